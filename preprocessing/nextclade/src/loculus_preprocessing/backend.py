@@ -1,21 +1,28 @@
 """Functions to interface with the backend"""
 
-import dataclasses
 import datetime as dt
-import json
 import logging
+import threading
 import time
 import uuid
-from collections.abc import Sequence
+import zlib
+from collections.abc import Iterable, Iterator, Sequence
+from functools import cache, partial
 from http import HTTPStatus
 from pathlib import Path
+from typing import Any
 from urllib.parse import urlparse
 
 import jwt
+import orjson
 import pytz
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
-from .config import Config
+from .config import Config, SubmissionCompression
+from .dataset_cache import DatasetCache
 from .datatypes import (
     FileCategory,
     FileIdAndNameAndReadUrl,
@@ -24,15 +31,31 @@ from .datatypes import (
     UnprocessedData,
     UnprocessedEntry,
 )
+from .metrics import metrics
 from .processing_functions import trim_ns
 
 logger = logging.getLogger(__name__)
 
+NO_BREAK_SPACE_UTF8 = "\N{NO-BREAK SPACE}".encode()
+# Bytes read from the socket at a time when streaming unprocessed entries
+NDJSON_CHUNK_SIZE = 64 * 1024
+# zlib window bits that make compressobj write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Connections kept alive to the backend and Keycloak, enough for the fetch and submit threads
+# of pipelined mode
+BACKEND_POOL_SIZE = 4
+# Bytes written at a time when downloading minimizer indexes and diamond databases
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class JwtCache:
     def __init__(self) -> None:
         self.token: str = ""
-        self.expiration: dt.datetime = dt.datetime.min
+        self.expiration: dt.datetime = dt.datetime.min.replace(tzinfo=pytz.UTC)
+        self.refresh_token: str = ""
+        self.refresh_expiration: dt.datetime = dt.datetime.min.replace(tzinfo=pytz.UTC)
+        # Held while a token is requested, so that concurrent callers wait for it
+        self.lock = threading.Lock()
 
     def get_token(self) -> str | None:
         # Only use token if it's got more than 5 minutes left
@@ -40,97 +63,151 @@ class JwtCache:
             return self.token
         return None
 
+    def get_refresh_token(self) -> str | None:
+        refresh_before = dt.datetime.now(tz=pytz.UTC) + dt.timedelta(seconds=30)
+        if self.refresh_token and self.refresh_expiration > refresh_before:
+            return self.refresh_token
+        return None
+
     def set_token(self, token: str, expiration: dt.datetime):
         self.token = token
         self.expiration = expiration
 
+    def set_refresh_token(self, refresh_token: str, expiration: dt.datetime):
+        self.refresh_token = refresh_token
+        self.refresh_expiration = expiration
+
 
 jwt_cache = JwtCache()
 
 
+@cache
+def backend_session() -> requests.Session:
+    """Session shared by all requests to the backend and Keycloak, so that connections are kept
+    alive between polls instead of being opened for every request"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=BACKEND_POOL_SIZE, pool_maxsize=BACKEND_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def get_jwt(config: Config) -> str:
-    if cached_token := jwt_cache.get_token():
-        logger.debug("Using cached JWT")
-        return cached_token
+    """Access token for the backend, cached until shortly before it expires and then renewed
+    with the refresh token, falling back to a password grant"""
+    with jwt_cache.lock:
+        if cached_token := jwt_cache.get_token():
+            logger.debug("Using cached JWT")
+            return cached_token
+
+        if refresh_token := jwt_cache.get_refresh_token():
+            try:
+                return request_jwt(
+                    config, {"grant_type": "refresh_token", "refresh_token": refresh_token}
+                )
+            except Exception as e:
+                logger.warning(f"Refreshing JWT failed, requesting a new one: {e}")
+
+        return request_jwt(
+            config,
+            {
+                "username": config.keycloak_user,
+                "password": config.keycloak_password,
+                "grant_type": "password",
+            },
+        )
 
+
+def request_jwt(config: Config, grant: dict[str, str]) -> str:
     url = config.keycloak_host.rstrip("/") + "/" + config.keycloak_token_path.lstrip("/")
-    data = {
-        "client_id": "backend-client",
-        "username": config.keycloak_user,
-        "password": config.keycloak_password,
-        "grant_type": "password",
-    }
+    data = {"client_id": "backend-client", **grant}
 
-    logger.debug(f"Requesting JWT from {url}")
+    logger.debug(f"Requesting JWT from {url} ({grant['grant_type']} grant)")
 
-    with requests.post(url, data=data, timeout=10) as response:
+    with backend_session().post(url, data=data, timeout=10) as response:
         if response.ok:
             logger.debug("JWT fetched successfully.")
-            token = response.json()["access_token"]
+            token_response = response.json()
+            token = token_response["access_token"]
             decoded = jwt.decode(token, options={"verify_signature": False})
             expiration = dt.datetime.fromtimestamp(decoded.get("exp", 0), tz=pytz.UTC)
             jwt_cache.set_token(token, expiration)
+            refresh_expires_in = token_response.get("refresh_expires_in") or 0
+            jwt_cache.set_refresh_token(
+                token_response.get("refresh_token", ""),
+                dt.datetime.now(tz=pytz.UTC) + dt.timedelta(seconds=refresh_expires_in),
+            )
             return token
         error_msg = f"Fetching JWT failed with status code {response.status_code}: {response.text}"
         logger.error(error_msg)
         raise Exception(error_msg)
 
 
-def parse_ndjson(ndjson_data: str) -> Sequence[UnprocessedEntry]:
-    entries: list[UnprocessedEntry] = []
-    if len(ndjson_data) == 0:
-        return entries
-    for json_str in ndjson_data.split("\n"):
-        if len(json_str) == 0 or json_str.isspace():
-            continue
-        # Loculus currently cannot handle non-breaking spaces.
-        json_str_processed = json_str.replace("\N{NO-BREAK SPACE}", " ")
-        try:
-            json_object = json.loads(json_str_processed)
-        except json.JSONDecodeError as e:
-            error_msg = f"Failed to parse JSON: {json_str_processed}"
-            raise ValueError(error_msg) from e
-        unaligned_nucleotide_sequences = json_object["data"]["unalignedNucleotideSequences"]
-        trimmed_unaligned_nucleotide_sequences = {
-            key: trim_ns(value) if value else None
-            for key, value in unaligned_nucleotide_sequences.items()
+def parse_unprocessed_entry(line: bytes | str) -> UnprocessedEntry:
+    """Parse one line of the /extract-unprocessed-data NDJSON response"""
+    # Loculus currently cannot handle non-breaking spaces.
+    if isinstance(line, bytes):
+        line = line.replace(NO_BREAK_SPACE_UTF8, b" ")
+    else:
+        line = line.replace("\N{NO-BREAK SPACE}", " ")
+    try:
+        json_object = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        line_str = line.decode(errors="replace") if isinstance(line, bytes) else line
+        error_msg = f"Failed to parse JSON: {line_str}"
+        raise ValueError(error_msg) from e
+    unaligned_nucleotide_sequences = json_object["data"]["unalignedNucleotideSequences"]
+    trimmed_unaligned_nucleotide_sequences = {
+        key: trim_ns(value) if value else None
+        for key, value in unaligned_nucleotide_sequences.items()
+    }
+    submitted_files = json_object["data"].get("files")
+    file_mapping = (
+        {
+            FileCategory(category): [
+                FileIdAndNameAndReadUrl(fileId=f["fileId"], name=f["name"], url=f.get("url"))
+                for f in files
+            ]
+            for category, files in submitted_files.items()
         }
-        submitted_files = json_object["data"].get("files")
-        file_mapping = (
-            {
-                FileCategory(category): [
-                    FileIdAndNameAndReadUrl(fileId=f["fileId"], name=f["name"], url=f.get("url"))
-                    for f in files
-                ]
-                for category, files in submitted_files.items()
-            }
-            if submitted_files
-            else None
-        )
-        unprocessed_data = UnprocessedData(
-            submitter=json_object["submitter"],
-            group_id=json_object["groupId"],
-            submittedAt=json_object["submittedAt"],
-            submissionId=json_object["submissionId"],
-            metadata=json_object["data"]["metadata"],
-            unalignedNucleotideSequences=trimmed_unaligned_nucleotide_sequences
-            if unaligned_nucleotide_sequences
-            else {},
-            files=file_mapping,
-        )
-        entry = UnprocessedEntry(
-            accessionVersion=f"{json_object['accession']}.{json_object['version']}",
-            data=unprocessed_data,
-        )
-        entries.append(entry)
-    return entries
+        if submitted_files
+        else None
+    )
+    unprocessed_data = UnprocessedData(
+        submitter=json_object["submitter"],
+        group_id=json_object["groupId"],
+        submittedAt=json_object["submittedAt"],
+        submissionId=json_object["submissionId"],
+        metadata=json_object["data"]["metadata"],
+        unalignedNucleotideSequences=trimmed_unaligned_nucleotide_sequences
+        if unaligned_nucleotide_sequences
+        else {},
+        files=file_mapping,
+    )
+    return UnprocessedEntry(
+        accessionVersion=f"{json_object['accession']}.{json_object['version']}",
+        data=unprocessed_data,
+    )
+
+
+def parse_ndjson_lines(lines: Iterable[bytes | str]) -> Iterator[UnprocessedEntry]:
+    """Parse NDJSON line by line as it arrives, e.g. from `Response.iter_lines()`, so that
+    neither the whole body nor all of its lines are held in memory at once"""
+    for line in lines:
+        if not line or line.isspace():
+            continue
+        yield parse_unprocessed_entry(line)
+
+
+def parse_ndjson(ndjson_data: str) -> Sequence[UnprocessedEntry]:
+    return list(parse_ndjson_lines(ndjson_data.split("\n")))
 
 
 def fetch_unprocessed_sequences(
-    etag: str | None, config: Config
+    etag: str | None, config: Config, batch_size: int | None = None
 ) -> tuple[str | None, Sequence[UnprocessedEntry] | None]:
     request_id = str(uuid.uuid4())
-    n = config.batch_size
+    n = batch_size or config.batch_size
     url = config.backend_host.rstrip("/") + "/extract-unprocessed-data"
     logger.debug(f"[{request_id}] Fetching {n} unprocessed sequences from {url}")
     params = {"numberOfSequenceEntries": n, "pipelineVersion": config.pipeline_version}
@@ -140,69 +217,139 @@ def fetch_unprocessed_sequences(
         **({"If-None-Match": etag} if etag else {}),
     }
     logger.debug(f"[{request_id}] Requesting data with ETag: {etag}")
-    response = requests.post(
-        url, data=params, headers=headers, timeout=config.backend_request_timeout_seconds
-    )
-    logger.info(
-        f"[{request_id}] Unprocessed data from backend: status code {response.status_code}, "
-        f"request id: {response.headers.get('x-request-id')}"
-    )
-    match response.status_code:
-        case HTTPStatus.NOT_MODIFIED:
-            return etag, None
-        case HTTPStatus.OK:
-            try:
-                parsed_ndjson = parse_ndjson(response.text)
-            except ValueError as e:
-                logger.error(f"[{request_id}] {e}")
-                time.sleep(10 * 1)
+    start = time.perf_counter()
+    # Streamed so that entries are parsed while the rest of the body is still being received
+    with backend_session().post(
+        url,
+        data=params,
+        headers=headers,
+        timeout=config.backend_request_timeout_seconds,
+        stream=True,
+    ) as response:
+        logger.info(
+            f"[{request_id}] Unprocessed data from backend: status code {response.status_code}, "
+            f"request id: {response.headers.get('x-request-id')}"
+        )
+        match response.status_code:
+            case HTTPStatus.NOT_MODIFIED:
+                metrics.record("fetch", time.perf_counter() - start)
+                return etag, None
+            case HTTPStatus.OK:
+                try:
+                    parsed_ndjson = list(
+                        parse_ndjson_lines(response.iter_lines(chunk_size=NDJSON_CHUNK_SIZE))
+                    )
+                except ValueError as e:
+                    logger.error(f"[{request_id}] {e}")
+                    time.sleep(10 * 1)
+                    return None, None
+                metrics.record("fetch", time.perf_counter() - start, len(parsed_ndjson))
+                return response.headers["ETag"], parsed_ndjson
+            case HTTPStatus.UNPROCESSABLE_ENTITY:
+                logger.debug(f"[{request_id}] {response.text}.\nSleeping for a while.")
+                time.sleep(60 * 1)
                 return None, None
-            return response.headers["ETag"], parsed_ndjson
-        case HTTPStatus.UNPROCESSABLE_ENTITY:
-            logger.debug(f"[{request_id}] {response.text}.\nSleeping for a while.")
-            time.sleep(60 * 1)
-            return None, None
-        case _:
-            msg = f"[{request_id}] Fetching unprocessed data failed. Status code: {response.status_code}"
-            raise Exception(
-                msg,
-                response.text,
-            )
+            case _:
+                msg = (
+                    f"[{request_id}] Fetching unprocessed data failed. "
+                    f"Status code: {response.status_code}"
+                )
+                raise Exception(
+                    msg,
+                    response.text,
+                )
+
+
+def serialize_processed_entry(entry: ProcessedEntry) -> bytes:
+    """One NDJSON line for /submit-processed-data; orjson serializes the dataclasses directly
+    instead of deep copying them with `dataclasses.asdict`"""
+    return orjson.dumps(entry, option=orjson.OPT_NON_STR_KEYS)
+
+
+def split_submission(lines: Sequence[bytes], max_request_bytes: int) -> Iterator[Sequence[bytes]]:
+    """Consecutive groups of NDJSON lines of at most `max_request_bytes` including line breaks,
+    a line larger than that is sent on its own"""
+    start = 0
+    size = 0
+    for index, line in enumerate(lines):
+        if index > start and size + len(line) + 1 > max_request_bytes:
+            yield lines[start:index]
+            start, size = index, 0
+        size += len(line) + 1
+    if start < len(lines):
+        yield lines[start:]
+
+
+def ndjson_body(
+    lines: Sequence[bytes], compression: SubmissionCompression | None
+) -> Iterator[bytes]:
+    """Stream the lines as NDJSON in chunks of about NDJSON_CHUNK_SIZE bytes, compressed on the
+    fly if requested"""
+    compressor: Any = None
+    match compression:
+        case SubmissionCompression.GZIP:
+            compressor = zlib.compressobj(wbits=GZIP_WBITS)
+        case SubmissionCompression.ZSTD:
+            compressor = zstandard.ZstdCompressor().compressobj()
+    chunk: list[bytes] = []
+    chunk_size = 0
+    for index, line in enumerate(lines):
+        if index:
+            chunk.append(b"\n")
+        chunk.append(line)
+        chunk_size += len(line) + 1
+        if chunk_size >= NDJSON_CHUNK_SIZE or index == len(lines) - 1:
+            data = b"".join(chunk)
+            chunk, chunk_size = [], 0
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    if compressor:
+        yield compressor.flush()
 
 
 def submit_processed_sequences(
     processed: Sequence[ProcessedEntry], dataset_dir: str, config: Config
 ) -> None:
-    request_id = str(uuid.uuid4())
-    json_strings = [json.dumps(dataclasses.asdict(sequence)) for sequence in processed]
+    start = time.perf_counter()
+    lines = [serialize_processed_entry(sequence) for sequence in processed]
     if config.keep_tmp_dir:
         # For debugging: write all submit requests to submission_requests.json
-        with open(dataset_dir + "/submission_requests.json", "w", encoding="utf-8") as f:
-            for seq in processed:
-                json.dump(dataclasses.asdict(seq), f)
-    ndjson_string = "\n".join(json_strings)
+        with open(dataset_dir + "/submission_requests.json", "wb") as f:
+            f.writelines(line + b"\n" for line in lines)
+    for request_lines in split_submission(lines, config.submission_max_request_bytes):
+        submit_processed_lines(request_lines, config)
+    metrics.record("submit", time.perf_counter() - start, len(processed))
+
+
+def submit_processed_lines(lines: Sequence[bytes], config: Config) -> None:
+    request_id = str(uuid.uuid4())
     url = config.backend_host.rstrip("/") + "/submit-processed-data"
     headers = {
         "Content-Type": "application/x-ndjson",
         "Authorization": "Bearer " + get_jwt(config),
         "x-request-id": request_id,
     }
+    if config.submission_compression:
+        headers["Content-Encoding"] = config.submission_compression
     params = {"pipelineVersion": config.pipeline_version}
-    logger.info(f"[{request_id}] Submitting {len(processed)} processed sequences to {url}")
-    response = requests.post(
+    logger.info(f"[{request_id}] Submitting {len(lines)} processed sequences to {url}")
+    response = backend_session().post(
         url,
-        data=ndjson_string,
+        data=ndjson_body(lines, config.submission_compression),
         headers=headers,
         params=params,
         timeout=config.backend_request_timeout_seconds,
     )
     if not response.ok:
-        Path("failed_submission.json").write_text(ndjson_string, encoding="utf-8")
+        ndjson = b"\n".join(lines)
+        Path("failed_submission.json").write_bytes(ndjson)
         msg = (
             f"[{request_id}] Submitting processed data failed. Status code: {response.status_code}, "
             f"request id: {response.headers.get('x-request-id')}\n"
             f"Response: {response.text}\n"
-            f"Data sent: {ndjson_string[:1000]}...\n"
+            f"Data sent: {ndjson[:1000].decode(errors='replace')}...\n"
         )
         raise RuntimeError(msg)
     logger.info(
@@ -225,7 +372,7 @@ def request_upload(group_id: int, number_of_files: int, config: Config) -> Seque
     logger.info(
         f"[{request_id}] Requesting upload for {number_of_files} files, group_id: {group_id}"
     )
-    response = requests.post(
+    response = backend_session().post(
         url, headers=headers, params=params, timeout=config.backend_request_timeout_seconds
     )
     if not response.ok:
@@ -237,18 +384,88 @@ def request_upload(group_id: int, number_of_files: int, config: Config) -> Seque
     return [FileUploadInfo(**item) for item in response.json()]
 
 
+@cache
+def upload_session(pool_size: int) -> requests.Session:
+    """Session for uploads to presigned URLs that keeps up to pool_size connections alive and
+    retries each upload on connection errors and 5xx responses"""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["PUT"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def upload_embl_file_to_presigned_url(
-    content: str, url: str, extra_headers: dict | None = None
+    content: str,
+    url: str,
+    extra_headers: dict | None = None,
+    session: requests.Session | None = None,
 ) -> None:
     headers = {"Content-Type": "chemical/x-embl-dl-nucleotide"}
     if extra_headers:
         headers.update(extra_headers)
-    r = requests.put(url, data=content.encode("utf-8"), headers=headers, timeout=60)
+    put = session.put if session else requests.put
+    r = put(url, data=content.encode("utf-8"), headers=headers, timeout=60)
     if not r.ok:
         msg = f"Upload failed: {r.status_code}, {r.text}"
         raise RuntimeError(msg)
 
 
+def write_response(response: requests.Response, path: Path) -> None:
+    with path.open("wb") as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+
+
+def save_download(response: requests.Response, file_name: str, directory: Path) -> dict[str, str]:
+    """Write the body to directory/file_name, return the validators for revalidating it"""
+    write_response(response, directory / file_name)
+    return {
+        name: response.headers[header]
+        for name, header in (("etag", "ETag"), ("last_modified", "Last-Modified"))
+        if header in response.headers
+    }
+
+
+def download_file(url: str, save_path: str, config: Config) -> None:
+    """Download url to save_path. With a dataset cache, the cached copy is revalidated with a
+    conditional request and reused if unchanged, or if the server cannot be reached."""
+    dataset_cache: DatasetCache | None = config._dataset_cache  # type: ignore
+    if dataset_cache is None:
+        with requests.get(url, timeout=10, stream=True) as response:
+            response.raise_for_status()
+            Path(save_path).parent.mkdir(parents=True, exist_ok=True)
+            write_response(response, Path(save_path))
+        return
+
+    key = ("url", url)
+    file_name = Path(save_path).name
+    cached = dataset_cache.lookup(key)
+    headers = {}
+    if cached and (etag := cached.metadata.get("etag")):
+        headers["If-None-Match"] = etag
+    if cached and (last_modified := cached.metadata.get("last_modified")):
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        with requests.get(url, headers=headers, timeout=10, stream=True) as response:
+            if not cached or response.status_code != HTTPStatus.NOT_MODIFIED:
+                response.raise_for_status()
+                cached = dataset_cache.install(key, partial(save_download, response, file_name))
+    except requests.exceptions.RequestException as e:
+        if not cached:
+            raise
+        logger.warning(f"Revalidating cached download of {url} failed, using it anyway: {e}")
+    dataset_cache.link(cached.path / file_name, save_path)
+
+
 def download_minimizer(config, save_path):
     if config.minimizer_url:
         url = config.minimizer_url
@@ -260,10 +477,7 @@ def download_minimizer(config, save_path):
         raise RuntimeError(msg)
 
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        Path(save_path).parent.mkdir(parents=True, exist_ok=True)
-        Path(save_path).write_bytes(response.content)
+        download_file(url, save_path, config)
     except requests.exceptions.RequestException as e:
         msg = f"Failed to download minimizer: {e}"
         logger.error(msg)
@@ -280,10 +494,7 @@ def download_diamond_db(config, save_path):
         raise RuntimeError(msg)
 
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        Path(save_path).parent.mkdir(parents=True, exist_ok=True)
-        Path(save_path).write_bytes(response.content)
+        download_file(url, save_path, config)
     except requests.exceptions.RequestException as e:
         msg = f"Failed to download diamond db: {e}"
         logger.error(msg)
@@ -0,0 +1,67 @@
+"""Adaptive number of sequences requested from the backend per batch"""
+
+import logging
+
+from .config import Config
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the backend in-processing timeout or S3 read URL lifetime a batch may use, leaving
+# headroom for slower batches and for the time batches wait in pipelined mode
+DEADLINE_SAFETY_FRACTION = 0.5
+GROWTH_FACTOR = 2
+
+
+class BatchSizeController:
+    """Chooses the batch size from the wall time of previous batches.
+
+    A batch's time runs from requesting it until its submission finished. If it exceeded the
+    budget (the target, capped by the deadlines that apply), the size is scaled down to what
+    would have fit. If a full batch was returned, suggesting a backlog, and it fit the budget,
+    the size grows by up to GROWTH_FACTOR. With `adaptive_batch_size` off, `batch_size` is fixed.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.enabled = config.adaptive_batch_size
+        self.min_size = max(config.min_batch_size, 1)
+        self.max_size = max(config.max_batch_size, self.min_size)
+        self.target_seconds = config.target_batch_seconds
+        self.backend_timeout_seconds = config.backend_processing_timeout_seconds
+        self.url_expiry_seconds = config.file_read_url_expiry_seconds
+        self.batch_size = (
+            min(max(config.batch_size, self.min_size), self.max_size)
+            if self.enabled
+            else config.batch_size
+        )
+        metrics.set_gauge("batch_size", self.batch_size)
+
+    def budget_seconds(self, has_files: bool) -> float:
+        deadline = self.backend_timeout_seconds
+        if has_files:
+            deadline = min(deadline, self.url_expiry_seconds)
+        return min(self.target_seconds, deadline * DEADLINE_SAFETY_FRACTION)
+
+    def observe(self, requested: int, received: int, seconds: float, has_files: bool) -> int:
+        """Update the batch size after a batch of `received` entries (out of `requested`) took
+        `seconds` from fetching to submission. Returns the new batch size."""
+        if not self.enabled or received == 0:
+            return self.batch_size
+        budget = self.budget_seconds(has_files)
+        seconds_per_entry = max(seconds / received, 1e-6)
+        fitting = int(budget / seconds_per_entry)
+        if seconds > budget:
+            new_size = min(fitting, self.batch_size - 1)
+        elif received >= requested:
+            new_size = max(min(fitting, self.batch_size * GROWTH_FACTOR), self.batch_size)
+        else:
+            new_size = self.batch_size
+        new_size = min(max(new_size, self.min_size), self.max_size)
+        if new_size != self.batch_size:
+            logger.info(
+                f"Changing batch size from {self.batch_size} to {new_size}: last batch of "
+                f"{received}/{requested} entries took {seconds:.1f}s (budget {budget:.1f}s)"
+            )
+            self.batch_size = new_size
+            metrics.set_gauge("batch_size", new_size)
+        return self.batch_size
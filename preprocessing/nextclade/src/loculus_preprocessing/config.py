@@ -10,6 +10,7 @@ from typing import Any, get_args
 import yaml
 from pydantic import BaseModel, Field, PrivateAttr, model_validator
 
+from loculus_preprocessing.dataset_cache import DatasetCache
 from loculus_preprocessing.datatypes import (
     FileCategory,
     FunctionArgs,
@@ -23,6 +24,7 @@ from loculus_preprocessing.external_services import (
     FileProcessingService,
     TaxonomyService,
 )
+from loculus_preprocessing.nextclade_cache import NextcladeResultCache
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +38,75 @@ ASSIGNED_REFERENCE_PREFIX = "ASSIGNED_REFERENCE"
 INTERNAL_INPUT_PREFIXES = (NEXTCLADE_PREFIX, ASSIGNED_REFERENCE_PREFIX)
 
 
+type NestedPathProjection = dict[str, NestedPathProjection | None]
+
+
+class NestedPath:
+    """
+    Accessor for a dot-separated path into nested dicts, e.g. `qc.stopCodons.stopCodons`.
+    The path is split once on construction. Components from a `*` wildcard onwards are dropped,
+    so `cladeFounderInfo.aaMutations.*.privateSubstitutions` returns the `aaMutations` value.
+    """
+
+    __slots__ = ("parts",)
+
+    def __init__(self, path: str, separator: str = ".") -> None:
+        parts = path.split(separator)
+        if "*" in parts:
+            parts = parts[: parts.index("*")]
+        self.parts: tuple[str, ...] = tuple(parts)
+
+    def __call__(self, data: Any) -> Any | None:
+        value = data
+        for part in self.parts:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+            if value is None:
+                return None
+        return value
+
+
+def build_projection(paths: list[tuple[str, ...]]) -> NestedPathProjection:
+    """
+    Merge paths into a tree of the keys to retain. A leaf (None) retains the whole subtree, so a
+    path that is a prefix of another path wins.
+    """
+    projection: NestedPathProjection = {}
+    for parts in paths:
+        node = projection
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})  # type: ignore[assignment]
+        else:
+            if parts:
+                node[parts[-1]] = None
+    return projection
+
+
+def project(data: dict[str, Any], projection: NestedPathProjection) -> dict[str, Any]:
+    """Copy of `data` restricted to the keys in `projection`"""
+    result: dict[str, Any] = {}
+    for key, subtree in projection.items():
+        if key not in data:
+            continue
+        value = data[key]
+        if subtree is None:
+            result[key] = value
+        elif isinstance(value, dict):
+            result[key] = project(value, subtree)
+    return result
+
+
+def available_cores() -> int:
+    """Number of CPUs this process may run on, respecting affinity masks set by the container"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 class EmblInfoMetadataPropertyNames(BaseModel):
     country_property: str = "geoLocCountry"
     admin_level_properties: list[str] = Field(
@@ -65,6 +136,11 @@ class AlignmentRequirement(StrEnum):
     NONE = "NONE"
 
 
+class SubmissionCompression(StrEnum):
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
 type SegmentName = str
 # name of the processed nucleotide sequence, as expected by the backend and LAPIS
 type SequenceName = str
@@ -107,6 +183,38 @@ class Config(BaseModel):
     batch_size: int = 5
     pipeline_version: int = 1
     backend_request_timeout_seconds: int = 30
+    # Overlap fetching, processing and submitting of consecutive batches
+    pipelined: bool = False
+    # Number of fetched batches that may wait for processing in pipelined mode
+    prefetch_batches: int = 1
+    # Number of processed batches that may wait for submission in pipelined mode
+    submit_queue_size: int = 1
+    # Worker processes for per-entry metadata processing, 1 processes entries in the main process
+    processing_workers: int = 1
+    # Adapt the number of sequences requested per batch between min and max batch size: grow
+    # while full batches finish within target_batch_seconds, shrink when they take longer or get
+    # close to the backend's in-processing timeout or the expiry of S3 read URLs for files
+    adaptive_batch_size: bool = False
+    min_batch_size: int = 1
+    max_batch_size: int = 100
+    target_batch_seconds: float = 30
+    # Backend resets entries that stay in processing for longer (helm value preprocessingTimeout)
+    backend_processing_timeout_seconds: int = 120
+    # Lifetime of the presigned S3 read URLs of files attached to unprocessed entries
+    file_read_url_expiry_seconds: int = 1800
+    # Wait between polls for unprocessed data while there is none, doubling from the minimum up
+    # to the maximum while the backend stays idle and resetting once work arrives
+    idle_poll_interval_seconds: float = 1
+    max_idle_poll_interval_seconds: float = 10
+    # Log a summary of per-stage wall times and item counts at most this often
+    metrics_log_interval_seconds: int = 60
+    # Serve cumulative per-stage metrics in Prometheus format at /metrics, disabled if unset
+    metrics_port: int | None = None
+    # Content-Encoding for submitted processed data; the backend, or a proxy in front of it,
+    # must decode compressed request bodies. Uncompressed if unset
+    submission_compression: SubmissionCompression | None = None
+    # Split a batch's submission into several requests once its NDJSON exceeds this many bytes
+    submission_max_request_bytes: int = 64 * 1024 * 1024
 
     backend_host: str = ""  # base API URL and organism - populated in get_config if left empty
     keycloak_host: str = "http://127.0.0.1:8083"
@@ -119,16 +227,38 @@ class Config(BaseModel):
     segments: list[Segment] = Field(default_factory=list)
     processing_spec: dict[str, ProcessingSpec] = Field(default_factory=dict)
     processing_order: tuple[str, ...] = ()
+    # Compiled form of processing_spec in processing_order, built by prepro on first use
+    _processing_plan: Any = PrivateAttr(default=None)
 
     alignment_requirement: AlignmentRequirement = AlignmentRequirement.ALL
     segment_classification_method: SegmentClassificationMethod = SegmentClassificationMethod.ALIGN
     nextclade_dataset_server: str = "https://data.clades.nextstrain.org/v3"
 
+    # Total nextclade threads per batch, split across datasets by number of sequences
+    nextclade_jobs: int = Field(default_factory=available_cores)
+    # Directory for caching nextclade results per sequence and dataset, disabled if unset
+    nextclade_cache_dir: str | None = None
+    nextclade_cache_max_size_mb: int = 1024
+    _nextclade_cache: NextcladeResultCache | None = PrivateAttr(default=None)
+    # Accessors for every `nextclade.` input path, and the subtrees of a result they read
+    _nextclade_paths: dict[str, NestedPath] = PrivateAttr(default_factory=dict)
+    _nextclade_projection: NestedPathProjection = PrivateAttr(default_factory=dict)
+
     require_nextclade_sort_match: bool = False
     minimizer_url: str | None = None
     diamond_dmnd_url: str | None = None
+    # Directory for caching downloaded nextclade datasets (with a tag), minimizer indexes and
+    # diamond databases across restarts, disabled if unset
+    dataset_cache_dir: str | None = None
+    # Re-hash every cached file before use instead of only those whose size or mtime changed
+    dataset_cache_verify_checksums: bool = False
+    # Cached downloads not used for this long are evicted when another download is added
+    dataset_cache_max_unused_days: int = 30
+    _dataset_cache: DatasetCache | None = PrivateAttr(default=None)
 
     create_embl_file: bool = False
+    # EMBL files created and uploaded concurrently per batch
+    embl_upload_workers: int = 8
     scientific_name: str = "Orthonairovirus haemorrhagiae"
     molecule_type: MoleculeType = MoleculeType.GENOMIC_RNA
     topology: Topology = Topology.LINEAR
@@ -146,6 +276,15 @@ class Config(BaseModel):
         default=FileProcessingService(None, 600)
     )
 
+    def __getstate__(self) -> dict[Any, Any]:
+        # The compiled processing plan holds closures, processing workers compile their own
+        state = super().__getstate__()
+        state["__pydantic_private__"] = {
+            **state["__pydantic_private__"],
+            "_processing_plan": None,
+        }
+        return state
+
     @model_validator(mode="after")
     def finalize(self):
         if not self.segments:
@@ -164,8 +303,24 @@ class Config(BaseModel):
             self.raw_reads_processing_service_url, self.raw_reads_processing_service_timeout_seconds
         )
 
+        if self.nextclade_cache_dir:
+            self._nextclade_cache = NextcladeResultCache(
+                self.nextclade_cache_dir, self.nextclade_cache_max_size_mb * 1024 * 1024
+            )
+
+        if self.dataset_cache_dir:
+            self._dataset_cache = DatasetCache(
+                self.dataset_cache_dir,
+                verify_checksums=self.dataset_cache_verify_checksums,
+                max_unused_seconds=self.dataset_cache_max_unused_days * 24 * 3600,
+            )
+
         validate_required_when(self)
         self.processing_order = get_processing_order(self)
+        self._nextclade_paths = get_nextclade_paths(self)
+        self._nextclade_projection = build_projection(
+            [accessor.parts for accessor in self._nextclade_paths.values()]
+        )
         self._taxonomy_service = TaxonomyService(self.taxonomy_service_url)
 
         return self
@@ -295,6 +450,18 @@ def validate_required_when(config: Config) -> None:
                 raise ValueError(msg)
 
 
+def get_nextclade_paths(config: Config) -> dict[str, NestedPath]:
+    """Compiled accessors for every nextclade result path used as input in the processing spec,
+    keyed by the path without the `nextclade.` prefix."""
+    return {
+        path: NestedPath(path)
+        for spec in config.processing_spec.values()
+        for input_path in spec.inputs.values()
+        if input_path.startswith(NEXTCLADE_PREFIX)
+        and (path := input_path.removeprefix(NEXTCLADE_PREFIX))
+    }
+
+
 def get_processing_order(config: Config) -> tuple[str, ...]:
     """Return a valid order for processing metadata fields based on their dependencies.
 
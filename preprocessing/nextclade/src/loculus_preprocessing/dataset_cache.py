@@ -0,0 +1,219 @@
+"""Persistent cache of downloaded nextclade datasets, minimizer indexes and diamond databases"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = ".manifest.json"
+
+
+@dataclass
+class CachedDataset:
+    """A verified cache entry. `metadata` holds what the download recorded, e.g. the ETag."""
+
+    path: Path
+    metadata: dict[str, str] = field(default_factory=dict)
+
+
+def file_sha256(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def directory_files(directory: Path) -> dict[str, Path]:
+    """Every file below `directory` by relative path"""
+    return {
+        path.relative_to(directory).as_posix(): path
+        for path in sorted(directory.rglob("*"))
+        if path.is_file() and path.name != MANIFEST_FILE
+    }
+
+
+def file_stat(path: Path) -> list[int]:
+    """Size and modification time of a file, to detect changes without hashing it"""
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def directory_manifest(directory: Path) -> dict[str, str]:
+    """sha256 of every file below `directory` by relative path"""
+    return {name: file_sha256(path) for name, path in directory_files(directory).items()}
+
+
+def manifest_digest(manifest: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+class DatasetCache:
+    """On-disk cache of downloads, keyed by what was downloaded, e.g. (server, name, tag).
+
+    Downloads are stored content-addressed in `objects/<sha256 of the file checksums>`, where
+    the manifest lists the sha256, size and modification time of every file. A download is
+    written to a temporary directory and renamed into place, and `refs/<sha256 of the key>.json`
+    then atomically points the key at it, so the directory can be shared between replicas, e.g.
+    on a volume of the node. Entries are verified against their manifest before use, re-hashing
+    only files whose size or modification time changed unless `verify_checksums` is set. Entries
+    that do not match are moved to `quarantine/` rather than deleted, as other replicas may
+    still use them.
+
+    Adding a download evicts refs and objects that were not used for `max_unused_seconds`,
+    where objects count as used while a ref points at them.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        verify_checksums: bool = False,
+        max_unused_seconds: float = 30 * 24 * 3600,
+    ) -> None:
+        self.objects_dir = Path(cache_dir) / "objects"
+        self.refs_dir = Path(cache_dir) / "refs"
+        self.quarantine_dir = Path(cache_dir) / "quarantine"
+        self.verify_checksums = verify_checksums
+        self.max_unused_seconds = max_unused_seconds
+
+    def _ref_path(self, key: Sequence[str | None]) -> Path:
+        return self.refs_dir / (hashlib.sha256(json.dumps(key).encode()).hexdigest() + ".json")
+
+    @staticmethod
+    def verify(path: Path, rehash: bool = False) -> bool:
+        """Whether the files of `path` match its manifest. Only files whose size or modification
+        time differ from the manifest are hashed, all of them with `rehash`."""
+        try:
+            manifest = json.loads((path / MANIFEST_FILE).read_text(encoding="utf-8"))
+            checksums, stats = manifest["files"], manifest["stats"]
+            files = directory_files(path)
+            if manifest_digest(checksums) != path.name or files.keys() != checksums.keys():
+                return False
+            return all(
+                file_sha256(file) == checksums[name]
+                for name, file in files.items()
+                if rehash or file_stat(file) != stats.get(name)
+            )
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Cannot verify dataset cache entry {path}: {e}")
+            return False
+
+    def quarantine(self, path: Path) -> None:
+        """Move a corrupted entry out of `objects/`. It is not deleted in place, as replicas that
+        linked it may still have its files open."""
+        self.quarantine_dir.mkdir(parents=True, exist_ok=True)
+        destination = self.quarantine_dir / f"{path.name}-{uuid.uuid4().hex}"
+        try:
+            path.rename(destination)
+            os.utime(destination)
+        except OSError as e:
+            # E.g. quarantined by another replica in the meantime
+            logger.warning(f"Cannot quarantine dataset cache entry {path}: {e}")
+            return
+        logger.warning(f"Moved corrupted dataset cache entry {path} to {destination}")
+
+    def lookup(self, key: Sequence[str | None]) -> CachedDataset | None:
+        ref_path = self._ref_path(key)
+        try:
+            ref = json.loads(ref_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable dataset cache ref {ref_path}: {e}")
+            ref_path.unlink(missing_ok=True)
+            return None
+        path = self.objects_dir / ref["object"]
+        if not self.verify(path, rehash=self.verify_checksums):
+            logger.warning(f"Discarding dataset cache entry {path} of {key}: checksum mismatch")
+            if path.exists():
+                self.quarantine(path)
+            ref_path.unlink(missing_ok=True)
+            return None
+        # Mark the entry as used for eviction
+        for used in (ref_path, path):
+            with contextlib.suppress(OSError):
+                os.utime(used)
+        logger.info(f"Using cached download of {key} from {path}")
+        return CachedDataset(path, ref.get("metadata", {}))
+
+    def install(
+        self, key: Sequence[str | None], download: Callable[[Path], dict[str, str] | None]
+    ) -> CachedDataset:
+        """Call `download` to write the files of `key` into an empty directory, then add them to
+        the cache. `download` may return metadata to keep with the entry."""
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.refs_dir.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.objects_dir, prefix=".tmp-"))
+        try:
+            metadata = download(tmp) or {}
+            checksums = directory_manifest(tmp)
+            stats = {name: file_stat(file) for name, file in directory_files(tmp).items()}
+            (tmp / MANIFEST_FILE).write_text(
+                json.dumps({"files": checksums, "stats": stats}), encoding="utf-8"
+            )
+            path = self.objects_dir / manifest_digest(checksums)
+            if path.exists() and not self.verify(path, rehash=self.verify_checksums):
+                self.quarantine(path)
+            try:
+                tmp.rename(path)
+            except OSError:
+                # Installed concurrently or earlier under a different key, keep that copy
+                if not path.is_dir():
+                    raise
+                os.utime(path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        ref_path = self._ref_path(key)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.refs_dir, delete=False, encoding="utf-8"
+        ) as ref:
+            json.dump({"key": list(key), "object": path.name, "metadata": metadata}, ref)
+        os.replace(ref.name, ref_path)
+        logger.info(f"Added download of {key} to dataset cache at {path}")
+        self.evict()
+        return CachedDataset(path, metadata)
+
+    def evict(self) -> None:
+        """Delete refs not used for `max_unused_seconds`, then objects that no remaining ref
+        points at and that were not used for as long either. The latter also covers temporary
+        directories of failed installs and the quarantine."""
+        cutoff = time.time() - self.max_unused_seconds
+        referenced = set()
+        for ref_path in self.refs_dir.glob("*.json"):
+            try:
+                if ref_path.stat().st_mtime < cutoff:
+                    logger.info(f"Evicting unused dataset cache ref {ref_path}")
+                    ref_path.unlink()
+                    continue
+                referenced.add(json.loads(ref_path.read_text(encoding="utf-8"))["object"])
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Cannot read dataset cache ref {ref_path}: {e}")
+                # Keep all objects rather than evicting one this ref may point at
+                return
+        for directory in (self.objects_dir, self.quarantine_dir):
+            if not directory.is_dir():
+                continue
+            for path in directory.iterdir():
+                try:
+                    if path.name in referenced or path.stat().st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                logger.info(f"Evicting unused dataset cache entry {path}")
+                shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def link(source: Path, destination: str) -> None:
+        """Make a cached file or directory available at `destination`"""
+        Path(destination).parent.mkdir(parents=True, exist_ok=True)
+        Path(destination).symlink_to(source.resolve(), target_is_directory=source.is_dir())
@@ -249,6 +249,9 @@ class SequenceAssignmentBatch:
         default_factory=dict
     )
     alerts: Alerts = field(default_factory=Alerts)
+    # Directory with the full `nextclade run` output per dataset if segments were assigned by
+    # aligning, so enrichment can reuse the alignment of each sequence to its assigned dataset
+    nextcladeResultDir: str | None = None  # noqa: N815
 
 
 @dataclass
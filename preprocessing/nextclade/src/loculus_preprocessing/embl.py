@@ -1,9 +1,10 @@
+import io
 import logging
+import re
+from dataclasses import dataclass, field
 from typing import Any
 
-from Bio.Seq import Seq
-from Bio.SeqFeature import CompoundLocation, FeatureLocation, Reference, SeqFeature
-from Bio.SeqRecord import SeqRecord
+from Bio.Seq import translate
 from unidecode import unidecode
 
 from loculus_preprocessing.datatypes import MoleculeType, ProcessedMetadata, SubmissionData
@@ -12,6 +13,33 @@ from .config import Config
 
 logger = logging.getLogger(__name__)
 
+# Layout of Biopython's EMBL writer, which the writer below reproduces byte for byte
+MAX_LINE_WIDTH = 80
+HEADER_TEXT_WIDTH = MAX_LINE_WIDTH - 5
+QUALIFIER_INDENT = 21
+QUALIFIER_INDENT_STR = "FT" + " " * (QUALIFIER_INDENT - 2)
+FEATURE_HEADER = "FH   Key             Location/Qualifiers\nFH\n"
+LETTERS_PER_BLOCK = 10
+LETTERS_PER_LINE = 6 * LETTERS_PER_BLOCK
+# Qualifiers whose values are written without quotes
+UNQUOTED_QUALIFIERS = frozenset(
+    {
+        "anticodon",
+        "citation",
+        "codon_start",
+        "compare",
+        "direction",
+        "estimated_length",
+        "mod_base",
+        "number",
+        "rpt_type",
+        "rpt_unit_range",
+        "tag_peptide",
+        "transl_except",
+        "transl_table",
+    }
+)
+
 # EMBL allowed qualifiers constant
 EMBL_ANNOTATIONS: dict[str, list[str]] = {
     "cds_qualifiers": [
@@ -99,8 +127,8 @@ def reformat_authors_from_loculus_to_embl_style(authors: str) -> str:
     See section "3.4.10.6: The RA Line" here: https://raw.githubusercontent.com/enasequence/read_docs/c4bd306c82710844128cdf43003a0167837dc442/submit/fileprep/flatfile_user_manual.txt
     Note if the initials are not known the surname alone will be listed.
 
-    This function does not add a semicolon as the Bio package adds a semicolon when creating
-    a SeqRecord."""
+    This function does not add a semicolon as the RA line is terminated by one when the flatfile
+    is written."""
     authors_list = [author for author in authors.split(";") if author]
     ena_authors = []
     for author in authors_list:
@@ -145,9 +173,79 @@ def get_authors(authors: str) -> str:
         raise ValueError(msg) from err
 
 
-def get_seq_features(  # noqa: PLR0914
-    annotation_object: dict[str, Any], sequence_str: str
-) -> list[SeqFeature]:
+@dataclass
+class EmblFeature:
+    type: str
+    location: str  # In INSDC feature table notation, e.g. "complement(join(1..10,20..30))"
+    qualifiers: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class EmblRecord:
+    id: str
+    molecule_type: str  # "DNA", "RNA" or "cRNA"
+    topology: str
+    description: str
+    organism: str
+    authors: str
+    sequence: str
+    features: list[EmblFeature]
+
+
+def span_location(begin: int, end: int, sequence_length: int) -> str:
+    """Location of the zero based, end exclusive range [begin, end) in INSDC notation"""
+    if end < begin:
+        msg = f"End location ({end}) must be greater than or equal to start location ({begin})"
+        raise ValueError(msg)
+    if begin == end:
+        # Zero length range: the point between two bases
+        return f"{end}^1" if end == sequence_length else f"{end}^{end + 1}"
+    if begin + 1 == end:
+        return str(end)
+    return f"{begin + 1}..{end}"
+
+
+def cds_location(ranges: list[dict[str, int]], strands: list[int], sequence_length: int) -> str:
+    """Location of a CDS from its segments; a join of reverse strand segments is written as
+    complement(join(...)) with the segments in reverse order"""
+    spans = [span_location(r["begin"], r["end"], sequence_length) for r in ranges]
+    if not spans:
+        msg = "CDS has no segments"
+        raise ValueError(msg)
+    if len(spans) == 1:
+        return f"complement({spans[0]})" if strands[0] == -1 else spans[0]
+    if all(strand == -1 for strand in strands):
+        return f"complement(join({','.join(reversed(spans))}))"
+    return (
+        "join("
+        + ",".join(
+            f"complement({span})" if strand == -1 else span
+            for span, strand in zip(spans, strands, strict=False)
+        )
+        + ")"
+    )
+
+
+class CodonTranslations(dict[str, str]):  # noqa: FURB189
+    """Translation of each codon seen so far with the standard table, computed by Biopython on
+    first use"""
+
+    def __missing__(self, codon: str) -> str:
+        amino_acid = self[codon] = translate(codon)
+        return amino_acid
+
+
+codon_translations = CodonTranslations()
+CODON_PATTERN = re.compile(r"...", re.DOTALL)
+
+
+def translate_sequence(sequence: str) -> str:
+    """Same as Biopython's `translate` with the standard table, which translates each codon on
+    its own and drops a trailing partial codon"""
+    return "".join(map(codon_translations.__getitem__, CODON_PATTERN.findall(sequence)))
+
+
+def get_seq_features(annotation_object: dict[str, Any], sequence_str: str) -> list[EmblFeature]:
     """
     Takes a dictionary object with the following structure:
     {
@@ -162,7 +260,7 @@ def get_seq_features(  # noqa: PLR0914
                 },...]
         },..]
     }
-    Creates a list of gene and CDS SeqFeature using:
+    Creates a list of gene and CDS features using:
     - https://www.ebi.ac.uk/ena/WebFeat/
     - https://www.insdc.org/submitting-standards/feature-table/
     Converts ranges from index-0 to index-1 and makes the ranges [] have an inclusive start and
@@ -174,11 +272,15 @@ def get_seq_features(  # noqa: PLR0914
         "Note": "note",
         "phase": "codon_start",
     }
+    gene_attributes_map = {
+        qualifier: qualifier for qualifier in EMBL_ANNOTATIONS["gene_qualifiers"]
+    }
+    gene_attributes_map.update(attribute_map)
+    cds_attributes_map = {qualifier: qualifier for qualifier in EMBL_ANNOTATIONS["cds_qualifiers"]}
+    cds_attributes_map.update(attribute_map)
+    sequence_length = len(sequence_str)
     feature_list = []
     for gene in annotation_object.get("genes", []):
-        gene_qualifiers = EMBL_ANNOTATIONS.get("gene_qualifiers", [])
-        gene_attributes_map = {qualifier: qualifier for qualifier in gene_qualifiers}
-        gene_attributes_map.update(attribute_map)
         gene_range = gene.get("range")
         attributes = gene.get("attributes", {})
         qualifiers = {
@@ -186,27 +288,14 @@ def get_seq_features(  # noqa: PLR0914
             for old_key, new_key in gene_attributes_map.items()
             if old_key in attributes
         }
-        # In FeatureLocation start and end are zero based, exclusive end.
-        # thus an embl entry of 123..150 (one based counting) becomes a location of [122:150]
-        feature = SeqFeature(
-            FeatureLocation(start=gene_range["begin"], end=gene_range["end"]),
-            type="gene",
-            qualifiers=qualifiers,
-        )
-        feature_list.append(feature)
+        # An EMBL location of 123..150 (one based counting) is the range [122:150]
+        location = span_location(gene_range["begin"], gene_range["end"], sequence_length)
+        feature_list.append(EmblFeature("gene", location, qualifiers))
         for cds in gene.get("cdses", []):
-            cds_qualifiers = EMBL_ANNOTATIONS.get("cds_qualifiers", [])
-            cds_attributes_map = {qualifier: qualifier for qualifier in cds_qualifiers}
-            cds_attributes_map.update(attribute_map)
             segments = cds.get("segments", [])
             ranges = [segment.get("range") for segment in segments]
             attributes_cds = cds.get("attributes", {})
             strands = [-1 if segment.get("strand") == "-" else +1 for segment in segments]
-            locations = [
-                FeatureLocation(start=r["begin"], end=r["end"], strand=s)
-                for r, s in zip(ranges, strands, strict=False)
-            ]
-            compound_location = locations[0] if len(locations) == 1 else CompoundLocation(locations)
             qualifiers = {
                 new_key: attributes_cds[old_key]
                 for old_key, new_key in cds_attributes_map.items()
@@ -218,19 +307,145 @@ def get_seq_features(  # noqa: PLR0914
             qualifiers["codon_start"] = qualifiers.get("codon_start", 0) + 1
             qualifiers["translation"] = "".join(
                 [
-                    str(Seq(sequence_str[(range["begin"]) : (range["end"])]).translate())
+                    translate_sequence(sequence_str[(range["begin"]) : (range["end"])])
                     for range in ranges
                 ]
             )
-            feature = SeqFeature(
-                location=compound_location,
-                type="CDS",
-                qualifiers=qualifiers,
-            )
-            feature_list.append(feature)
+            location = cds_location(ranges, strands, sequence_length)
+            feature_list.append(EmblFeature("CDS", location, qualifiers))
     return feature_list
 
 
+def split_header_text(text: str) -> list[str]:
+    """Split text into lines of at most HEADER_TEXT_WIDTH characters at whitespace. Words that
+    are too long keep a line to themselves."""
+    text = text.strip()
+    if len(text) <= HEADER_TEXT_WIDTH:
+        return [text]
+    words = text.split()
+    index = 0
+    # The first line may stay empty if the first word is too long, like in Biopython
+    line = ""
+    while index < len(words) and len(line) + 1 + len(words[index]) <= HEADER_TEXT_WIDTH:
+        line = f"{line} {words[index]}".lstrip()
+        index += 1
+    lines = [line]
+    while index < len(words):
+        line = words[index]
+        index += 1
+        while index < len(words) and len(line) + 1 + len(words[index]) <= HEADER_TEXT_WIDTH:
+            line += " " + words[index]
+            index += 1
+        lines.append(line)
+    return lines
+
+
+def write_header_lines(buffer: io.StringIO, tag: str, text: str) -> None:
+    buffer.writelines(f"{tag}   {line}\n" for line in split_header_text(text))
+
+
+def wrap_location(location: str) -> str:
+    """Break locations that do not fit the feature table column after a comma"""
+    width = MAX_LINE_WIDTH - QUALIFIER_INDENT
+    parts = []
+    while len(location) > width:
+        index = location.rfind(",", 0, width)
+        if index == -1:
+            logger.warning(f"Could not split location: {location}")
+            break
+        parts.append(location[: index + 1])
+        location = location[index + 1 :]
+    parts.append(location)
+    return ("\n" + QUALIFIER_INDENT_STR).join(parts)
+
+
+def write_qualifier(buffer: io.StringIO, key: str, value: Any) -> None:
+    if value is None:
+        buffer.write(f"{QUALIFIER_INDENT_STR}/{key}\n")
+        return
+    if isinstance(value, str):
+        # NCBI says escape " as "" in qualifier values
+        value = value.replace('"', '""')
+    if isinstance(value, int) or key in UNQUOTED_QUALIFIERS:
+        line = f"{QUALIFIER_INDENT_STR}/{key}={value}"
+    else:
+        line = f'{QUALIFIER_INDENT_STR}/{key}="{value}"'
+    while len(line) > MAX_LINE_WIDTH:
+        # Break at the last space that keeps the line within the width, otherwise at the width
+        index = line.rfind(" ", QUALIFIER_INDENT + 2, MAX_LINE_WIDTH + 1)
+        if index == -1:
+            index = MAX_LINE_WIDTH
+        buffer.write(line[:index] + "\n")
+        line = QUALIFIER_INDENT_STR + line[index:].lstrip()
+    buffer.write(line + "\n")
+
+
+def write_feature(buffer: io.StringIO, feature: EmblFeature) -> None:
+    buffer.write(f"FT   {feature.type:<16}"[:QUALIFIER_INDENT])
+    buffer.write(wrap_location(feature.location) + "\n")
+    for key, values in feature.qualifiers.items():
+        if isinstance(values, list | tuple):
+            for value in values:
+                write_qualifier(buffer, key, value)
+        else:
+            write_qualifier(buffer, key, values)
+
+
+def write_sequence(buffer: io.StringIO, sequence: str, count_bases: bool) -> None:
+    data = sequence.lower()
+    length = len(data)
+    if count_bases:
+        counts = [data.count(base) for base in "acgt"]
+        buffer.write(
+            f"SQ   Sequence {length} BP; {counts[0]} A; {counts[1]} C; {counts[2]} G; "
+            f"{counts[3]} T; {length - sum(counts)} other;\n"
+        )
+    else:
+        buffer.write("SQ   \n")
+    full_lines_end = length - length % LETTERS_PER_LINE
+    for start in range(0, full_lines_end, LETTERS_PER_LINE):
+        line = data[start : start + LETTERS_PER_LINE]
+        buffer.write(
+            f"     {line[:10]} {line[10:20]} {line[20:30]} {line[30:40]} {line[40:50]} "
+            f"{line[50:]}{start + LETTERS_PER_LINE:>10}\n"
+        )
+    if full_lines_end < length:
+        blocks = "".join(
+            f" {data[start : start + LETTERS_PER_BLOCK]}".ljust(LETTERS_PER_BLOCK + 1)
+            for start in range(full_lines_end, full_lines_end + LETTERS_PER_LINE, LETTERS_PER_BLOCK)
+        )
+        buffer.write(f"    {blocks}{length:>10}\n")
+
+
+def write_embl_record(buffer: io.StringIO, record: EmblRecord) -> None:
+    """Serialize a record in the EMBL flat file format, as Biopython's
+    `SeqRecord.format("embl")` would"""
+    accession, _, version = record.id.rpartition(".")
+    if "." in record.id and version.isdigit():
+        version = f"SV {version}"
+    else:
+        accession, version = record.id, ""
+    if ";" in accession or " " in accession:
+        msg = f"Cannot have semi-colons or spaces in EMBL accession, '{accession}'"
+        raise ValueError(msg)
+    buffer.write(
+        f"ID   {accession}; {version}; {record.topology}; {record.molecule_type}; ; UNC; "
+        f"{len(record.sequence)} BP.\nXX\nAC   {accession};\nXX\n"
+    )
+    write_header_lines(buffer, "DE", record.description)
+    buffer.write("XX\n")
+    write_header_lines(buffer, "OS", record.organism)
+    buffer.write("OC   .\nXX\nRN   [1]\n")
+    if record.authors:
+        write_header_lines(buffer, "RA", record.authors + ";")
+    buffer.write("XX\n" + FEATURE_HEADER)
+    for feature in record.features:
+        write_feature(buffer, feature)
+    buffer.write("XX\n")
+    write_sequence(buffer, record.sequence, count_bases="DNA" in record.molecule_type)
+    buffer.write("//\n")
+
+
 def create_flatfile(  # noqa: PLR0914
     config: Config, submission_data: SubmissionData
 ) -> str:
@@ -245,7 +460,6 @@ def create_flatfile(  # noqa: PLR0914
     country = get_country(metadata, config)
     organism = config.scientific_name
     molecule_type = config.molecule_type
-    topology = config.topology
 
     seqIO_moleculetype = {  # noqa: N806
         MoleculeType.GENOMIC_DNA: "DNA",
@@ -253,44 +467,37 @@ def create_flatfile(  # noqa: PLR0914
         MoleculeType.VIRAL_CRNA: "cRNA",
     }
 
-    embl_content = []
+    buffer = io.StringIO()
 
     for seq_name, sequence_str in unaligned_nuc_seq.items():
         if not sequence_str:
             continue
-        reference = Reference()
         segment = seq_name if config.multi_segment else None
-        description = get_description(accession, version, config.db_name, metadata, segment)
-        reference.authors = authors
-        sequence = SeqRecord(
-            Seq(sequence_str),
-            id=f"{accession}_{seq_name}" if config.multi_segment else accession,
-            annotations={
-                "molecule_type": seqIO_moleculetype.get(molecule_type, "DNA"),
-                "organism": organism,
-                "topology": topology,
-                "references": [reference],  # type: ignore[dict-item]
-            },
-            description=description,
-        )
-
-        source_feature = SeqFeature(
-            FeatureLocation(start=0, end=len(sequence_str)),
-            type="source",
-            qualifiers={
+        source_feature = EmblFeature(
+            "source",
+            span_location(0, len(sequence_str), len(sequence_str)),
+            {
                 "molecule_type": str(molecule_type),
                 "organism": organism,
                 "country": country,
                 "collection_date": collection_date,
             },
         )
-        sequence.features.append(source_feature)
+        features = [source_feature]
         if annotation_object and annotation_object.get(seq_name, None):
-            seq_feature_list = get_seq_features(annotation_object[seq_name], sequence_str)
-            for feature in seq_feature_list:
-                sequence.features.append(feature)
+            features.extend(get_seq_features(annotation_object[seq_name], sequence_str))
 
-        embl_content.append(sequence.format("embl"))
+        record = EmblRecord(
+            id=f"{accession}_{seq_name}" if config.multi_segment else accession,
+            molecule_type=seqIO_moleculetype.get(molecule_type, "DNA"),
+            topology=str(config.topology),
+            description=get_description(accession, version, config.db_name, metadata, segment),
+            organism=organism,
+            authors=authors,
+            sequence=sequence_str,
+            features=features,
+        )
+        # Multi-segment sequences have no empty lines between segments
+        write_embl_record(buffer, record)
 
-    # Multi-segment sequences have no empty lines between segments
-    return "".join(embl_content)
+    return buffer.getvalue()
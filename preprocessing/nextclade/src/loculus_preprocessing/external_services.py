@@ -1,6 +1,9 @@
 import logging
 import urllib.parse
 from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from http import HTTPStatus
 
 import requests
 from pydantic import BaseModel, Field, ValidationError
@@ -22,15 +25,56 @@ from loculus_preprocessing.datatypes import (
 logger = logging.getLogger(__name__)
 
 
-class RequestCache:
-    """Class for caching requests to external services during preprocessing.
+# Lookup kind and the scientific name or taxon ID looked up, e.g. ("scientific_name", "Homo")
+type TaxonKey = tuple[str, str]
 
-    Keys are the fully formatted URLs that have already been used to make sucessful requests.
-    Values are requests.Response as they were returned by the service.
+SCIENTIFIC_NAME = "scientific_name"
+TAX_ID = "tax_id"
+COMMON_NAME = "common_name"
+
+# Names and IDs per request to the batch endpoint, the limit of the taxonomy service
+TAXA_BATCH_SIZE = 1000
+
+
+class Taxon(BaseModel):
+    """A taxon as returned by the taxonomy service"""
+
+    tax_id: int | None = None
+    scientific_name: str | None = None
+    common_name: str | None = None
+    parent_id: int | None = None
+    depth: int | None = None
+
+
+class TaxaBatchResponse(BaseModel):
+    scientific_names: dict[str, list[Taxon]] = Field(default_factory=dict)
+    tax_ids: dict[int, Taxon] = Field(default_factory=dict)
+    common_names: dict[int, Taxon] = Field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class TaxonLookup:
+    """Parsed answer of the taxonomy service to one lookup: the taxa found, or the status code
+    and detail the lookup failed with"""
+
+    taxa: tuple[Taxon, ...] = ()
+    status_code: int = HTTPStatus.OK
+    detail: str = ""
+
+    @classmethod
+    def not_found(cls, detail: str) -> "TaxonLookup":
+        return cls(status_code=HTTPStatus.NOT_FOUND, detail=detail)
+
+
+class TaxonCache:
+    """Class for caching lookups in the taxonomy service during preprocessing.
+
+    Keys are the lookup kind and value, values the parsed lookup results. Taxa that were found
+    and lookups the service answered with 404 are cached, other failures are retried.
     """
 
     def __init__(self, max_size: int, retries=5) -> None:
-        self.cache: OrderedDict[str, requests.Response] = OrderedDict()
+        self.cache: OrderedDict[TaxonKey, TaxonLookup] = OrderedDict()
         self.max_size = max_size
         self.session = requests.Session()
         retry = Retry(total=retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
@@ -38,34 +82,43 @@ class RequestCache:
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
-    def get(self, url: str) -> requests.Response | None:
-        if url in self.cache:
-            self.cache.move_to_end(url)
-            return self.cache[url]
+    def get(self, key: TaxonKey) -> TaxonLookup | None:
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
         return None
 
-    def set(self, url: str, response: requests.Response) -> None:
-        self.cache[url] = response
-        self.cache.move_to_end(url)
+    def set(self, key: TaxonKey, lookup: TaxonLookup) -> None:
+        self.cache[key] = lookup
+        self.cache.move_to_end(key)
 
         if len(self.cache) > self.max_size:
             self.cache.popitem(last=False)
 
-    def get_or_fetch(self, url: str, timeout: int = 15) -> requests.Response:
+    def get_or_fetch(self, key: TaxonKey, url: str, timeout: int = 15) -> TaxonLookup:
         """
-        Check if `url` already exists in the cache and return the cached Response if it does.
-
-        If `url` is not in the cache, make the actual request (with timeout and retries).
-        Add the Response to the cache (if status code in the 200s), and return the Response.
+        Return the cached lookup of `key` if there is one, otherwise GET `url` (with timeout
+        and retries) and parse the response, caching it if the taxa were found or not found.
 
         The caller should wrap this in a try/except block and handle errors.
         """
-        response = self.get(url)
-        if response is None:
-            response = self.session.get(url, timeout=timeout)
-            if 200 <= response.status_code < 300:  # noqa: PLR2004
-                self.set(url, response)
-        return response
+        lookup = self.get(key)
+        if lookup is not None:
+            return lookup
+        response = self.session.get(url, timeout=timeout)
+        body = response.json()
+        if response.status_code != requests.codes.ok:
+            lookup = TaxonLookup(status_code=response.status_code, detail=body.get("detail", ""))
+        else:
+            taxa = body if isinstance(body, list) else [body]
+            lookup = TaxonLookup(taxa=tuple(Taxon.model_validate(taxon) for taxon in taxa))
+        if lookup.status_code in {HTTPStatus.OK, HTTPStatus.NOT_FOUND}:
+            self.set(key, lookup)
+        return lookup
+
+    def update(self, lookups: dict[TaxonKey, TaxonLookup]) -> None:
+        for key, lookup in lookups.items():
+            self.set(key, lookup)
 
     def clear(self) -> None:
         self.cache.clear()
@@ -83,81 +136,187 @@ def taxonomy_network_error(
     return raw_internal_error(f"Network error while {action} '{subject}': {e}.")
 
 
-taxonomy_cache = RequestCache(max_size=1024)
+# Large enough for the lookups of the distinct hosts of a batch, which are prefetched at once
+taxonomy_cache = TaxonCache(max_size=16384)
 
 
 class TaxonomyService:
     def __init__(self, taxonomy_service_url: str | None):
         self.taxonomy_service_url = taxonomy_service_url
 
+    @staticmethod
+    def host_key(unvalidated_host: str) -> TaxonKey:
+        if unvalidated_host.isdigit():
+            return (TAX_ID, unvalidated_host)
+        return (SCIENTIFIC_NAME, unvalidated_host)
+
+    def lookup_url(self, key: TaxonKey) -> str:
+        kind, value = key
+        if kind == SCIENTIFIC_NAME:
+            query = urllib.parse.urlencode({"scientific_name": value})
+            return f"{self.taxonomy_service_url}/taxa?{query}"
+        if kind == COMMON_NAME:
+            return f"{self.taxonomy_service_url}/taxa/{value}?find_common_name=true"
+        return f"{self.taxonomy_service_url}/taxa/{value}"
+
+    def lookup(self, key: TaxonKey) -> TaxonLookup:
+        return taxonomy_cache.get_or_fetch(key, self.lookup_url(key))
+
+    def prefetch(self, hosts: Iterable[str]) -> None:
+        """Resolve the scientific names and taxon IDs in `hosts`, and the common names of the
+        taxa they resolve to, with the batch endpoint, so that validating the hosts of a batch
+        hits the cache instead of sending a request per host and field.
+
+        Failures are only logged: lookups that were not prefetched are fetched one by one.
+        """
+        if not self.taxonomy_service_url:
+            return
+        names: list[str] = []
+        # Hosts per taxon ID, e.g. 7159 for both '7159' and '07159'
+        tax_ids: dict[int, list[str]] = {}
+        for host in dict.fromkeys(hosts):
+            key = self.host_key(host)
+            if taxonomy_cache.get(key) is not None:
+                continue
+            if key[0] == SCIENTIFIC_NAME:
+                names.append(host)
+            elif (tax_id := int_or_none(host)) is not None:
+                tax_ids.setdefault(tax_id, []).append(host)
+        id_list = list(tax_ids)
+        for start in range(0, max(len(names), len(id_list)), TAXA_BATCH_SIZE):
+            name_chunk = names[start : start + TAXA_BATCH_SIZE]
+            id_chunk = id_list[start : start + TAXA_BATCH_SIZE]
+            try:
+                response = taxonomy_cache.session.post(
+                    f"{self.taxonomy_service_url}/taxa/batch",
+                    json={
+                        "scientific_names": name_chunk,
+                        "tax_ids": id_chunk,
+                        "find_common_name": True,
+                    },
+                    timeout=60,
+                )
+                response.raise_for_status()
+                batch = TaxaBatchResponse.model_validate(response.json())
+            except (requests.exceptions.RequestException, ValidationError) as e:
+                logger.warning(f"Prefetching {len(name_chunk) + len(id_chunk)} taxa failed: {e}")
+                return
+            self.cache_batch(batch, name_chunk, {i: tax_ids[i] for i in id_chunk})
+
+    def cached_lookups(self, hosts: Iterable[str]) -> dict[TaxonKey, TaxonLookup]:
+        """The cached lookups validating `hosts` uses: those of the hosts themselves and the
+        ID and common name lookups of the taxa they resolve to"""
+        lookups: dict[TaxonKey, TaxonLookup] = {}
+        for host in hosts:
+            key = self.host_key(host)
+            lookup = taxonomy_cache.cache.get(key)
+            if lookup is None:
+                continue
+            lookups[key] = lookup
+            for taxon in lookup.taxa:
+                if taxon.tax_id is None:
+                    continue
+                for kind in (TAX_ID, COMMON_NAME):
+                    taxon_key = (kind, str(taxon.tax_id))
+                    if (taxon_lookup := taxonomy_cache.cache.get(taxon_key)) is not None:
+                        lookups[taxon_key] = taxon_lookup
+        return lookups
+
+    @staticmethod
+    def cache_batch(
+        batch: TaxaBatchResponse, names: list[str], tax_ids: dict[int, list[str]]
+    ) -> None:
+        """Cache the lookups a batch response answers, as they would have been answered by the
+        single lookup endpoints, including not found answers"""
+        resolved: list[Taxon] = []
+        for name in names:
+            taxa = batch.scientific_names.get(name)
+            if taxa is None:
+                taxonomy_cache.set(
+                    (SCIENTIFIC_NAME, name), TaxonLookup.not_found(f"'{name}' not found")
+                )
+                continue
+            taxonomy_cache.set((SCIENTIFIC_NAME, name), TaxonLookup(taxa=tuple(taxa)))
+            # Later fields look up the taxon a name resolves to by its ID
+            resolved.append(most_generic(taxa))
+        for tax_id, hosts in tax_ids.items():
+            taxon = batch.tax_ids.get(tax_id)
+            lookup = (
+                TaxonLookup(taxa=(taxon,))
+                if taxon is not None
+                else TaxonLookup.not_found(f"'{tax_id}' not found")
+            )
+            for host in hosts:
+                taxonomy_cache.set((TAX_ID, host), lookup)
+            if taxon is not None:
+                resolved.append(taxon)
+        for taxon in resolved:
+            if taxon.tax_id is None:
+                continue
+            tax_id_str = str(taxon.tax_id)
+            taxonomy_cache.set((TAX_ID, tax_id_str), TaxonLookup(taxa=(taxon,)))
+            with_common_name = batch.common_names.get(taxon.tax_id)
+            taxonomy_cache.set(
+                (COMMON_NAME, tax_id_str),
+                TaxonLookup(taxa=(with_common_name,))
+                if with_common_name is not None
+                else TaxonLookup.not_found(f"Unable to find common name for taxon {taxon.tax_id}"),
+            )
+
     def get_tax_id(self, unvalidated_host: str, error_if_failed: bool) -> RawProcessingResult:
         if not self.taxonomy_service_url:
             return missing_taxonomy_service_error()
 
-        if unvalidated_host.isdigit():
-            url = f"{self.taxonomy_service_url}/taxa/{unvalidated_host}"
-        else:
-            query = urllib.parse.urlencode({"scientific_name": unvalidated_host})
-            url = f"{self.taxonomy_service_url}/taxa?{query}"
         try:
-            response = taxonomy_cache.get_or_fetch(url)
-            body = response.json()
+            lookup = self.lookup(self.host_key(unvalidated_host))
         except requests.exceptions.RequestException as e:
             return taxonomy_network_error(
                 subject=f"taxon ID {unvalidated_host}",
                 action="fetching taxon info",
                 e=e,
             )
-        if response.status_code != requests.codes.ok:
+        if lookup.status_code != requests.codes.ok:
             message = f"Host validation for '{unvalidated_host}' failed."
-            details = f"with code {response.status_code}: {body.get('detail', '')}"
+            details = f"with code {lookup.status_code}: {lookup.detail}"
             logger.error(message + details)
             return RawProcessingResult(
                 datum=None,
                 warnings=[message] if not error_if_failed else [],
                 errors=[message] if error_if_failed else [],
             )
-        if isinstance(body, list):
-            # when querying by scientific name, multiple taxa may be returned
-            # - we select the most generic one
-            if not body:
-                message = (
-                    f"Host validation for '{unvalidated_host}' was successful "
-                    "but no taxa were returned."
-                )
-                return raw_internal_error(message)
-            taxon = min(body, key=lambda x: x.get("depth", float("inf")))
-        else:
-            taxon = body
+        if not lookup.taxa:
+            message = (
+                f"Host validation for '{unvalidated_host}' was successful "
+                "but no taxa were returned."
+            )
+            return raw_internal_error(message)
+        taxon = most_generic(lookup.taxa)
 
-        tax_id = taxon.get("tax_id")
-        if tax_id is None:
+        if taxon.tax_id is None:
             message = (
                 f"Host validation for '{unvalidated_host}' was successful "
                 "but response json 'tax_id' was missing."
             )
             return raw_internal_error(message)
         return RawProcessingResult(
-            datum=str(tax_id),
+            datum=str(taxon.tax_id),
         )
 
     def get_scientific_name(self, tax_id: str, error_if_failed: bool) -> RawProcessingResult:
         if not self.taxonomy_service_url:
             return missing_taxonomy_service_error()
 
-        url = f"{self.taxonomy_service_url}/taxa/{tax_id}"
         try:
-            response = taxonomy_cache.get_or_fetch(url)
-            body = response.json()
+            lookup = self.lookup((TAX_ID, tax_id))
         except requests.exceptions.RequestException as e:
             return taxonomy_network_error(
                 subject=f"taxon ID {tax_id}",
                 action="fetching taxon scientific name",
                 e=e,
             )
-        if response.status_code != requests.codes.ok:
+        if lookup.status_code != requests.codes.ok:
             message = f"Could not map '{tax_id}' to scientific name."
-            details = f"Code {response.status_code}: {body.get('detail', '')}"
+            details = f"Code {lookup.status_code}: {lookup.detail}"
             logger.error(message + details)
             return RawProcessingResult(
                 datum=None,
@@ -165,7 +324,7 @@ class TaxonomyService:
                 errors=[message] if error_if_failed else [],
             )
 
-        scientific_name = body.get("scientific_name")
+        scientific_name = lookup.taxa[0].scientific_name if lookup.taxa else None
         if scientific_name is None:
             message = f"'{tax_id}' is a valid taxon ID but response json had no 'scientific_name'."
             return raw_internal_error(message)
@@ -176,25 +335,23 @@ class TaxonomyService:
         if not self.taxonomy_service_url:
             return missing_taxonomy_service_error()
 
-        url = f"{self.taxonomy_service_url}/taxa/{tax_id}?find_common_name=true"
         try:
-            response = taxonomy_cache.get_or_fetch(url)
-            body = response.json()
+            lookup = self.lookup((COMMON_NAME, tax_id))
         except requests.exceptions.RequestException as e:
             return taxonomy_network_error(
                 subject=f"taxon ID {tax_id}",
                 action="fetching taxon common name",
                 e=e,
             )
-        if response.status_code != requests.codes.ok:
+        if lookup.status_code != requests.codes.ok:
             message = f"Could not map '{tax_id}' to common name."
-            details = f"Code {response.status_code}: {body.get('detail', '')}"
+            details = f"Code {lookup.status_code}: {lookup.detail}"
             logger.error(message + details)
             return RawProcessingResult(
                 warnings=[message],
             )
 
-        common_name = body.get("common_name")
+        common_name = lookup.taxa[0].common_name if lookup.taxa else None
         if common_name is None:
             message = f"Taxonomy service indicated common name was found for hostTaxonId '{tax_id}', but failed to return it."
             return raw_internal_error(message)
@@ -202,6 +359,19 @@ class TaxonomyService:
         return RawProcessingResult(datum=common_name)
 
 
+def most_generic(taxa: Iterable[Taxon]) -> Taxon:
+    """When querying by scientific name, multiple taxa may be returned - we select the most
+    generic one"""
+    return min(taxa, key=lambda x: x.depth if x.depth is not None else float("inf"))
+
+
+def int_or_none(value: str) -> int | None:
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
 FileName = str
 
 
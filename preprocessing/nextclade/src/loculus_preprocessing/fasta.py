@@ -0,0 +1,46 @@
+"""Minimal FASTA reading and writing without building Biopython SeqRecords"""
+
+import mmap
+import os
+from collections.abc import Iterator
+
+# Removed from sequence lines, same as Bio.SeqIO's FASTA parser
+_SEQUENCE_WHITESPACE = b"\r\n \t"
+
+
+def parse_fasta(data: bytes | mmap.mmap) -> Iterator[tuple[str, str]]:
+    """Yield (id, sequence) for each record, where id is the header up to the first whitespace.
+
+    Records are located with bytes.find, so each sequence is sliced out in one piece rather
+    than assembled line by line.
+    """
+    start = data.find(b">")
+    size = len(data)
+    while start != -1:
+        header_end = data.find(b"\n", start)
+        if header_end == -1:
+            header_end = size
+        next_record = data.find(b"\n>", header_end)
+        end = size if next_record == -1 else next_record
+        header = data[start + 1 : header_end].split(maxsplit=1)
+        seq_id = header[0].decode("utf-8") if header else ""
+        sequence = data[header_end:end].translate(None, _SEQUENCE_WHITESPACE).decode("utf-8")
+        yield seq_id, sequence
+        start = next_record if next_record == -1 else next_record + 1
+
+
+def read_fasta(path: str) -> Iterator[tuple[str, str]]:
+    """Memory-map the FASTA file at path and yield (id, sequence) for each record"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from parse_fasta(data)
+
+
+def write_fasta(sequences: dict[str, str], output_file: str) -> None:
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        for id, seq in sequences.items():
+            f.write(f">{id}\n")
+            f.write(f"{seq}\n")
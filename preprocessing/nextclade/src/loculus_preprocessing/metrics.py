@@ -0,0 +1,158 @@
+"""Wall time and item counts per preprocessing stage.
+
+Stages record into the module-level `metrics` registry. Totals can be scraped in Prometheus text
+format from an optional HTTP endpoint, and a structured summary of the stages recorded since the
+previous summary is logged periodically. Gauges hold the latest value of a setting that changes
+at runtime, such as the adaptive batch size.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "loculus_preprocessing_stage"
+
+# Stage name and sorted label pairs, e.g. ("nextclade_run", (("dataset", "L"),))
+type StageKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    items: int = 0
+    seconds: float = 0.0
+
+    def add(self, seconds: float, items: int) -> None:
+        self.calls += 1
+        self.items += items
+        self.seconds += seconds
+
+
+@dataclass
+class StageRecord:
+    """Handed out by `Metrics.stage` so the item count can be set once it is known"""
+
+    items: int = 0
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._totals: dict[StageKey, StageStats] = {}
+        self._window: dict[StageKey, StageStats] = {}
+        self._window_start = time.monotonic()
+        self._gauges: dict[str, float] = {}
+        self._server: ThreadingHTTPServer | None = None
+
+    def record(self, stage: str, seconds: float, items: int = 0, **labels: str) -> None:
+        key: StageKey = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            self._totals.setdefault(key, StageStats()).add(seconds, items)
+            self._window.setdefault(key, StageStats()).add(seconds, items)
+
+    @contextmanager
+    def stage(self, stage: str, items: int = 0, **labels: str) -> Generator[StageRecord]:
+        """Time the body of the with-statement, also if it raises"""
+        record = StageRecord(items=items)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.record(stage, time.perf_counter() - start, record.items, **labels)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def gauges(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._gauges)
+
+    def totals(self) -> dict[StageKey, StageStats]:
+        with self._lock:
+            return {key: StageStats(**vars(stats)) for key, stats in self._totals.items()}
+
+    def log_summary(self, min_interval_seconds: float = 0) -> None:
+        """Log the stages recorded since the last summary as one JSON line, at most once per
+        `min_interval_seconds`."""
+        with self._lock:
+            elapsed = time.monotonic() - self._window_start
+            if elapsed < min_interval_seconds or not self._window:
+                return
+            window, self._window = self._window, {}
+            self._window_start = time.monotonic()
+            gauges = dict(self._gauges)
+        stages = [
+            {
+                "stage": stage,
+                **dict(labels),
+                "calls": stats.calls,
+                "items": stats.items,
+                "seconds": round(stats.seconds, 3),
+                "items_per_second": round(stats.items / stats.seconds, 1)
+                if stats.seconds
+                else None,
+            }
+            for (stage, labels), stats in sorted(window.items())
+        ]
+        logger.info(
+            "Stage metrics: "
+            + json.dumps(
+                {"interval_seconds": round(elapsed, 1), "stages": stages, "gauges": gauges}
+            )
+        )
+
+    def render_prometheus(self) -> str:
+        lines: list[str] = []
+        totals = sorted(self.totals().items())
+        for field, help_text in (
+            ("seconds", "Wall time spent in the stage"),
+            ("items", "Items (sequences, entries or files) handled by the stage"),
+            ("calls", "Number of times the stage ran"),
+        ):
+            name = f"{METRIC_PREFIX}_{field}_total"
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} counter"))
+            for (stage, labels), stats in totals:
+                label_str = ",".join(
+                    f'{key}="{value}"' for key, value in (("stage", stage), *labels)
+                )
+                lines.append(f"{name}{{{label_str}}} {getattr(stats, field)}")
+        for gauge, value in sorted(self.gauges().items()):
+            name = f"loculus_preprocessing_{gauge}"
+            lines.extend((f"# TYPE {name} gauge", f"{name} {value}"))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> None:
+        """Expose the totals at http://0.0.0.0:<port>/metrics from a daemon thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:  # noqa: PLR6301
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer(("0.0.0.0", port), Handler)  # noqa: S104
+        threading.Thread(
+            target=self._server.serve_forever, name="prepro-metrics", daemon=True
+        ).start()
+        logger.info(f"Serving stage metrics on port {port} at /metrics")
+
+
+metrics = Metrics()
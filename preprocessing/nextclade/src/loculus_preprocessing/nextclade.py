@@ -1,23 +1,31 @@
 import csv
 import json
 import logging
+import math
 import os
 import re
 import subprocess  # noqa: S404
 import sys
 from collections import defaultdict
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from typing import Any, Final, Literal
 
-import pandas as pd
-from Bio import SeqIO
-
 from loculus_preprocessing.sequence_checks import error_on_excess_sequences
 
-from .config import Config, NextcladeSequenceAndDataset, SequenceName
+from .config import (
+    Config,
+    NestedPathProjection,
+    NextcladeSequenceAndDataset,
+    SequenceName,
+    project,
+)
+from .dataset_cache import DatasetCache
 from .datatypes import (
     AccessionVersion,
     Alert,
@@ -41,6 +49,9 @@ from .datatypes import (
     UnprocessedAfterNextclade,
     UnprocessedEntry,
 )
+from .fasta import read_fasta, write_fasta
+from .metrics import metrics
+from .nextclade_cache import CachedNextcladeResult
 
 # https://stackoverflow.com/questions/15063936
 csv.field_size_limit(sys.maxsize)
@@ -49,6 +60,10 @@ logger = logging.getLogger(__name__)
 
 DataSetIdentifier: Final = "dataset"
 SequenceIdentifier: Final = "seqName"
+# Suffix of the protein ids in the diamond database, see `run_diamond`
+DIAMOND_CDS_SUFFIX: Final = re.compile(r"\|CDS\d+$")
+# Nextclade writes sequences that failed to align as records with only these fields
+NEXTCLADE_ERROR_FIELDS: Final = frozenset({"index", SequenceIdentifier, "errors"})
 
 
 def sequence_annotation(
@@ -64,7 +79,7 @@ def sequence_annotation(
 def mask_terminal_gaps(
     sequence: GenericSequence, mask_char: Literal["N"] | Literal["X"] = "N"
 ) -> GenericSequence:
-    # https://chatgpt.com/share/b213c687-38c4-4c62-98a8-4fecb210d479
+    """Replace leading and trailing gaps ('-') with mask_char, internal gaps are kept"""
     if not sequence:
         return ""
 
@@ -72,25 +87,18 @@ def mask_terminal_gaps(
         error_message = "mask_char must be 'N' or 'X'"
         raise ValueError(error_message)
 
-    # Entire sequence of gaps
-    if not sequence.strip("-"):
+    # str.lstrip/rstrip scan in C, avoiding a Python-level loop over long genomes
+    leading_gaps = len(sequence) - len(sequence.lstrip("-"))
+    if leading_gaps == len(sequence):
         return mask_char * len(sequence)
+    trailing_gaps = len(sequence) - len(sequence.rstrip("-"))
+    if not leading_gaps and not trailing_gaps:
+        return sequence
 
-    # Find the index of the first non-'-' character
-    first_non_gap = 0
-    while first_non_gap < len(sequence) and sequence[first_non_gap] == "-":
-        first_non_gap += 1
-
-    # Find the index of the last non-'-' character
-    last_non_gap = len(sequence)
-    while last_non_gap > 0 and sequence[last_non_gap - 1] == "-":
-        last_non_gap -= 1
-
-    # Replace terminal gaps with 'N'
     return (
-        mask_char * first_non_gap
-        + sequence[first_non_gap:last_non_gap]
-        + mask_char * (len(sequence) - last_non_gap)
+        mask_char * leading_gaps
+        + sequence[leading_gaps : len(sequence) - trailing_gaps]
+        + mask_char * trailing_gaps
     )
 
 
@@ -98,6 +106,96 @@ def create_gene_name(gene: str, gene_suffix: str | None) -> str:
     return gene + "-" + gene_suffix if gene_suffix else gene
 
 
+def split_jobs(
+    sequence_counts: dict[SequenceName, int], total_jobs: int
+) -> dict[SequenceName, int]:
+    """
+    Split `total_jobs` nextclade threads across datasets proportional to the number of sequences
+    routed to each dataset. Every dataset gets at least one job, leftover jobs (after rounding
+    down) go to the datasets with the largest remainders.
+    """
+    if not sequence_counts:
+        return {}
+    total_sequences = sum(sequence_counts.values())
+    spare_jobs = total_jobs - len(sequence_counts)
+    if spare_jobs <= 0 or total_sequences == 0:
+        return dict.fromkeys(sequence_counts, 1)
+    shares = {name: spare_jobs * count / total_sequences for name, count in sequence_counts.items()}
+    jobs = {name: 1 + int(share) for name, share in shares.items()}
+    leftover = total_jobs - sum(jobs.values())
+    by_remainder = sorted(shares, key=lambda name: shares[name] - int(shares[name]), reverse=True)
+    for name in by_remainder[:leftover]:
+        jobs[name] += 1
+    return jobs
+
+
+@dataclass(frozen=True)
+class NextcladeRun:
+    """`nextclade run` of input_file against dataset `name` with all outputs in result_dir"""
+
+    name: SequenceName
+    input_file: str
+    result_dir: str
+    jobs: int
+    # Sequences in input_file, for stage metrics
+    items: int = 0
+
+    @property
+    def output_translations(self) -> str:
+        return f"{self.result_dir}/nextclade.cds_translation.{{cds}}.fasta"
+
+
+def nextclade_run_command(run: NextcladeRun, dataset_dir: str, config: Config) -> list[str]:
+    return [
+        "nextclade3",
+        "run",
+        "--retry-reverse-complement=true",
+        f"--output-all={run.result_dir}",
+        f"--input-dataset={dataset_dir}/{run.name}",
+        f"--output-translations={run.output_translations}",
+        f"--jobs={run.jobs}",
+        *config.get_dataset_by_name(run.name).nextclade_additional_args,
+        "--",
+        run.input_file,
+    ]
+
+
+def run_nextclade(runs: Sequence[NextcladeRun], dataset_dir: str, config: Config) -> None:
+    """Run one nextclade process per dataset concurrently, raise if any of them fails"""
+
+    def run_one(run: NextcladeRun) -> None:
+        with metrics.stage("nextclade_run", items=run.items, dataset=run.name):
+            command = nextclade_run_command(run, dataset_dir, config)
+            logger.debug(f"Running nextclade: {command}")
+            # TODO: Capture stderr and log at DEBUG level
+            exit_code = subprocess.run(command, check=False).returncode  # noqa: S603
+        if exit_code != 0:
+            msg = f"nextclade failed with exit code {exit_code}"
+            raise Exception(msg)
+
+    if not runs:
+        return
+    with ThreadPoolExecutor(max_workers=len(runs)) as executor:
+        futures = [executor.submit(run_one, run) for run in runs]
+        for future in futures:
+            future.result()
+
+
+def nextclade_input_id(accession_version: AccessionVersion, fasta_id: FastaId) -> str:
+    """Sequence name of an input sequence in nextclade runs over all sequences of a batch"""
+    return f"{accession_version}__{fasta_id}"
+
+
+def result_id(seq_name: str, seq_ids: dict[str, AccessionVersion] | None) -> str | None:
+    """
+    Accession version a nextclade result belongs to. Results of runs over nextclade_input_id
+    names are mapped through `seq_ids`, results missing from it are to be skipped (None).
+    """
+    if seq_ids is None:
+        return seq_name
+    return seq_ids.get(seq_name)
+
+
 def parse_nextclade_tsv(
     amino_acid_insertions: defaultdict[
         AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
@@ -107,6 +205,7 @@ def parse_nextclade_tsv(
     ],
     result_dir: str,
     sequence_and_dataset: NextcladeSequenceAndDataset,
+    seq_ids: dict[str, AccessionVersion] | None = None,
 ) -> tuple[
     defaultdict[AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]],
     defaultdict[AccessionVersion, defaultdict[SequenceName, list[NucleotideInsertion]]],
@@ -115,7 +214,9 @@ def parse_nextclade_tsv(
     with Path(result_dir + "/nextclade.tsv").open(encoding="utf-8") as nextclade_tsv:
         reader = csv.DictReader(nextclade_tsv, delimiter="\t")
         for row in reader:
-            id = row[SequenceIdentifier]
+            id = result_id(row[SequenceIdentifier], seq_ids)
+            if id is None:
+                continue
 
             if row["insertions"]:
                 nucleotide_insertions[id][name] = list(row["insertions"].split(","))
@@ -136,7 +237,41 @@ def parse_nextclade_tsv(
     return amino_acid_insertions, nucleotide_insertions
 
 
-def parse_nextclade_json(
+def nextclade_projection(config: Config) -> NestedPathProjection:
+    """
+    Subtrees of a nextclade result that preprocessing reads: the paths of all `nextclade.` inputs
+    of the processing spec (precomputed when loading the config) and `annotation` if EMBL files
+    are created.
+    """
+    if config.create_embl_file:
+        return {**config._nextclade_projection, "annotation": None}
+    return config._nextclade_projection
+
+
+def iter_nextclade_results(
+    nextclade_ndjson_path: Path, projection: NestedPathProjection | None = None
+) -> Iterator[dict[str, Any]]:
+    """
+    Yield the results in nextclade's NDJSON output one at a time, restricted to the sequence
+    identifier and the subtrees in `projection` if given. Records of sequences that failed to
+    align are skipped.
+    """
+    with nextclade_ndjson_path.open(encoding="utf-8") as nextclade_ndjson:
+        for line in nextclade_ndjson:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.keys() <= NEXTCLADE_ERROR_FIELDS:
+                continue
+            if projection is not None:
+                result = {
+                    SequenceIdentifier: result[SequenceIdentifier],
+                    **project(result, projection),
+                }
+            yield result
+
+
+def parse_nextclade_json(  # noqa: PLR0913, PLR0917
     result_dir,
     nextclade_metadata: defaultdict[
         AccessionVersion, defaultdict[SequenceName, dict[str, Any] | None]
@@ -145,28 +280,70 @@ def parse_nextclade_json(
     unaligned_nucleotide_sequences: dict[
         AccessionVersion, dict[SequenceName, NucleotideSequence | None]
     ],
+    projection: NestedPathProjection | None = None,
+    seq_ids: dict[str, AccessionVersion] | None = None,
 ) -> defaultdict[AccessionVersion, defaultdict[SequenceName, dict[str, Any] | None]]:
     """
     Update nextclade_metadata object with the results of the nextclade analysis.
     If the sequence existed in the input (unaligned_nucleotide_sequences) but did not align
     nextclade_metadata[name]=None.
+    Results are streamed from nextclade.ndjson so only one full result is held in memory at a
+    time, and only the parts of each result in `projection` (see `nextclade_projection`) are
+    retained.
     """
     for id, sequences in unaligned_nucleotide_sequences.items():
         if name in sequences and sequences[name] is not None:
             nextclade_metadata[id][name] = None
-    nextclade_json_path = Path(result_dir) / "nextclade.json"
-    json_data = json.loads(nextclade_json_path.read_text(encoding="utf-8"))
-    for result in json_data["results"]:
-        id = result[SequenceIdentifier]
-        nextclade_metadata[id][name] = result
+    for result in iter_nextclade_results(Path(result_dir) / "nextclade.ndjson", projection):
+        if (accession_version := result_id(result[SequenceIdentifier], seq_ids)) is None:
+            continue
+        result[SequenceIdentifier] = accession_version
+        nextclade_metadata[accession_version][name] = result
     return nextclade_metadata
 
 
+class BestHits:
+    """Highest scoring hit per sequence in the output of a classifier, reduced row by row
+    instead of loading the whole table.
+
+    Of hits with equal scores the first one added wins, as with the stable sort by descending
+    score followed by `groupby().first()` this replaces. Hits without a score are skipped, but
+    their sequence is recorded in `seen`.
+    """
+
+    def __init__(self) -> None:
+        # Dataset of the best hit per sequence id
+        self.datasets: dict[str, str] = {}
+        self.scores: dict[str, float] = {}
+        self.seen: set[str] = set()
+
+    def add(self, seq_id: str, dataset: str, score: str) -> None:
+        self.seen.add(seq_id)
+        value = float(score) if score else math.nan
+        if math.isnan(value):
+            return
+        if seq_id not in self.scores or value > self.scores[seq_id]:
+            self.scores[seq_id] = value
+            self.datasets[seq_id] = dataset
+
+    def add_tsv(self, path: str, score_column: str, dataset: str | None = None) -> "BestHits":
+        """Add the hits of a TSV with a header, taking the dataset from the `dataset` column
+        unless it is given"""
+        with Path(path).open(encoding="utf-8", newline="") as tsv:
+            for row in csv.DictReader(tsv, delimiter="\t"):
+                self.add(
+                    row[SequenceIdentifier],
+                    dataset if dataset is not None else row[DataSetIdentifier],
+                    row[score_column],
+                )
+        return self
+
+
 def run_sort(
     result_file: str,
     input_file: str,
     dataset_dir: str,
-) -> pd.DataFrame:
+) -> BestHits:
     """
     Run nextclade
     - use config.minimizer_url or default minimizer from nextclade server
@@ -198,23 +375,14 @@ def run_sort(
     if exit_code != 0:
         msg = f"nextclade sort failed with exit code {exit_code}"
         raise Exception(msg)
-    return pd.read_csv(
-        result_file,
-        sep="\t",
-        dtype={
-            "index": "Int64",
-            "score": "float64",
-            SequenceIdentifier: "string",
-            DataSetIdentifier: "string",
-        },
-    )
+    return BestHits().add_tsv(result_file, "score")
 
 
 def run_diamond(
     result_file: str,
     input_file: str,
     dataset_dir: str,
-) -> pd.DataFrame:
+) -> BestHits:
     """
     Run diamond blastx
     - use diamond.dmnd defined in config.diamond_dmnd_url
@@ -260,31 +428,14 @@ def run_diamond(
     if exit_code != 0:
         msg = f"diamond blastx failed with exit code {exit_code}"
         raise Exception(msg)
-    df = pd.read_csv(
-        result_file,
-        header=None,
-        names=[
-            SequenceIdentifier,
-            DataSetIdentifier,
-            "pident",
-            "length",
-            "mismatch",
-            "gapopen",
-            "qstart",
-            "qend",
-            "sstart",
-            "send",
-            "evalue",
-            "bitscore",
-        ],
-        sep="\t",
-    )
-    df[DataSetIdentifier] = df[DataSetIdentifier].str.replace(
-        r"\|CDS\d+$",
-        "",
-        regex=True,
-    )
-    return df
+    best_hits = BestHits()
+    with Path(result_file).open(encoding="utf-8", newline="") as tsv:
+        # Columns as in --outfmt above: qseqid, sseqid, pident, ...
+        for row in csv.reader(tsv, delimiter="\t"):
+            if not row:
+                continue
+            best_hits.add(row[0], DIAMOND_CDS_SUFFIX.sub("", row[1]), row[2])
+    return best_hits
 
 
 def accepted__dataset_matches_or_default(
@@ -314,17 +465,13 @@ def check_nextclade_sort_matches(  # noqa: PLR0913, PLR0917
     - assert highest score is in sequence_and_dataset.accepted_dataset_matches
     (default is nextclade_dataset_name)
     """
-    df = run_sort(
+    best_hits = run_sort(
         result_file_dir + "/sort_output.tsv",
         input_file,
         dataset_dir,
     )
 
-    hits = df.dropna(subset=["score"]).sort_values("score", ascending=False)
-    best_hits = hits.groupby(SequenceIdentifier, as_index=False).first()
-    missing_ids = set(df[SequenceIdentifier].unique()) - set(best_hits[SequenceIdentifier].unique())
-
-    for seq in missing_ids:
+    for seq in best_hits.seen - best_hits.datasets.keys():
         alerts[seq].warnings.append(
             sequence_annotation(
                 "Sequence does not appear to match reference, per `nextclade sort`. "
@@ -332,12 +479,12 @@ def check_nextclade_sort_matches(  # noqa: PLR0913, PLR0917
             )
         )
 
-    for _, row in best_hits.iterrows():
+    for seq, best_dataset_id in best_hits.datasets.items():
         # If best match is not the same as the dataset we are submitting to, add an error
-        if row[DataSetIdentifier] not in accepted_dataset_matches:
-            alerts[row[SequenceIdentifier]].errors.append(
+        if best_dataset_id not in accepted_dataset_matches:
+            alerts[seq].errors.append(
                 sequence_annotation(
-                    f"Sequence best matches {row[DataSetIdentifier]}, "
+                    f"Sequence best matches {best_dataset_id}, "
                     "a different organism than the one you are submitting to: "
                     f"{organism}. It is therefore not possible to release. "
                     "Contact the administrator if you think this message is an error."
@@ -359,7 +506,7 @@ def write_nextclade_input_fasta(
         for entry in unprocessed:
             accession_version = entry.accessionVersion
             for fasta_id, seq in entry.data.unalignedNucleotideSequences.items():
-                id = f"{accession_version}__{fasta_id}"
+                id = nextclade_input_id(accession_version, fasta_id)
                 id_map[accession_version, fasta_id] = id
                 f.write(f">{id}\n")
                 f.write(f"{seq}\n")
@@ -381,7 +528,7 @@ def is_valid_dataset_match(method, best_dataset_id, dataset):
 def assign_segment(
     entry: UnprocessedEntry,
     id_map: dict[tuple[AccessionVersion, FastaId], str],
-    best_hits: pd.DataFrame,
+    best_hits: dict[str, str],
     config: Config,
 ) -> SequenceAssignment:
     """
@@ -396,8 +543,8 @@ def assign_segment(
     sequence_assignment = SequenceAssignment()
 
     for fasta_id in entry.data.unalignedNucleotideSequences:
-        seq_id = id_map[entry.accessionVersion, fasta_id]
-        if seq_id not in best_hits[SequenceIdentifier].unique():
+        best_dataset_id = best_hits.get(id_map[entry.accessionVersion, fasta_id])
+        if best_dataset_id is None:
             method = config.segment_classification_method.display_name
             annotation = sequence_annotation(
                 f"Sequence with fasta id {fasta_id} does not match any reference for "
@@ -407,10 +554,7 @@ def assign_segment(
             sequence_assignment.alert.errors.append(annotation)
             continue
 
-        best_hit = best_hits[best_hits[SequenceIdentifier] == seq_id]
-
         not_found = True
-        best_dataset_id = best_hit[DataSetIdentifier].iloc[0]
         for dataset in config.nextclade_sequence_and_datasets:
             if is_valid_dataset_match(
                 config.segment_classification_method, best_dataset_id, dataset
@@ -449,54 +593,49 @@ def assign_segment(
 
 
 def assign_segment_with_nextclade_align(
-    unprocessed: Sequence[UnprocessedEntry], config: Config, dataset_dir: str
+    unprocessed: Sequence[UnprocessedEntry],
+    config: Config,
+    dataset_dir: str,
+    output_dir: str | None = None,
 ) -> SequenceAssignmentBatch:
     """
     Run nextclade align
     - assert sequence aligns to one of the references in config.nextclade_sequence_and_datasets
+    If output_dir is given, the full nextclade outputs are kept in output_dir/<dataset name> and
+    returned as batch.nextcladeResultDir, so that enrichment does not need to align again.
     """
     batch = SequenceAssignmentBatch()
 
-    all_dfs = []
-    with TemporaryDirectory(delete=not config.keep_tmp_dir) as result_dir:
+    best_hits = BestHits()
+    with (
+        nullcontext(output_dir)
+        if output_dir
+        else TemporaryDirectory(delete=not config.keep_tmp_dir) as result_dir
+    ):
         input_file = result_dir + "/input.fasta"
         id_map = write_nextclade_input_fasta(unprocessed, input_file)
 
-        for sequence_and_dataset in config.nextclade_sequence_and_datasets:
-            name = sequence_and_dataset.name
-            result_file_seg = f"{result_dir}/sort_output_{name}.tsv"
-
-            command = [
-                "nextclade3",
-                "run",
-                "--retry-reverse-complement=true",
-                f"--output-tsv={result_file_seg}",
-                f"--input-dataset={dataset_dir}/{name}",
-                "--jobs=1",
-                "--",
-                input_file,
-            ]
-            exit_code = subprocess.run(command, check=False).returncode  # noqa: S603
-            if exit_code != 0:
-                msg = f"nextclade failed with exit code {exit_code}"
-                raise Exception(msg)
-
-            logger.debug("Nextclade results available in %s", result_dir)
-            df = pd.read_csv(result_file_seg, sep="\t")
-            df[DataSetIdentifier] = name
-            all_dfs.append(df)
-
-    df_combined = pd.concat(all_dfs, ignore_index=True)
-    hits = df_combined.dropna(subset=["alignmentScore"]).sort_values(
-        by=[SequenceIdentifier, "alignmentScore"], ascending=[True, False]
-    )
-    best_hits = hits.groupby(SequenceIdentifier, as_index=False).first()
+        names = [ds.name for ds in config.nextclade_sequence_and_datasets]
+        jobs = split_jobs(dict.fromkeys(names, len(id_map)), config.nextclade_jobs)
+        run_nextclade(
+            [
+                NextcladeRun(name, input_file, f"{result_dir}/{name}", jobs[name], len(id_map))
+                for name in names
+            ],
+            dataset_dir,
+            config,
+        )
+        logger.debug("Nextclade results available in %s", result_dir)
+
+        # On equal scores the dataset listed first in the config wins
+        for name in names:
+            best_hits.add_tsv(f"{result_dir}/{name}/nextclade.tsv", "alignmentScore", name)
 
     for entry in unprocessed:
         sequence_assignment = assign_segment(
             entry,
             id_map,
-            best_hits,
+            best_hits.datasets,
             config,
         )
         accession_version = entry.accessionVersion
@@ -506,6 +645,7 @@ def assign_segment_with_nextclade_align(
         )
         batch.alerts[accession_version] = sequence_assignment.alert
 
+    batch.nextcladeResultDir = output_dir
     return batch
 
 
@@ -523,23 +663,17 @@ def assign_segment_with_nextclade_sort(
         input_file = result_dir + "/input.fasta"
         id_map = write_nextclade_input_fasta(unprocessed, input_file)
 
-        df = run_sort(
+        best_hits = run_sort(
             result_file=result_dir + "/sort_output.tsv",
             input_file=input_file,
             dataset_dir=dataset_dir,
         )
 
-    # Get best hits per sequence
-    hits = df.dropna(subset=["score"]).sort_values(
-        [SequenceIdentifier, "score"], ascending=[True, False]
-    )
-    best_hits = hits.groupby(SequenceIdentifier, as_index=False).first()
-
     for entry in unprocessed:
         sequence_assignment = assign_segment(
             entry,
             id_map,
-            best_hits,
+            best_hits.datasets,
             config,
         )
         accession_version = entry.accessionVersion
@@ -565,23 +699,17 @@ def assign_segment_with_diamond(
         input_file = result_dir + "/input.fasta"
         id_map = write_nextclade_input_fasta(unprocessed, input_file)
 
-        df = run_diamond(
+        best_hits = run_diamond(
             result_file=result_dir + "/diamond_output.tsv",
             input_file=input_file,
             dataset_dir=dataset_dir,
         )
 
-    # Get best hits per sequence
-    hits = df.dropna(subset=["pident"]).sort_values(
-        [SequenceIdentifier, "pident"], ascending=[True, False]
-    )
-    best_hits = hits.groupby(SequenceIdentifier, as_index=False).first()
-
     for entry in unprocessed:
         sequence_assignment = assign_segment(
             entry,
             id_map,
-            best_hits,
+            best_hits.datasets,
             config,
         )
         accession_version = entry.accessionVersion
@@ -700,17 +828,16 @@ def load_aligned_nuc_sequences(
     aligned_nucleotide_sequences: dict[
         AccessionVersion, dict[SequenceName, NucleotideSequence | None]
     ],
+    seq_ids: dict[str, AccessionVersion] | None = None,
 ) -> dict[AccessionVersion, dict[SequenceName, NucleotideSequence | None]]:
     """
     Load the nextclade alignment results into the aligned_nucleotide_sequences dict, mapping each
     accession to a sequenceName: NucleotideSequence dictionary.
     """
-    with open(result_dir_seg + "/nextclade.aligned.fasta", encoding="utf-8") as aligned_nucs:
-        aligned_nuc = SeqIO.parse(aligned_nucs, "fasta")
-        for aligned_sequence in aligned_nuc:
-            sequence_id: str = aligned_sequence.id
-            sequence: NucleotideSequence = str(aligned_sequence.seq)
-            aligned_nucleotide_sequences[sequence_id][name] = mask_terminal_gaps(sequence)
+    for seq_name, sequence in read_fasta(result_dir_seg + "/nextclade.aligned.fasta"):
+        if (sequence_id := result_id(seq_name, seq_ids)) is None:
+            continue
+        aligned_nucleotide_sequences[sequence_id][name] = mask_terminal_gaps(sequence)
     return aligned_nucleotide_sequences
 
 
@@ -718,6 +845,7 @@ def load_aligned_aa_sequences(
     result_dir_seg: str,
     sequence_and_dataset: NextcladeSequenceAndDataset,
     aligned_aminoacid_sequences: dict[AccessionVersion, dict[GeneName, AminoAcidSequence | None]],
+    seq_ids: dict[str, AccessionVersion] | None = None,
 ) -> dict[AccessionVersion, dict[GeneName, AminoAcidSequence | None]]:
     """
     Load the nextclade amino acid alignment results into the aligned_aminoacid_sequences dict, mapping each
@@ -725,14 +853,13 @@ def load_aligned_aa_sequences(
     """
     for gene in sequence_and_dataset.genes:
         translation_path = result_dir_seg + f"/nextclade.cds_translation.{gene}.fasta"
+        gene_name = create_gene_name(gene, sequence_and_dataset.gene_suffix)
         try:
-            with open(translation_path, encoding="utf-8") as aligned_translations:
-                aligned_translation = SeqIO.parse(aligned_translations, "fasta")
-                for aligned_sequence in aligned_translation:
-                    sequence_id = aligned_sequence.id
-                    masked_sequence = mask_terminal_gaps(str(aligned_sequence.seq), mask_char="X")
-                    gene_name = create_gene_name(gene, sequence_and_dataset.gene_suffix)
-                    aligned_aminoacid_sequences[sequence_id][gene_name] = masked_sequence
+            for seq_name, sequence in read_fasta(translation_path):
+                if (sequence_id := result_id(seq_name, seq_ids)) is None:
+                    continue
+                masked_sequence = mask_terminal_gaps(sequence, mask_char="X")
+                aligned_aminoacid_sequences[sequence_id][gene_name] = masked_sequence
         except FileNotFoundError:
             # This can happen if the sequence does not cover this gene
             logger.debug(
@@ -742,8 +869,15 @@ def load_aligned_aa_sequences(
 
 
 def assign_segment_for_alignment(
-    unprocessed: Sequence[UnprocessedEntry], config: Config, dataset_dir: str
+    unprocessed: Sequence[UnprocessedEntry],
+    config: Config,
+    dataset_dir: str,
+    output_dir: str | None = None,
 ) -> SequenceAssignmentBatch:
+    """
+    Assign the sequences of each entry to a dataset. output_dir is used for the nextclade outputs
+    of ALIGN classification, which are then reused by enrich_with_nextclade.
+    """
     errors = {}
     for entry in unprocessed:
         errors[entry.accessionVersion] = error_on_excess_sequences(
@@ -753,19 +887,21 @@ def assign_segment_for_alignment(
     if not config.multi_datasets:
         batch = assign_all_single_segments(unprocessed, config=config)
     else:
-        match config.segment_classification_method:
-            case SegmentClassificationMethod.DIAMOND:
-                batch = assign_segment_with_diamond(
-                    unprocessed, config=config, dataset_dir=dataset_dir
-                )
-            case SegmentClassificationMethod.MINIMIZER:
-                batch = assign_segment_with_nextclade_sort(
-                    unprocessed, config=config, dataset_dir=dataset_dir
-                )
-            case SegmentClassificationMethod.ALIGN:
-                batch = assign_segment_with_nextclade_align(
-                    unprocessed, config=config, dataset_dir=dataset_dir
-                )
+        method = config.segment_classification_method
+        with metrics.stage("segment_assignment", items=len(unprocessed), method=method.value):
+            match method:
+                case SegmentClassificationMethod.DIAMOND:
+                    batch = assign_segment_with_diamond(
+                        unprocessed, config=config, dataset_dir=dataset_dir
+                    )
+                case SegmentClassificationMethod.MINIMIZER:
+                    batch = assign_segment_with_nextclade_sort(
+                        unprocessed, config=config, dataset_dir=dataset_dir
+                    )
+                case SegmentClassificationMethod.ALIGN:
+                    batch = assign_segment_with_nextclade_align(
+                        unprocessed, config=config, dataset_dir=dataset_dir, output_dir=output_dir
+                    )
     batch.alerts = {
         id: Alert(
             errors=[*batch.alerts[id].errors, *error] if error else batch.alerts[id].errors,
@@ -776,7 +912,7 @@ def assign_segment_for_alignment(
     return batch
 
 
-def enrich_with_nextclade(  # noqa: PLR0914
+def enrich_with_nextclade(  # noqa: C901, PLR0912, PLR0914, PLR0915
     unprocessed: Sequence[UnprocessedEntry], dataset_dir: str, config: Config
 ) -> dict[AccessionVersion, UnprocessedAfterNextclade]:
     """
@@ -807,11 +943,6 @@ def enrich_with_nextclade(  # noqa: PLR0914
         AccessionVersion, dict[FileCategory, list[FileIdAndNameAndReadUrl]] | None
     ] = {entry.accessionVersion: entry.data.files for entry in unprocessed}
 
-    batch = assign_segment_for_alignment(unprocessed, config=config, dataset_dir=dataset_dir)
-    unaligned_nucleotide_sequences = batch.unalignedNucleotideSequences
-    segment_assignment_map = batch.sequenceNameToFastaId
-    alerts: Alerts = batch.alerts
-
     aligned_nucleotide_sequences: dict[
         AccessionVersion, dict[SegmentName, NucleotideSequence | None]
     ] = defaultdict(dict)
@@ -827,21 +958,38 @@ def enrich_with_nextclade(  # noqa: PLR0914
     amino_acid_insertions: defaultdict[
         AccessionVersion, defaultdict[GeneName, list[AminoAcidInsertion]]
     ] = defaultdict(lambda: defaultdict(list))
+    projection = nextclade_projection(config)
+    nextclade_cache = config._nextclade_cache
+    cache_keys: dict[SequenceName, dict[AccessionVersion, str]] = {}
+    cache_hits: dict[SequenceName, dict[AccessionVersion, CachedNextcladeResult]] = {}
     with TemporaryDirectory(delete=not config.keep_tmp_dir) as result_dir:
+        batch = assign_segment_for_alignment(
+            unprocessed,
+            config=config,
+            dataset_dir=dataset_dir,
+            output_dir=result_dir + "/classification",
+        )
+        unaligned_nucleotide_sequences = batch.unalignedNucleotideSequences
+        segment_assignment_map = batch.sequenceNameToFastaId
+        alerts: Alerts = batch.alerts
+
+        sequence_counts: dict[SequenceName, int] = {}
+        nextclade_inputs: dict[SequenceName, str] = {}
+        # Result directory per dataset, and for results of the classification run the mapping
+        # from its sequence names to accession versions of sequences assigned to the dataset
+        result_dirs: dict[SequenceName, tuple[str, dict[str, AccessionVersion] | None]] = {}
         for sequence_and_dataset in config.nextclade_sequence_and_datasets:
             name = sequence_and_dataset.name
             result_dir_seg = result_dir + "/" + name
-            input_file = result_dir_seg + "/input.fasta"
-            os.makedirs(os.path.dirname(input_file), exist_ok=True)
-            is_empty: bool = True
-            with open(input_file, "w", encoding="utf-8") as f:
-                for id, seg_dict in unaligned_nucleotide_sequences.items():
-                    if name in seg_dict and seg_dict[name] is not None:
-                        f.write(f">{id}\n")
-                        f.write(f"{seg_dict[name]}\n")
-                        is_empty = False
-            if is_empty:
+            sequences: dict[AccessionVersion, NucleotideSequence] = {
+                id: sequence
+                for id, seg_dict in unaligned_nucleotide_sequences.items()
+                if (sequence := seg_dict.get(name)) is not None
+            }
+            if not sequences:
                 continue
+            input_file = result_dir_seg + "/input.fasta"
+            write_fasta(sequences, input_file)
 
             if config.require_nextclade_sort_match:
                 alerts = check_nextclade_sort_matches(
@@ -855,45 +1003,123 @@ def enrich_with_nextclade(  # noqa: PLR0914
                     dataset_dir=dataset_dir,
                 )
 
-            command = [
-                "nextclade3",
-                "run",
-                "--retry-reverse-complement=true",
-                f"--output-all={result_dir_seg}",
-                f"--input-dataset={dataset_dir}/{name}",
-                f"--output-translations={result_dir_seg}/nextclade.cds_translation.{{cds}}.fasta",
-                "--jobs=1",
-                *sequence_and_dataset.nextclade_additional_args,
-                "--",
-                input_file,
-            ]
-            logger.debug(f"Running nextclade: {command}")
-
-            # TODO: Capture stderr and log at DEBUG level
-            exit_code = subprocess.run(command, check=False).returncode  # noqa: S603
-            if exit_code != 0:
-                msg = f"nextclade failed with exit code {exit_code}"
-                raise Exception(msg)
-
-            logger.debug("Nextclade results available in %s", result_dir)
+            if batch.nextcladeResultDir:
+                # Segment classification already aligned every sequence to every dataset
+                result_dirs[name] = (
+                    f"{batch.nextcladeResultDir}/{name}",
+                    {
+                        nextclade_input_id(id, segment_assignment_map[id][name]): id
+                        for id in sequences
+                    },
+                )
+                continue
 
-            # Add aligned sequences to aligned_nucleotide_sequences
-            # Modifies aligned_nucleotide_sequences in place
-            aligned_nucleotide_sequences = load_aligned_nuc_sequences(
-                result_dir_seg, name, aligned_nucleotide_sequences
-            )
-            aligned_aminoacid_sequences = load_aligned_aa_sequences(
-                result_dir_seg, sequence_and_dataset, aligned_aminoacid_sequences
-            )
-            nextclade_metadata = parse_nextclade_json(
-                result_dir_seg, nextclade_metadata, name, unaligned_nucleotide_sequences
-            )  # this includes the "annotation" field
-            amino_acid_insertions, nucleotide_insertions = parse_nextclade_tsv(
-                amino_acid_insertions,
-                nucleotide_insertions,
-                result_dir_seg,
-                sequence_and_dataset,
+            if nextclade_cache:
+                fingerprint = nextclade_cache.dataset_fingerprint(
+                    sequence_and_dataset.model_dump_json() + json.dumps(projection, sort_keys=True),
+                    f"{dataset_dir}/{name}",
+                )
+                cache_keys[name] = {
+                    id: nextclade_cache.key(sequence, fingerprint)
+                    for id, sequence in sequences.items()
+                }
+                cache_hits[name] = {
+                    id: cached
+                    for id, key in cache_keys[name].items()
+                    if (cached := nextclade_cache.get(key)) is not None
+                }
+                if cache_hits[name]:
+                    sequences = {
+                        id: sequence
+                        for id, sequence in sequences.items()
+                        if id not in cache_hits[name]
+                    }
+                    if not sequences:
+                        continue
+                    input_file = result_dir_seg + "/uncached.fasta"
+                    write_fasta(sequences, input_file)
+
+            sequence_counts[name] = len(sequences)
+            nextclade_inputs[name] = input_file
+
+        jobs = split_jobs(sequence_counts, config.nextclade_jobs)
+        runs: list[NextcladeRun] = []
+        for name, count in sequence_counts.items():
+            result_dir_seg = result_dir + "/" + name
+            runs.append(
+                NextcladeRun(name, nextclade_inputs[name], result_dir_seg, jobs[name], count)
             )
+            result_dirs[name] = (result_dir_seg, None)
+        run_nextclade(runs, dataset_dir, config)
+        logger.debug("Nextclade results available in %s", result_dir)
+
+        for name, (result_dir_seg, seq_ids) in result_dirs.items():
+            sequence_and_dataset = config.get_dataset_by_name(name)
+            items = len(seq_ids) if seq_ids is not None else sequence_counts[name]
+            with metrics.stage("nextclade_parse", items=items, dataset=name):
+                # Add aligned sequences to aligned_nucleotide_sequences
+                # Modifies aligned_nucleotide_sequences in place
+                aligned_nucleotide_sequences = load_aligned_nuc_sequences(
+                    result_dir_seg, name, aligned_nucleotide_sequences, seq_ids
+                )
+                aligned_aminoacid_sequences = load_aligned_aa_sequences(
+                    result_dir_seg, sequence_and_dataset, aligned_aminoacid_sequences, seq_ids
+                )
+                nextclade_metadata = parse_nextclade_json(
+                    result_dir_seg,
+                    nextclade_metadata,
+                    name,
+                    unaligned_nucleotide_sequences,
+                    projection,
+                    seq_ids,
+                )  # this includes the "annotation" field if EMBL files are created
+                amino_acid_insertions, nucleotide_insertions = parse_nextclade_tsv(
+                    amino_acid_insertions,
+                    nucleotide_insertions,
+                    result_dir_seg,
+                    sequence_and_dataset,
+                    seq_ids,
+                )
+
+    if nextclade_cache:
+        for name, keys in cache_keys.items():
+            gene_names = [
+                create_gene_name(gene, config.get_dataset_by_name(name).gene_suffix)
+                for gene in config.get_dataset_by_name(name).genes
+            ]
+            for id, key in keys.items():
+                if (cached := cache_hits[name].get(id)) is not None:
+                    nextclade_metadata[id][name] = (
+                        {**cached.nextclade_metadata, SequenceIdentifier: id}
+                        if cached.nextclade_metadata is not None
+                        else None
+                    )
+                    if cached.aligned_nucleotide_sequence is not None:
+                        aligned_nucleotide_sequences[id][name] = cached.aligned_nucleotide_sequence
+                    if cached.nucleotide_insertions:
+                        nucleotide_insertions[id][name] = cached.nucleotide_insertions
+                    aligned_aminoacid_sequences[id].update(cached.aligned_amino_acid_sequences)
+                    amino_acid_insertions[id].update(cached.amino_acid_insertions)
+                    continue
+                nextclade_cache.put(
+                    key,
+                    CachedNextcladeResult(
+                        nextclade_metadata=nextclade_metadata[id].get(name),
+                        aligned_nucleotide_sequence=aligned_nucleotide_sequences[id].get(name),
+                        nucleotide_insertions=nucleotide_insertions[id].get(name, []),
+                        aligned_amino_acid_sequences={
+                            gene: aligned_aminoacid_sequences[id][gene]
+                            for gene in gene_names
+                            if gene in aligned_aminoacid_sequences[id]
+                        },
+                        amino_acid_insertions={
+                            gene: amino_acid_insertions[id][gene]
+                            for gene in gene_names
+                            if gene in amino_acid_insertions[id]
+                        },
+                    ),
+                )
+        nextclade_cache.log_stats()
 
     return {
         id: UnprocessedAfterNextclade(
@@ -913,27 +1139,49 @@ def enrich_with_nextclade(  # noqa: PLR0914
     }
 
 
+def get_nextclade_dataset(
+    sequence_and_dataset: NextcladeSequenceAndDataset, server: str, output_dir: str | Path
+) -> None:
+    dataset_download_command = [
+        arg
+        for arg in [
+            "nextclade3",
+            "dataset",
+            "get",
+            f"--name={sequence_and_dataset.nextclade_dataset_name}",
+            f"--server={server}",
+            f"--output-dir={output_dir}",
+            f"--tag={sequence_and_dataset.nextclade_dataset_tag}"
+            if sequence_and_dataset.nextclade_dataset_tag
+            else "",
+        ]
+        if arg
+    ]
+    logger.info("Downloading Nextclade dataset: %s", dataset_download_command)
+    if subprocess.run(dataset_download_command, check=False).returncode != 0:  # noqa: S603
+        msg = "Dataset download failed"
+        raise RuntimeError(msg)
+    logger.info("Nextclade dataset downloaded successfully")
+
+
 def download_nextclade_dataset(dataset_dir: str, config: Config) -> None:
+    """Download the nextclade datasets to dataset_dir/<name>, reusing the copy in the dataset
+    cache (if configured) of datasets with a tag. Without a tag the latest version is
+    downloaded, which can change between restarts."""
+    dataset_cache: DatasetCache | None = config._dataset_cache  # type: ignore
     for sequence_and_dataset in config.nextclade_sequence_and_datasets:
-        dataset_download_command = [
-            arg
-            for arg in [
-                "nextclade3",
-                "dataset",
-                "get",
-                f"--name={sequence_and_dataset.nextclade_dataset_name}",
-                f"--server={
-                    sequence_and_dataset.nextclade_dataset_server or config.nextclade_dataset_server
-                }",
-                f"--output-dir={dataset_dir}/{sequence_and_dataset.name}",
-                f"--tag={sequence_and_dataset.nextclade_dataset_tag}"
-                if sequence_and_dataset.nextclade_dataset_tag
-                else "",
-            ]
-            if arg
-        ]
-        logger.info("Downloading Nextclade dataset: %s", dataset_download_command)
-        if subprocess.run(dataset_download_command, check=False).returncode != 0:  # noqa: S603
-            msg = "Dataset download failed"
-            raise RuntimeError(msg)
-        logger.info("Nextclade dataset downloaded successfully")
+        server = sequence_and_dataset.nextclade_dataset_server or config.nextclade_dataset_server
+        output_dir = f"{dataset_dir}/{sequence_and_dataset.name}"
+        if dataset_cache is None or not sequence_and_dataset.nextclade_dataset_tag:
+            get_nextclade_dataset(sequence_and_dataset, server, output_dir)
+            continue
+        key = (
+            "nextclade_dataset",
+            server,
+            sequence_and_dataset.nextclade_dataset_name,
+            sequence_and_dataset.nextclade_dataset_tag,
+        )
+        cached = dataset_cache.lookup(key) or dataset_cache.install(
+            key, partial(get_nextclade_dataset, sequence_and_dataset, server)
+        )
+        dataset_cache.link(cached.path, output_dir)
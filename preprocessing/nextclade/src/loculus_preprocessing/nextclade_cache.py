@@ -0,0 +1,201 @@
+"""Persistent, content-addressed cache of per-sequence nextclade results"""
+
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import subprocess  # noqa: S404
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+from .datatypes import (
+    AminoAcidInsertion,
+    AminoAcidSequence,
+    GeneName,
+    NucleotideInsertion,
+    NucleotideSequence,
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_SUFFIX = ".json.gz"
+# After exceeding the size limit, evict until the cache is below this fraction of the limit
+EVICTION_TARGET_FRACTION = 0.9
+# Re-stat the cache directory at least this often, to account for other replicas' writes
+INDEX_MAX_AGE_SECONDS = 60
+
+
+@dataclass
+class CachedNextcladeResult:
+    """Everything preprocessing extracts from a nextclade run for one sequence and dataset.
+    `nextclade_metadata` is None if the sequence did not align."""
+
+    nextclade_metadata: dict[str, Any] | None
+    aligned_nucleotide_sequence: NucleotideSequence | None = None
+    nucleotide_insertions: list[NucleotideInsertion] = field(default_factory=list)
+    aligned_amino_acid_sequences: dict[GeneName, AminoAcidSequence | None] = field(
+        default_factory=dict
+    )
+    amino_acid_insertions: dict[GeneName, list[AminoAcidInsertion]] = field(default_factory=dict)
+
+
+@cache
+def nextclade_version() -> str:
+    try:
+        result = subprocess.run(
+            ["nextclade3", "--version"],  # noqa: S607
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return result.stdout.strip()
+
+
+class NextcladeResultCache:
+    """On-disk cache mapping (sequence, dataset fingerprint) to a CachedNextcladeResult.
+
+    Entries are gzipped JSON files written atomically, so the directory can be shared between
+    replicas. Once the total size exceeds `max_size_bytes` the least recently used entries
+    (by mtime, which is bumped on every hit) are evicted. Each replica tracks the size of the
+    directory from a listing that is refreshed every INDEX_MAX_AGE_SECONDS and before evicting,
+    so with several replicas the limit can be exceeded by what the others wrote since then.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._sizes: dict[Path, int] | None = None
+        self._total_size = 0
+        self._indexed_at = 0.0
+
+    @staticmethod
+    def dataset_fingerprint(dataset_config: str, dataset_path: str) -> str:
+        """Identifies a dataset version: the dataset config (name, tag, genes, additional args),
+        the downloaded pathogen.json (which contains the resolved tag) and the nextclade version.
+        """
+        digest = hashlib.sha256(dataset_config.encode())
+        pathogen_json = Path(dataset_path) / "pathogen.json"
+        if pathogen_json.exists():
+            digest.update(pathogen_json.read_bytes())
+        digest.update(nextclade_version().encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(sequence: NucleotideSequence, fingerprint: str) -> str:
+        return hashlib.sha256(f"{fingerprint}:{sequence}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / (key + CACHE_FILE_SUFFIX)
+
+    def _index(self, refresh: bool = False) -> dict[Path, int]:
+        """Size of every entry, from a listing of the directory of at most
+        INDEX_MAX_AGE_SECONDS ago"""
+        if (
+            refresh
+            or self._sizes is None
+            or time.monotonic() - self._indexed_at > INDEX_MAX_AGE_SECONDS
+        ):
+            self._sizes = {}
+            for path in self.cache_dir.glob(f"*/*{CACHE_FILE_SUFFIX}"):
+                try:
+                    self._sizes[path] = path.stat().st_size
+                except FileNotFoundError:
+                    continue  # Evicted by another replica
+            self._total_size = sum(self._sizes.values())
+            self._indexed_at = time.monotonic()
+        return self._sizes
+
+    def get(self, key: str) -> CachedNextcladeResult | None:
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                result = CachedNextcladeResult(**json.load(f))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Discarding unreadable nextclade cache entry {path}: {e}")
+            with contextlib.suppress(OSError):
+                path.unlink(missing_ok=True)
+            self._total_size -= self._index().pop(path, 0)
+            self.misses += 1
+            return None
+        # Fails on a read-only cache or if another replica just evicted the entry, the result
+        # is still good
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        self.hits += 1
+        return result
+
+    @staticmethod
+    def _write(path: Path, result: CachedNextcladeResult) -> int:
+        """Atomically write `result` to `path`, return its size"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=path.parent, delete=False)  # noqa: SIM115
+        try:
+            with tmp, gzip.open(tmp, "wt", encoding="utf-8") as f:
+                json.dump(asdict(result), f)
+            os.replace(tmp.name, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                Path(tmp.name).unlink(missing_ok=True)
+            raise
+        # Fails if another replica evicted the entry right away
+        return path.stat().st_size
+
+    def put(self, key: str, result: CachedNextcladeResult) -> None:
+        """Add `result` to the cache. Failures, e.g. on a full or read-only cache volume, are
+        only logged, as nextclade already succeeded."""
+        path = self._path(key)
+        try:
+            size = self._write(path, result)
+        except OSError as e:
+            logger.warning(f"Cannot add nextclade cache entry {path}: {e}")
+            return
+        sizes = self._index()
+        self._total_size -= sizes.get(path, 0)
+        sizes[path] = size
+        self._total_size += size
+        if self._total_size > self.max_size_bytes:
+            try:
+                self.evict()
+            except OSError as e:
+                logger.warning(
+                    f"Cannot evict entries from nextclade cache at {self.cache_dir}: {e}"
+                )
+
+    def evict(self) -> None:
+        sizes = self._index(refresh=True)
+        target = self.max_size_bytes * EVICTION_TARGET_FRACTION
+        mtimes = {}
+        for path in list(sizes):
+            try:
+                mtimes[path] = path.stat().st_mtime
+            except FileNotFoundError:
+                self._total_size -= sizes.pop(path)
+        evicted = 0
+        for path in sorted(mtimes, key=mtimes.__getitem__):
+            if self._total_size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._total_size -= sizes.pop(path)
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from nextclade cache at {self.cache_dir}")
+
+    def log_stats(self) -> None:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        logger.info(
+            f"Nextclade cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate), {len(self._index())} entries"
+        )
@@ -1,9 +1,21 @@
+import atexit
 import logging
+import math
+import multiprocessing
+import queue
+import threading
 import time
 from collections import defaultdict
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
 from tempfile import TemporaryDirectory
-from typing import Any
+from typing import Any, Final
+
+import requests
 
 from .backend import (
     download_diamond_db,
@@ -12,7 +24,9 @@ from .backend import (
     request_upload,
     submit_processed_sequences,
     upload_embl_file_to_presigned_url,
+    upload_session,
 )
+from .batch_size import BatchSizeController
 from .config import (
     ASSIGNED_REFERENCE_PREFIX,
     FILES_PREFIX,
@@ -20,6 +34,7 @@ from .config import (
     PROCESSED_PREFIX,
     AlignmentRequirement,
     Config,
+    NestedPath,
     ProcessingSpec,
     SequenceName,
 )
@@ -31,6 +46,8 @@ from .datatypes import (
     AnnotationSourceType,
     FileCategory,
     FileIdAndNameAndReadUrl,
+    FileUploadInfo,
+    FunctionArgs,
     GeneName,
     InputData,
     InputMetadata,
@@ -51,6 +68,8 @@ from .datatypes import (
     UnprocessedEntry,
 )
 from .embl import create_flatfile
+from .external_services import TaxonKey, TaxonLookup, taxonomy_cache
+from .metrics import metrics
 from .nextclade import (
     assign_segment_using_header,
     download_nextclade_dataset,
@@ -58,6 +77,8 @@ from .nextclade import (
 )
 from .processing_functions import (
     ProcessingFunctions,
+    current_time,
+    now_snapshot,
     null_per_backend,
     process_frameshifts,
     process_labeled_mutations,
@@ -129,24 +150,6 @@ def get_dataset_name(
     return lapis_names[0]
 
 
-def truncate_after_wildcard(path: str, separator: str = ".") -> str:
-    parts = path.split(separator)
-    if "*" in parts:
-        return separator.join(parts[: parts.index("*")])
-    return path
-
-
-def get_nested_metadata(metadata: dict[str, Any], path: str, separator: str = ".") -> Any | None:
-    value: Any = metadata
-    for part in path.split(separator):
-        if not isinstance(value, dict):
-            return None
-        value = value.get(part)
-        if value is None:
-            return None
-    return value
-
-
 def add_nextclade_metadata(
     spec: ProcessingSpec,
     unprocessed: UnprocessedAfterNextclade,
@@ -182,10 +185,8 @@ def add_nextclade_metadata(
     ):
         return InputData(datum=None)
 
-    raw: Any | None = get_nested_metadata(
-        unprocessed.nextcladeMetadata[sequence_name],
-        truncate_after_wildcard(nextclade_path),
-    )
+    accessor = config._nextclade_paths.get(nextclade_path) or NestedPath(nextclade_path)
+    raw: Any | None = accessor(unprocessed.nextcladeMetadata[sequence_name])
 
     match nextclade_path:
         case "frameShifts":
@@ -230,50 +231,120 @@ def add_assigned_reference(
     return InputData(datum=reference)
 
 
-def add_input_metadata(
-    spec: ProcessingSpec,
-    unprocessed: UnprocessedAfterNextclade,
-    input_path: str,
-    config: Config,
-) -> InputData:
-    """Returns value of input_path in unprocessed metadata"""
+@dataclass(frozen=True)
+class PlannedInput:
+    arg_name: str
+    # Input path without the "processed." prefix
+    path: str
+    from_processed: bool
+    # Reads a metadata input from an entry after alignment
+    read: Callable[[UnprocessedAfterNextclade], InputData]
+
+
+@dataclass(frozen=True)
+class PlannedField:
+    """How one output field is computed, with everything that does not depend on the entry
+    resolved when the plan is compiled"""
+
+    output_field: str
+    spec: ProcessingSpec
+    inputs: tuple[PlannedInput, ...]
+    input_fields: list[str]
+    static_args: FunctionArgs
+    # None if the configured function does not exist, so that the error surfaces per entry
+    function: Callable[..., Any] | None
+    # Segment whose length a `length_<segment>` field holds
+    length_of: str | None = None
+
+
+@dataclass(frozen=True)
+class ProcessingPlan:
+    # The config values compiled into this plan, it is recompiled when they are replaced
+    processing_order: tuple[str, ...]
+    processing_spec: dict[str, ProcessingSpec]
+    fields: tuple[PlannedField, ...]
+
+
+def input_reader(
+    spec: ProcessingSpec, input_path: str, config: Config
+) -> Callable[[UnprocessedAfterNextclade], InputData]:
+    """Accessor for an input of an entry after alignment: the assigned reference, a nextclade
+    result path or an input metadata field"""
     if input_path.startswith(ASSIGNED_REFERENCE_PREFIX):
-        return add_assigned_reference(spec, unprocessed, config=config)
-    # If field starts with "nextclade.", take from nextclade metadata
+        return partial(add_assigned_reference, spec, config=config)
     if input_path.startswith(NEXTCLADE_PREFIX):
         nextclade_path = input_path[len(NEXTCLADE_PREFIX) :]
-        return add_nextclade_metadata(spec, unprocessed, nextclade_path, config=config)
-    if input_path not in unprocessed.inputMetadata:
-        return InputData(datum=None)
-    return InputData(datum=unprocessed.inputMetadata[input_path])
+        return partial(add_nextclade_metadata, spec, nextclade_path=nextclade_path, config=config)
+    return lambda unprocessed: InputData(datum=unprocessed.inputMetadata.get(input_path))
+
+
+def compile_processing_plan(config: Config) -> ProcessingPlan:
+    fields = []
+    for output_field in config.processing_order:
+        spec = config.processing_spec[output_field]
+        inputs = []
+        for arg_name, input_path in spec.inputs.items():
+            from_processed = input_path.startswith(PROCESSED_PREFIX)
+            path = input_path.removeprefix(PROCESSED_PREFIX)
+            inputs.append(
+                PlannedInput(arg_name, path, from_processed, input_reader(spec, path, config))
+            )
+        fields.append(
+            PlannedField(
+                output_field=output_field,
+                spec=spec,
+                inputs=tuple(inputs),
+                input_fields=[planned.path for planned in inputs],
+                static_args=dict(spec.args) if spec.args else {},
+                function=getattr(ProcessingFunctions, spec.function, None),
+                length_of=output_field.removeprefix("length_")
+                if output_field.startswith("length_")
+                else None,
+            )
+        )
+    return ProcessingPlan(config.processing_order, config.processing_spec, tuple(fields))
+
+
+def get_processing_plan(config: Config) -> ProcessingPlan:
+    """The compiled processing spec of `config`, compiled on first use"""
+    plan: ProcessingPlan | None = config._processing_plan
+    if (
+        plan is None
+        or plan.processing_order is not config.processing_order
+        or plan.processing_spec is not config.processing_spec
+    ):
+        plan = compile_processing_plan(config)
+        config._processing_plan = plan
+    return plan
 
 
 def _call_processing_function(  # noqa: PLR0913, PLR0917
     accession_version: AccessionVersion,
-    spec: ProcessingSpec,
-    output_field: str,
+    planned: PlannedField,
     group_id: int | None,
     submitted_at: str | None,
     input_data: InputMetadata,
-    input_fields: list[str],
     config: Config,
 ) -> ProcessingResult:
-    args = dict(spec.args) if spec.args else {}
+    args = dict(planned.static_args)
     args["is_insdc_ingest_group"] = config.insdc_ingest_group_id == group_id
     args["submittedAt"] = submitted_at
     args["ACCESSION_VERSION"] = accession_version
     args["taxonomy_service"] = config._taxonomy_service  # type: ignore
+    function_name = planned.spec.function
 
     try:
-        processing_result = ProcessingFunctions.call_function(
-            spec.function,
+        function = planned.function or ProcessingFunctions.get_function(function_name)
+        processing_result = ProcessingFunctions.call_resolved_function(
+            function_name,
+            function,
             args,
             input_data,
-            output_field,
-            input_fields,
+            planned.output_field,
+            planned.input_fields,
         )
     except Exception as e:
-        msg = f"Processing for spec: {spec} with input data: {input_data} failed with {e}"
+        msg = f"Processing for spec: {planned.spec} with input data: {input_data} failed with {e}"
         raise RuntimeError(msg) from e
 
     return processing_result
@@ -334,10 +405,21 @@ def get_output_metadata(  # noqa: C901, PLR0912, PLR0914, PLR0915
     warnings: list[ProcessingAnnotation] = []
     output_metadata: ProcessedMetadata = {}
 
-    for output_field in config.processing_order:
-        spec = config.processing_spec[output_field]
-        input_data: InputMetadata = {}
-        input_fields: list[str] = []
+    after_nextclade = isinstance(unprocessed, UnprocessedAfterNextclade)
+    if isinstance(unprocessed, UnprocessedAfterNextclade):
+        group_id = (
+            int(unprocessed.inputMetadata["group_id"])
+            if unprocessed.inputMetadata["group_id"]
+            else None
+        )
+        submitted_at = unprocessed.inputMetadata["submittedAt"]
+    else:
+        group_id = unprocessed.group_id
+        submitted_at = unprocessed.submittedAt
+
+    for planned in get_processing_plan(config).fields:
+        output_field = planned.output_field
+        spec = planned.spec
         if output_field == "length":
             try:
                 segment = spec.args.get("segment", "main") if spec.args else "main"
@@ -360,59 +442,33 @@ def get_output_metadata(  # noqa: C901, PLR0912, PLR0914, PLR0915
             )
             continue
 
-        if output_field.startswith("length_"):
+        if planned.length_of is not None:
             sequence_name = get_dataset_name(
-                output_field[7:], unprocessed.unalignedNucleotideSequences, config
+                planned.length_of, unprocessed.unalignedNucleotideSequences, config
             )
             output_metadata[output_field] = get_sequence_length(
                 unprocessed.unalignedNucleotideSequences, sequence_name
             )
             continue
 
-        for arg_name, input_path in spec.inputs.items():
-            get_from_processed = False
-            if input_path.startswith(PROCESSED_PREFIX):
-                resolved_path = input_path.removeprefix(PROCESSED_PREFIX)
-                get_from_processed = True
-            else:
-                resolved_path = input_path
-
-            if isinstance(unprocessed, UnprocessedAfterNextclade):
-                if get_from_processed:
-                    input_data[arg_name] = output_metadata.get(resolved_path)  # type: ignore
-                else:
-                    input_metadata = add_input_metadata(
-                        spec, unprocessed, resolved_path, config=config
-                    )
-                    input_data[arg_name] = input_metadata.datum
-                    errors.extend(input_metadata.errors)
-                    warnings.extend(input_metadata.warnings)
-
-                input_fields.append(resolved_path)
-                group_id = (
-                    int(unprocessed.inputMetadata["group_id"])
-                    if unprocessed.inputMetadata["group_id"]
-                    else None
-                )
-                submitted_at = unprocessed.inputMetadata["submittedAt"]
+        input_data: InputMetadata = {}
+        for planned_input in planned.inputs:
+            if planned_input.from_processed:
+                input_data[planned_input.arg_name] = output_metadata.get(planned_input.path)  # type: ignore
+            elif after_nextclade:
+                input_metadata = planned_input.read(unprocessed)  # type: ignore[arg-type]
+                input_data[planned_input.arg_name] = input_metadata.datum
+                errors.extend(input_metadata.errors)
+                warnings.extend(input_metadata.warnings)
             else:
-                input_data[arg_name] = (  # type: ignore
-                    output_metadata.get(resolved_path)  # type: ignore
-                    if get_from_processed
-                    else unprocessed.metadata.get(resolved_path)
-                )
-                input_fields.append(resolved_path)
-                group_id = unprocessed.group_id
-                submitted_at = unprocessed.submittedAt
+                input_data[planned_input.arg_name] = unprocessed.metadata.get(planned_input.path)  # type: ignore
 
         processing_result = _call_processing_function(
             accession_version=accession_version,
-            spec=spec,
-            output_field=output_field,
+            planned=planned,
             group_id=group_id,
             submitted_at=submitted_at,
             input_data=input_data,
-            input_fields=input_fields,
             config=config,
         )
 
@@ -430,7 +486,7 @@ def get_output_metadata(  # noqa: C901, PLR0912, PLR0914, PLR0915
         requirement_errors: list[str] = []
         if spec.required:
             requirement_errors.append(
-                build_missing_required_msg(output_field, input_fields, config)
+                build_missing_required_msg(output_field, planned.input_fields, config)
             )
 
         for condition in spec.required_when:
@@ -613,8 +669,9 @@ def process_single(
             aminoAcidInsertions=unprocessed.aminoAcidInsertions,
             sequenceNameToFastaId=unprocessed.sequenceNameToFastaId,
         ),
+        # Deduplicated in order, so that workers with another hash seed return the same result
         errors=list(
-            set(
+            dict.fromkeys(
                 unprocessed.errors
                 + iupac_errors
                 + max_seq_errors
@@ -623,7 +680,7 @@ def process_single(
                 + file_errors
             )
         ),
-        warnings=list(set(unprocessed.warnings + alignment_warnings + metadata_warnings)),
+        warnings=list(dict.fromkeys(unprocessed.warnings + alignment_warnings + metadata_warnings)),
     )
 
     return SubmissionData(
@@ -663,9 +720,11 @@ def process_single_unaligned(
         unprocessed=unprocessed,
         output_metadata=output_metadata,
         errors=list(
-            set(iupac_errors + metadata_errors + segment_assignment.alert.errors + file_errors)
+            dict.fromkeys(
+                iupac_errors + metadata_errors + segment_assignment.alert.errors + file_errors
+            )
         ),
-        warnings=list(set(metadata_warnings)),
+        warnings=list(dict.fromkeys(metadata_warnings)),
         sequenceNameToFastaId=segment_assignment.sequenceNameToFastaId,
     )
 
@@ -701,119 +760,526 @@ def processed_entry_with_errors(id) -> SubmissionData:
     )
 
 
+def process_entry(
+    accession_version: AccessionVersion,
+    unprocessed: UnprocessedAfterNextclade | UnprocessedData,
+    config: Config,
+) -> SubmissionData:
+    """Process a single entry, turning any exception into an entry with errors"""
+    try:
+        if isinstance(unprocessed, UnprocessedAfterNextclade):
+            return process_single(accession_version, unprocessed, config)
+        return process_single_unaligned(accession_version, unprocessed, config)
+    except Exception as e:
+        logger.error(f"Processing failed for {accession_version} with error: {e}")
+        return processed_entry_with_errors(accession_version)
+
+
+type EntryChunk = list[tuple[AccessionVersion, UnprocessedAfterNextclade | UnprocessedData]]
+
+# Config of a worker process, set once by the pool initializer instead of pickled per task
+_worker_config: Config | None = None
+
+
+def _init_processing_worker(config: Config) -> None:
+    global _worker_config  # noqa: PLW0603
+    _worker_config = config
+    logging.basicConfig(level=config.log_level)
+
+
+def _process_chunk(
+    chunk: EntryChunk, now: datetime, lookups: dict[TaxonKey, TaxonLookup]
+) -> tuple[list[SubmissionData], dict[TaxonKey, TaxonLookup]]:
+    """Process a chunk in a worker process, against the batch's `now` and with the taxonomy
+    lookups of its hosts the main process has cached. Also returns the lookups fetched while
+    doing so, so that the main process can add them to its cache for later batches."""
+    if _worker_config is None:
+        msg = "Processing worker was not initialized"
+        raise RuntimeError(msg)
+    taxonomy_cache.update(lookups)
+    known_keys = set(taxonomy_cache.cache)
+    with now_snapshot(now):
+        results = [process_entry(id, unprocessed, _worker_config) for id, unprocessed in chunk]
+    fetched = {key: lookup for key, lookup in taxonomy_cache.cache.items() if key not in known_keys}
+    return results, fetched
+
+
+# Pool of process_entries_in_pool, kept across batches, and the config it was started with
+_processing_pool: ProcessPoolExecutor | None = None
+_processing_pool_config: Config | None = None
+
+
+def processing_pool(config: Config) -> ProcessPoolExecutor:
+    """The pool of `config.processing_workers` metadata processing workers, started once.
+
+    Workers are started by a forkserver instead of being forked from the main process, which
+    runs the fetch, submit and metrics threads by then: a child forked while another thread
+    holds a lock, e.g. of a logging handler or a connection pool, deadlocks on it.
+    """
+    global _processing_pool, _processing_pool_config  # noqa: PLW0603
+    if _processing_pool is not None and _processing_pool_config is not config:
+        close_processing_pool()
+    if _processing_pool is None:
+        context = multiprocessing.get_context("forkserver")
+        # Workers are forked from the forkserver with the processing code already imported
+        context.set_forkserver_preload([__name__])
+        _processing_pool = ProcessPoolExecutor(
+            max_workers=config.processing_workers,
+            mp_context=context,
+            initializer=_init_processing_worker,
+            initargs=(config,),
+        )
+        _processing_pool_config = config
+    return _processing_pool
+
+
+@atexit.register
+def close_processing_pool() -> None:
+    global _processing_pool, _processing_pool_config  # noqa: PLW0603
+    if _processing_pool is not None:
+        _processing_pool.shutdown(cancel_futures=True)
+    _processing_pool = None
+    _processing_pool_config = None
+
+
+def process_entries_in_pool(entries: EntryChunk, config: Config) -> list[SubmissionData]:
+    """Process entries in `config.processing_workers` worker processes, preserving order.
+
+    Each chunk is sent with the cached taxonomy lookups of its hosts, and the lookups workers
+    fetch are merged back into the main process's cache, so lookups are shared across batches
+    just like in serial mode. If a worker dies, the entries of its chunk get a processing error
+    and the pool is restarted for the next batch.
+    """
+    workers = min(config.processing_workers, len(entries))
+    # A few chunks per worker evens out slow entries without paying IPC overhead per entry
+    chunk_size = math.ceil(len(entries) / (workers * 4))
+    chunks = [entries[i : i + chunk_size] for i in range(0, len(entries), chunk_size)]
+    executor = processing_pool(config)
+    now = current_time()
+    futures = [
+        executor.submit(
+            _process_chunk,
+            chunk,
+            now,
+            config._taxonomy_service.cached_lookups(batch_hosts(chunk, config)),  # type: ignore
+        )
+        for chunk in chunks
+    ]
+    processed_results: list[SubmissionData] = []
+    broken = False
+    for chunk, future in zip(chunks, futures, strict=True):
+        try:
+            results, fetched = future.result()
+        except Exception as e:
+            logger.error(f"Processing worker failed for {len(chunk)} entries with error: {e}")
+            broken = broken or isinstance(e, BrokenProcessPool)
+            results = [processed_entry_with_errors(id) for id, _ in chunk]
+            fetched = {}
+        taxonomy_cache.update(fetched)
+        processed_results.extend(results)
+    if broken:
+        close_processing_pool()
+    return processed_results
+
+
+# Processing functions that look up an input in the taxonomy service, and the argument they
+# look up; the values of these inputs are resolved for the whole batch before processing
+TAXONOMY_LOOKUP_ARGS: Final = {
+    "resolve_host_taxon_id": "host",
+    "scientific_name_from_id": "hostTaxonId",
+    "common_name_from_id": "hostTaxonId",
+}
+
+
+def batch_hosts(entries: EntryChunk, config: Config) -> set[str]:
+    """The distinct hosts the entries look up in the taxonomy service"""
+    paths = {
+        planned_input.path
+        for planned in get_processing_plan(config).fields
+        if planned.spec.function in TAXONOMY_LOOKUP_ARGS
+        for planned_input in planned.inputs
+        if planned_input.arg_name == TAXONOMY_LOOKUP_ARGS[planned.spec.function]
+        and not planned_input.from_processed
+    }
+    if not paths or not config.taxonomy_service_url:
+        return set()
+    hosts: set[str] = set()
+    for _, unprocessed in entries:
+        metadata = (
+            unprocessed.inputMetadata
+            if isinstance(unprocessed, UnprocessedAfterNextclade)
+            else unprocessed.metadata
+        )
+        for path in paths:
+            host = metadata.get(path)
+            if host and isinstance(host, str):
+                hosts.add(host)
+    return hosts
+
+
+def prefetch_taxa(entries: EntryChunk, config: Config) -> None:
+    """Resolve the distinct hosts of a batch with one request to the taxonomy service, instead
+    of a request per host and field while the entries are processed"""
+    hosts = batch_hosts(entries, config)
+    if not hosts:
+        return
+    with metrics.stage("taxonomy_prefetch", items=len(hosts)):
+        config._taxonomy_service.prefetch(hosts)  # type: ignore
+
+
 def process_all(
     unprocessed: Sequence[UnprocessedEntry], dataset_dir: str, config: Config
 ) -> Sequence[SubmissionData]:
-    processed_results = []
     logger.debug(f"Processing {len(unprocessed)} unprocessed sequences")
+    entries: EntryChunk
     if config.alignment_requirement != AlignmentRequirement.NONE:
         nextclade_results = enrich_with_nextclade(unprocessed, dataset_dir, config)
-        for id, result in nextclade_results.items():
-            try:
-                processed_single = process_single(id, result, config)
-            except Exception as e:
-                logger.error(f"Processing failed for {id} with error: {e}")
-                processed_single = processed_entry_with_errors(id)
-            processed_results.append(processed_single)
+        entries = list(nextclade_results.items())
     else:
-        for entry in unprocessed:
-            try:
-                processed_single = process_single_unaligned(
-                    entry.accessionVersion, entry.data, config
-                )
-            except Exception as e:
-                logger.error(f"Processing failed for {entry.accessionVersion} with error: {e}")
-                processed_single = processed_entry_with_errors(entry.accessionVersion)
-            processed_results.append(processed_single)
+        entries = [(entry.accessionVersion, entry.data) for entry in unprocessed]
+
+    # Workers are sent the snapshot, so all entries of the batch share one "now"
+    prefetch_taxa(entries, config)
+    with metrics.stage("metadata_processing", items=len(entries)), now_snapshot():
+        if config.processing_workers > 1 and len(entries) > 1:
+            return process_entries_in_pool(entries, config)
+        return [process_entry(id, unprocessed, config) for id, unprocessed in entries]
+
+
+def embl_upload_error() -> ProcessingAnnotation:
+    return ProcessingAnnotation(
+        unprocessedFields=[
+            AnnotationSource(name="embl_upload", type=AnnotationSourceType.METADATA)
+        ],
+        processedFields=[AnnotationSource(name="embl_upload", type=AnnotationSourceType.METADATA)],
+        message="Failed to create or upload EMBL file. Please contact your administrator.",
+    )
 
-    return processed_results
+
+def create_entry_flatfile(submission_data: SubmissionData, config: Config) -> str | None:
+    """Create the EMBL file of one entry, adding an error annotation to it on failure"""
+    try:
+        with metrics.stage("embl_generation", items=1):
+            return create_flatfile(config, submission_data)
+    except Exception as e:
+        logger.error("Error creating EMBL file: %s", e)
+        submission_data.processed_entry.errors.append(embl_upload_error())
+        return None
+
+
+def upload_flatfile(
+    submission_data: SubmissionData,
+    file_content: str,
+    upload_info: FileUploadInfo,
+    session: requests.Session,
+) -> None:
+    """Upload the EMBL file of one entry to a presigned URL, adding the file to the entry's
+    annotations files on success and an error annotation on failure"""
+    accession = submission_data.processed_entry.accession
+    version = submission_data.processed_entry.version
+    try:
+        with metrics.stage("embl_upload", items=1):
+            upload_embl_file_to_presigned_url(
+                file_content, upload_info.url, upload_info.headers, session=session
+            )
+    except Exception as e:
+        logger.error("Error uploading EMBL file: %s", e)
+        submission_data.processed_entry.errors.append(embl_upload_error())
+        return
+    processed_files = submission_data.processed_entry.data.files or {}
+    processed_files.setdefault(FileCategory.ANNOTATIONS, []).append(
+        FileIdAndNameAndReadUrl(fileId=upload_info.fileId, name=f"{accession}.{version}.embl")
+    )
+    submission_data.processed_entry.data.files = processed_files
 
 
 def upload_flatfiles(processed: Sequence[SubmissionData], config: Config) -> None:
+    """Create and upload the EMBL files of a batch.
+
+    Files are created by `config.embl_upload_workers` threads first, so that upload URLs, and
+    with them file IDs, are only requested for entries whose file could be created. URLs are
+    requested once per group, and the files are then uploaded by the same threads sharing a
+    connection pool. Failures only affect the entries concerned.
+    """
+    by_group: dict[int, list[SubmissionData]] = defaultdict(list)
     for submission_data in processed:
-        accession = submission_data.processed_entry.accession
-        version = submission_data.processed_entry.version
-        try:
-            if submission_data.group_id is None:
-                msg = "Group ID is required for EMBL file upload"
-                raise ValueError(msg)
-            file_content = create_flatfile(config, submission_data)
-            file_name = f"{accession}.{version}.embl"
-            upload_info = request_upload(submission_data.group_id, 1, config)[0]
-            file_id = upload_info.fileId
-            upload_embl_file_to_presigned_url(file_content, upload_info.url, upload_info.headers)
-            processed_files = submission_data.processed_entry.data.files or {}
-            processed_files.setdefault(FileCategory.ANNOTATIONS, []).append(
-                FileIdAndNameAndReadUrl(fileId=file_id, name=file_name)
+        if submission_data.group_id is None:
+            logger.error("Error creating or uploading EMBL file: Group ID is required")
+            submission_data.processed_entry.errors.append(embl_upload_error())
+            continue
+        by_group[submission_data.group_id].append(submission_data)
+
+    workers = max(config.embl_upload_workers, 1)
+    session = upload_session(workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embl-upload") as executor:
+        creations = {
+            group_id: [
+                (submission_data, executor.submit(create_entry_flatfile, submission_data, config))
+                for submission_data in entries
+            ]
+            for group_id, entries in by_group.items()
+        }
+
+        futures: list[Future[None]] = []
+        for group_id, entries_and_creations in creations.items():
+            files = [
+                (submission_data, content)
+                for submission_data, creation in entries_and_creations
+                if (content := creation.result()) is not None
+            ]
+            if not files:
+                continue
+            try:
+                with metrics.stage("embl_request_upload", items=len(files)):
+                    upload_infos = request_upload(group_id, len(files), config)
+                if len(upload_infos) != len(files):
+                    msg = f"Requested {len(files)} upload URLs, got {len(upload_infos)}"
+                    raise RuntimeError(msg)
+            except Exception as e:
+                logger.error(f"Error requesting EMBL file uploads for group {group_id}: {e}")
+                for submission_data, _ in files:
+                    submission_data.processed_entry.errors.append(embl_upload_error())
+                continue
+            futures.extend(
+                executor.submit(upload_flatfile, submission_data, content, upload_info, session)
+                for (submission_data, content), upload_info in zip(files, upload_infos, strict=True)
             )
-            submission_data.processed_entry.data.files = processed_files
+        for future in futures:
+            future.result()
+
+
+def prepare_dataset_dir(dataset_dir: str, config: Config) -> None:
+    if config.alignment_requirement != AlignmentRequirement.NONE:
+        download_nextclade_dataset(dataset_dir, config)
+    if (
+        config.segment_classification_method == SegmentClassificationMethod.MINIMIZER
+        or config.require_nextclade_sort_match
+    ):
+        download_minimizer(config, dataset_dir + "/minimizer/minimizer.json")
+    if config.segment_classification_method == SegmentClassificationMethod.DIAMOND:
+        if not config.diamond_dmnd_url:
+            msg = "Diamond database URL must be provided for diamond segment classification"
+            raise ValueError(msg)
+        download_diamond_db(config, dataset_dir + "/diamond/diamond.dmnd")
+
+
+def submit_batch(processed: Sequence[SubmissionData], dataset_dir: str, config: Config) -> bool:
+    """Upload EMBL files (if configured) and submit a processed batch.
+    Returns False if the backend rejected the submission."""
+    if config.create_embl_file:
+        upload_flatfiles(processed, config)
+
+    try:
+        processed_entries = [submission_data.processed_entry for submission_data in processed]
+        submit_processed_sequences(processed_entries, dataset_dir, config)
+    except RuntimeError as e:
+        logger.exception("Submitting processed data failed. Traceback : %s", e)
+        return False
+    logger.info("Processed %s sequences", len(processed))
+    metrics.log_summary(config.metrics_log_interval_seconds)
+    return True
+
+
+def has_files(unprocessed: Sequence[UnprocessedEntry]) -> bool:
+    return any(entry.data.files for entry in unprocessed)
+
+
+class IdleBackoff:
+    """Exponentially growing wait between polls that found no unprocessed sequences. The
+    backend has no long-poll support, so this trades pickup latency after idle periods for
+    fewer requests while idle."""
+
+    def __init__(self, config: Config) -> None:
+        self.min_seconds = config.idle_poll_interval_seconds
+        self.max_seconds = max(config.max_idle_poll_interval_seconds, self.min_seconds)
+        self.seconds = self.min_seconds
+
+    def wait(self, stop: threading.Event | None = None) -> None:
+        """Sleep for the current interval, or until `stop` is set, then double the interval"""
+        logger.debug(f"No unprocessed sequences found. Sleeping for {self.seconds:g} seconds.")
+        if stop:
+            stop.wait(self.seconds)
+        else:
+            time.sleep(self.seconds)
+        self.seconds = min(self.seconds * 2, self.max_seconds)
+
+    def reset(self) -> None:
+        self.seconds = self.min_seconds
+
+
+def run_serial(dataset_dir: str, config: Config) -> None:
+    total_processed = 0
+    etag = None
+    last_force_refresh = time.time()
+    batch_sizes = BatchSizeController(config)
+    idle_backoff = IdleBackoff(config)
+    while True:
+        logger.debug("Fetching unprocessed sequences")
+        # Reset etag every hour just in case
+        if last_force_refresh + 3600 < time.time():
+            etag = None
+            last_force_refresh = time.time()
+        requested = batch_sizes.batch_size
+        fetched_at = time.perf_counter()
+        etag, unprocessed = fetch_unprocessed_sequences(etag, config, requested)
+        if not unprocessed:
+            idle_backoff.wait()
+            continue
+        idle_backoff.reset()
+        # Don't use etag if we just got data
+        # preprocessing only asks for 100 sequences to process at a time, so there might be more
+        etag = None
+        try:
+            processed = process_all(unprocessed, dataset_dir, config)
         except Exception as e:
-            logger.error("Error creating or uploading EMBL file: %s", e)
-            submission_data.processed_entry.errors.append(
-                ProcessingAnnotation(
-                    unprocessedFields=[
-                        AnnotationSource(name="embl_upload", type=AnnotationSourceType.METADATA)
-                    ],
-                    processedFields=[
-                        AnnotationSource(name="embl_upload", type=AnnotationSourceType.METADATA)
-                    ],
-                    message="Failed to create or upload EMBL file. "
-                    "Please contact your administrator.",
-                )
+            logger.exception(f"Processing failed. Traceback : {e}. Unprocessed data: {unprocessed}")
+            continue
+
+        if submit_batch(processed, dataset_dir, config):
+            total_processed += len(processed)
+            batch_sizes.observe(
+                requested,
+                len(unprocessed),
+                time.perf_counter() - fetched_at,
+                has_files(unprocessed),
             )
 
 
-def run(config: Config) -> None:  # noqa: C901
-    with TemporaryDirectory(delete=not config.keep_tmp_dir) as dataset_dir:
-        if config.alignment_requirement != AlignmentRequirement.NONE:
-            download_nextclade_dataset(dataset_dir, config)
-        if (
-            config.segment_classification_method == SegmentClassificationMethod.MINIMIZER
-            or config.require_nextclade_sort_match
-        ):
-            download_minimizer(config, dataset_dir + "/minimizer/minimizer.json")
-        if config.segment_classification_method == SegmentClassificationMethod.DIAMOND:
-            if not config.diamond_dmnd_url:
-                msg = "Diamond database URL must be provided for diamond segment classification"
-                raise ValueError(msg)
-            download_diamond_db(config, dataset_dir + "/diamond/diamond.dmnd")
-
-        total_processed = 0
-        etag = None
-        last_force_refresh = time.time()
-        while True:
-            logger.debug("Fetching unprocessed sequences")
-            # Reset etag every hour just in case
+_END_OF_STREAM: Final = object()
+
+
+@dataclass
+class FetchedBatch:
+    entries: Sequence[UnprocessedEntry]
+    requested: int
+    # perf_counter() when the batch was requested, the backend's in-processing clock starts then
+    fetched_at: float
+
+
+def _fetch_worker(
+    config: Config, batches: queue.Queue, stop: threading.Event, batch_sizes: BatchSizeController
+) -> None:
+    """Keep `batches` filled with unprocessed batches until `stop` is set.
+    Blocks while the queue is full; an exception is forwarded through the queue and ends the
+    worker."""
+    etag = None
+    last_force_refresh = time.time()
+    idle_backoff = IdleBackoff(config)
+    try:
+        while not stop.is_set():
             if last_force_refresh + 3600 < time.time():
                 etag = None
                 last_force_refresh = time.time()
-            etag, unprocessed = fetch_unprocessed_sequences(etag, config)
+            requested = batch_sizes.batch_size
+            fetched_at = time.perf_counter()
+            etag, unprocessed = fetch_unprocessed_sequences(etag, config, requested)
             if not unprocessed:
-                # sleep 1 sec and try again
-                logger.debug("No unprocessed sequences found. Sleeping for 1 second.")
-                time.sleep(1)
+                idle_backoff.wait(stop)
                 continue
-            # Don't use etag if we just got data
-            # preprocessing only asks for 100 sequences to process at a time, so there might be more
+            idle_backoff.reset()
             etag = None
+            fetched = FetchedBatch(unprocessed, requested, fetched_at)
+            while not stop.is_set():
+                try:
+                    batches.put(fetched, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    except Exception as e:
+        batches.put(e)
+
+
+def _submit_worker(
+    dataset_dir: str,
+    config: Config,
+    pending: queue.Queue,
+    failures: list[Exception],
+    batch_sizes: BatchSizeController,
+) -> None:
+    """Submit processed batches in the order they were queued until the end-of-stream marker."""
+    while True:
+        item = pending.get()
+        if item is _END_OF_STREAM:
+            return
+        fetched, processed = item
+        try:
+            submitted = submit_batch(processed, dataset_dir, config)
+        except Exception as e:
+            failures.append(e)
+            return
+        if submitted:
+            batch_sizes.observe(
+                fetched.requested,
+                len(fetched.entries),
+                time.perf_counter() - fetched.fetched_at,
+                has_files(fetched.entries),
+            )
+
+
+def run_pipelined(dataset_dir: str, config: Config) -> None:
+    """Run fetch, process and submit as a three stage pipeline.
+
+    Fetching runs ahead by up to `config.prefetch_batches` batches and submitting lags behind by
+    up to `config.submit_queue_size` batches, both bounded so a slow stage applies back-pressure
+    to the others. Errors are raised in pipeline order: batches processed before a fetch or submit
+    failure are still submitted before the error propagates.
+    """
+    stop = threading.Event()
+    batches: queue.Queue = queue.Queue(maxsize=max(config.prefetch_batches, 1))
+    pending: queue.Queue = queue.Queue(maxsize=max(config.submit_queue_size, 1))
+    submit_failures: list[Exception] = []
+    batch_sizes = BatchSizeController(config)
+    fetcher = threading.Thread(
+        target=_fetch_worker,
+        args=(config, batches, stop, batch_sizes),
+        name="prepro-fetch",
+        daemon=True,
+    )
+    submitter = threading.Thread(
+        target=_submit_worker,
+        args=(dataset_dir, config, pending, submit_failures, batch_sizes),
+        name="prepro-submit",
+        daemon=True,
+    )
+    fetcher.start()
+    submitter.start()
+    try:
+        while True:
+            if submit_failures:
+                raise submit_failures[0]
             try:
-                processed = process_all(unprocessed, dataset_dir, config)
+                fetched = batches.get(timeout=1)
+            except queue.Empty:
+                continue
+            if isinstance(fetched, Exception):
+                raise fetched
+            try:
+                processed = process_all(fetched.entries, dataset_dir, config)
             except Exception as e:
                 logger.exception(
-                    f"Processing failed. Traceback : {e}. Unprocessed data: {unprocessed}"
+                    f"Processing failed. Traceback : {e}. Unprocessed data: {fetched.entries}"
                 )
                 continue
-
-            if config.create_embl_file:
-                upload_flatfiles(processed, config)
-
-            try:
-                processed_entries = [
-                    submission_data.processed_entry for submission_data in processed
-                ]
-                submit_processed_sequences(processed_entries, dataset_dir, config)
-            except RuntimeError as e:
-                logger.exception("Submitting processed data failed. Traceback : %s", e)
-                continue
-            total_processed += len(processed)
-            logger.info("Processed %s sequences", len(processed))
+            while submitter.is_alive():
+                try:
+                    pending.put((fetched, processed), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    finally:
+        stop.set()
+        if submitter.is_alive():
+            pending.put(_END_OF_STREAM)
+            submitter.join()
+
+
+def run(config: Config) -> None:
+    with TemporaryDirectory(delete=not config.keep_tmp_dir) as dataset_dir:
+        prepare_dataset_dir(dataset_dir, config)
+        if config.metrics_port:
+            metrics.serve(config.metrics_port)
+
+        if config.pipelined:
+            run_pipelined(dataset_dir, config)
+        else:
+            run_serial(dataset_dir, config)
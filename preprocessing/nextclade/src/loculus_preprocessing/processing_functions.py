@@ -10,8 +10,11 @@ import logging
 import math
 import re
 import unicodedata
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 from typing import Any
 
 import dateutil.parser as dateutil
@@ -157,6 +160,80 @@ def regex_error(
     )
 
 
+# Distinct date strings whose parse is kept, submissions (especially INSDC ingest) repeat a few
+DATE_PARSE_CACHE_SIZE = 4096
+
+# Current time used by date checks while a batch is processed, see `now_snapshot`
+_now_snapshot: datetime | None = None
+
+
+def current_time() -> datetime:
+    return _now_snapshot or datetime.now(tz=pytz.utc)
+
+
+@contextmanager
+def now_snapshot(now: datetime | None = None) -> Generator[datetime]:
+    """Fix the current time of all date checks in the body, so that the entries of a batch are
+    checked against the same "now" and dateutil defaults stay valid for cached parses. Workers
+    pass the `now` of the batch they process part of."""
+    global _now_snapshot  # noqa: PLW0603
+    previous = _now_snapshot
+    _now_snapshot = now or datetime.now(tz=pytz.utc)
+    try:
+        yield _now_snapshot
+    finally:
+        _now_snapshot = previous
+
+
+def _strptime_first(date_str: str, formats: tuple[str, ...]) -> tuple[str, datetime] | str:
+    error = ""
+    for fmt in formats:
+        try:
+            return fmt, datetime.strptime(date_str, fmt)  # noqa: DTZ007
+        except ValueError as e:
+            error = str(e)
+    return error
+
+
+_cached_strptime_first = lru_cache(maxsize=DATE_PARSE_CACHE_SIZE)(_strptime_first)
+
+
+def parse_date(date_str: str, formats: tuple[str, ...]) -> tuple[str, datetime]:
+    """Parse `date_str` with the first of `formats` that matches, returning the format and the
+    naive datetime. Raises the ValueError of the last format if none matches."""
+    result = (
+        _cached_strptime_first(date_str, formats)
+        if isinstance(date_str, str)
+        else _strptime_first(date_str, formats)
+    )
+    if isinstance(result, str):
+        raise ValueError(result)
+    return result
+
+
+@lru_cache(maxsize=DATE_PARSE_CACHE_SIZE)
+def _cached_dateutil_parse(value: str, default: datetime) -> datetime | None:
+    try:
+        return dateutil.parse(value, default=default)
+    except Exception:
+        return None
+
+
+def parse_datetime(value: str) -> datetime | None:
+    """`dateutil.parse(value)`, or None if that raises. Fields missing from `value` are taken
+    from today, like dateutil does, with today fixed by `now_snapshot`."""
+    if not isinstance(value, str):
+        try:
+            return dateutil.parse(value)
+        except Exception:
+            return None
+    # dateutil's default: local midnight of today
+    today = (
+        current_time().astimezone().replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    )
+    return _cached_dateutil_parse(value, today)
+
+
 @dataclass
 class DateRange:
     date_range_lower: datetime
@@ -175,34 +252,34 @@ def convert_to_date_range(date_str: str) -> DateRange | None:
         "%Y": "Month and day are missing. Assuming date is some time in the year.",
     }
 
-    for fmt, msg in formats_to_messages.items():
-        try:
-            parsed_date = datetime.strptime(date_str, fmt).replace(tzinfo=pytz.utc)
-        except ValueError:
-            continue
-        match fmt:
-            case "%Y-%m-%d":
-                return DateRange(
-                    date_range_lower=parsed_date,
-                    date_range_upper=parsed_date,
-                )
-            case "%Y-%m":
-                return DateRange(
-                    date_range_lower=parsed_date.replace(day=1),
-                    date_range_upper=(
-                        parsed_date.replace(
-                            day=calendar.monthrange(parsed_date.year, parsed_date.month)[1]
-                        )
-                    ),
-                    message=msg,
-                )
-            case "%Y":
-                return DateRange(
-                    date_range_lower=parsed_date.replace(month=1, day=1),
-                    date_range_upper=parsed_date.replace(month=12, day=31),
-                    message=msg,
-                )
-        break
+    try:
+        fmt, parsed_date = parse_date(date_str, tuple(formats_to_messages))
+    except ValueError:
+        return None
+    parsed_date = parsed_date.replace(tzinfo=pytz.utc)
+    msg = formats_to_messages[fmt]
+    match fmt:
+        case "%Y-%m-%d":
+            return DateRange(
+                date_range_lower=parsed_date,
+                date_range_upper=parsed_date,
+            )
+        case "%Y-%m":
+            return DateRange(
+                date_range_lower=parsed_date.replace(day=1),
+                date_range_upper=(
+                    parsed_date.replace(
+                        day=calendar.monthrange(parsed_date.year, parsed_date.month)[1]
+                    )
+                ),
+                message=msg,
+            )
+        case "%Y":
+            return DateRange(
+                date_range_lower=parsed_date.replace(month=1, day=1),
+                date_range_upper=parsed_date.replace(month=12, day=31),
+                message=msg,
+            )
     return None
 
 
@@ -256,13 +333,35 @@ class ProcessingFunctions:
         output_field: str,
         input_fields: list[str],
     ) -> ProcessingResult:
+        return cls.call_resolved_function(
+            function_name,
+            cls.get_function(function_name),
+            args,
+            input_data,
+            output_field,
+            input_fields,
+        )
+
+    @classmethod
+    def get_function(cls, function_name: str) -> Callable[..., Any]:
         if not hasattr(cls, function_name):
             msg = (
                 f"CRITICAL: No processing function matches: {function_name}."
                 "This is a configuration error."
             )
             raise ValueError(msg)
-        func = getattr(cls, function_name)
+        return getattr(cls, function_name)
+
+    @staticmethod
+    def call_resolved_function(  # noqa: PLR0913, PLR0917
+        function_name: str,
+        func: Callable[..., Any],
+        args: FunctionArgs,
+        input_data: InputMetadata,
+        output_field: str,
+        input_fields: list[str],
+    ) -> ProcessingResult:
+        """Call a function returned by `get_function` and convert its result"""
         try:
             result = func(input_data, output_field, input_fields=input_fields, args=args)
         except Exception as e:
@@ -327,8 +426,8 @@ class ProcessingFunctions:
 
         warnings: list[str] = []
         try:
-            parsed_date = datetime.strptime(date, "%Y-%m-%d").astimezone(pytz.utc)
-            if parsed_date > datetime.now(tz=pytz.utc):
+            _, parsed_date = parse_date(date, ("%Y-%m-%d",))
+            if parsed_date.astimezone(pytz.utc) > current_time():
                 warnings.append("Date is in the future.")
             return RawProcessingResult(datum=date, warnings=warnings)
         except ValueError as e:
@@ -362,10 +461,9 @@ class ProcessingFunctions:
 
         input_date_str = input_data["date"]
         release_date_str = input_data.get("releaseDate", "") or ""
-        try:
-            release_date = dateutil.parse(release_date_str).replace(tzinfo=pytz.utc)
-        except Exception:
-            release_date = None
+        release_date = parse_datetime(release_date_str)
+        if release_date:
+            release_date = release_date.replace(tzinfo=pytz.utc)
 
         try:
             submitted_at = datetime.fromtimestamp(float(str(args["submittedAt"])), tz=pytz.utc)
@@ -457,10 +555,8 @@ class ProcessingFunctions:
             )
             datum.date_range_upper = max_upper_limit
 
-        if datum.date_range_lower and datum.date_range_lower > datetime.now(tz=pytz.utc):
-            logger.debug(
-                f"Lower range of date: {datum.date_range_lower} > {datetime.now(tz=pytz.utc)}"
-            )
+        if datum.date_range_lower and datum.date_range_lower > current_time():
+            logger.debug(f"Lower range of date: {datum.date_range_lower} > {current_time()}")
             errors.append(f"Metadata field {output_field}:'{input_date_str}' is in the future.")
 
         if release_date and datum.date_range_lower and (datum.date_range_lower > release_date):
@@ -492,7 +588,7 @@ class ProcessingFunctions:
         return RawProcessingResult(datum=return_value, warnings=warnings, errors=errors)
 
     @staticmethod
-    def parse_and_assert_past_date(  # noqa: C901
+    def parse_and_assert_past_date(
         input_data: InputMetadata,
         output_field,
         input_fields: list[str],
@@ -508,10 +604,7 @@ class ProcessingFunctions:
         if not date_str:
             return RawProcessingResult()
         release_date_str = input_data.get("release_date", "") or ""
-        try:
-            release_date = dateutil.parse(release_date_str)
-        except Exception:
-            release_date = None
+        release_date = parse_datetime(release_date_str)
 
         formats_to_messages = {
             "%Y-%m-%d": None,
@@ -522,38 +615,37 @@ class ProcessingFunctions:
         warnings: list[str] = []
         errors: list[str] = []
 
-        for format, message in formats_to_messages.items():
-            try:
-                parsed_date = datetime.strptime(date_str, format).replace(tzinfo=pytz.utc)
-                match format:
-                    case "%Y-%m-%d":
-                        datum = parsed_date.strftime("%Y-%m-%d")
-                    case "%Y-%m":
-                        datum = f"{parsed_date.strftime('%Y-%m')}-01"
-                    case "%Y":
-                        datum = f"{parsed_date.strftime('%Y')}-01-01"
-
-                logger.debug(f"parsed_date: {parsed_date}")
-
-                if message:
-                    warnings.append(f"Metadata field {output_field}:'{date_str}' - " + message)
-
-                if parsed_date > datetime.now(tz=pytz.utc):
-                    logger.debug(f"parsed_date: {parsed_date} > {datetime.now(tz=pytz.utc)}")
-                    errors.append(f"Metadata field {output_field}:'{date_str}' is in the future.")
-
-                if release_date and parsed_date > release_date:
-                    logger.debug(f"parsed_date: {parsed_date} > release_date: {release_date}")
-                    errors.append(
-                        f"Metadata field {output_field}:'{date_str}'is after release date."
-                    )
+        try:
+            format, parsed_date = parse_date(date_str, tuple(formats_to_messages))
+        except ValueError:
+            # If all parsing attempts fail, it's an unrecognized format
+            return processing_error(
+                f"Metadata field {output_field}: Date format is not recognized."
+            )
+        parsed_date = parsed_date.replace(tzinfo=pytz.utc)
+        message = formats_to_messages[format]
+        match format:
+            case "%Y-%m-%d":
+                datum = parsed_date.strftime("%Y-%m-%d")
+            case "%Y-%m":
+                datum = f"{parsed_date.strftime('%Y-%m')}-01"
+            case "%Y":
+                datum = f"{parsed_date.strftime('%Y')}-01-01"
 
-                return RawProcessingResult(datum=datum, warnings=warnings, errors=errors)
-            except ValueError:
-                continue
+        logger.debug(f"parsed_date: {parsed_date}")
+
+        if message:
+            warnings.append(f"Metadata field {output_field}:'{date_str}' - " + message)
+
+        if parsed_date > current_time():
+            logger.debug(f"parsed_date: {parsed_date} > {current_time()}")
+            errors.append(f"Metadata field {output_field}:'{date_str}' is in the future.")
+
+        if release_date and parsed_date > release_date:
+            logger.debug(f"parsed_date: {parsed_date} > release_date: {release_date}")
+            errors.append(f"Metadata field {output_field}:'{date_str}'is after release date.")
 
-        # If all parsing attempts fail, it's an unrecognized format
-        return processing_error(f"Metadata field {output_field}: Date format is not recognized.")
+        return RawProcessingResult(datum=datum, warnings=warnings, errors=errors)
 
     @staticmethod
     def parse_timestamp(
@@ -569,7 +661,8 @@ class ProcessingFunctions:
             return RawProcessingResult()
 
         try:
-            parsed_timestamp = dateutil.parse(timestamp)
+            # Parsing again without the cache raises the error dateutil failed with
+            parsed_timestamp = parse_datetime(timestamp) or dateutil.parse(timestamp)
             return RawProcessingResult(datum=parsed_timestamp.strftime("%Y-%m-%d"))
         except ValueError as e:
             return processing_error(
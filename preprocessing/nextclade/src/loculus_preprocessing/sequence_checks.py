@@ -26,6 +26,23 @@ UNALIGNED_NUCLEOTIDE_SYMBOLS = {
     "N",
 }  # This list should always correspond at minimum to the check defined in the backend
 
+# Both cases are accepted, sequences are checked case-insensitively
+_UNALIGNED_NUCLEOTIDE_BYTES = "".join(sorted(UNALIGNED_NUCLEOTIDE_SYMBOLS)).encode("ascii")
+_UNALIGNED_NUCLEOTIDE_BYTES += _UNALIGNED_NUCLEOTIDE_BYTES.lower()
+
+
+def non_iupac_symbols(sequence: NucleotideSequence) -> set[str]:
+    """Return the (uppercased) symbols in sequence that are not valid IUPAC nucleotide codes.
+
+    Deleting all valid bytes with bytes.translate is a single pass in C; only the invalid
+    remainder (usually empty) is turned into a set.
+    """
+    try:
+        invalid = sequence.encode("ascii").translate(None, _UNALIGNED_NUCLEOTIDE_BYTES)
+    except UnicodeEncodeError:
+        return set(sequence.upper()) - UNALIGNED_NUCLEOTIDE_SYMBOLS
+    return set(invalid.decode("ascii").upper())
+
 
 def errors_if_non_iupac(
     unaligned_nucleotide_sequences: dict[SegmentName, NucleotideSequence | None],
@@ -33,18 +50,18 @@ def errors_if_non_iupac(
     errors: list[ProcessingAnnotation] = []
     for name, sequence in unaligned_nucleotide_sequences.items():
         if sequence:
-            non_iupac_symbols = set(sequence.upper()) - UNALIGNED_NUCLEOTIDE_SYMBOLS
-            if non_iupac_symbols:
+            invalid_symbols = non_iupac_symbols(sequence)
+            if invalid_symbols:
                 errors.append(
                     ProcessingAnnotation.from_single(
                         name,
                         AnnotationSourceType.NUCLEOTIDE_SEQUENCE,
                         message=(
                             f"Found non-IUPAC symbols in the {name} sequence: "
-                            + ", ".join(non_iupac_symbols)
+                            + ", ".join(invalid_symbols)
                             + (
                                 ". Gap characters (-) are not allowed in raw sequences."
-                                if "-" in non_iupac_symbols
+                                if "-" in invalid_symbols
                                 else ""
                             )
                         ),
@@ -0,0 +1,73 @@
+"""Microbenchmark for EMBL flatfile generation, comparing the EMBL writer against the
+Biopython-based implementation it replaced.
+
+Not collected by pytest; run from preprocessing/nextclade with `python tests/benchmark_embl.py`.
+"""
+
+import timeit
+
+from test_embl import (
+    MULTI_SEGMENT_CONFIG,
+    biopython_flatfile,
+    cds,
+    gene,
+    make_config,
+    make_submission,
+    random_sequence,
+)
+
+from loculus_preprocessing.embl import create_flatfile
+
+REPEATS = 10
+
+
+def annotation(genome_length: int, gene_count: int) -> dict:
+    gene_length = genome_length // gene_count
+    return {
+        "genes": [
+            gene(
+                start,
+                start + gene_length - 1,
+                [
+                    cds([(start, start + gene_length - 1, "+")], gene=f"G{i}", product=f"P{i}"),
+                    cds(
+                        [(start, start + 300, "+"), (start + 600, start + gene_length - 1, "+")],
+                        gene=f"G{i}",
+                        product=f"spliced P{i}",
+                    ),
+                ],
+                gene=f"G{i}",
+            )
+            for i, start in enumerate(range(0, gene_count * gene_length, gene_length))
+        ]
+    }
+
+
+def report(name: str, genome_length: int, gene_count: int) -> None:
+    config = make_config(MULTI_SEGMENT_CONFIG)
+    sequence = random_sequence(genome_length, seed=0)
+    submission = make_submission(
+        {"ebola-sudan": sequence, "ebola-zaire": sequence},
+        {
+            segment: annotation(genome_length, gene_count)
+            for segment in ("ebola-sudan", "ebola-zaire")
+        },
+    )
+    expected = biopython_flatfile(config, submission)
+    assert create_flatfile(config, submission) == expected  # noqa: S101
+    before = min(
+        timeit.repeat(lambda: biopython_flatfile(config, submission), number=1, repeat=REPEATS)
+    )
+    after = min(
+        timeit.repeat(lambda: create_flatfile(config, submission), number=1, repeat=REPEATS)
+    )
+    print(f"{name:<40} {before * 1e3:8.3f} ms -> {after * 1e3:8.3f} ms ({before / after:6.1f}x)")
+
+
+def main() -> None:
+    report("2 segments of 19 kb, 7 genes each", 19_000, 7)
+    report("2 segments of 200 kb, 50 genes each", 200_000, 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Microbenchmark for per-entry metadata processing with and without the compiled plan.
+
+Not collected by pytest; run from preprocessing/nextclade with
+`PYTHONPATH=tests python tests/benchmark_metadata_processing.py`.
+"""
+
+import timeit
+from typing import Any
+
+from loculus_preprocessing.config import Config, ProcessingSpec, get_config, get_processing_order
+from loculus_preprocessing.datatypes import (
+    AnnotationSourceType,
+    InputData,
+    InputMetadata,
+    ProcessedMetadata,
+    ProcessingAnnotation,
+    UnprocessedAfterNextclade,
+    UnprocessedData,
+)
+from loculus_preprocessing.prepro import (
+    ASSIGNED_REFERENCE_PREFIX,
+    NEXTCLADE_PREFIX,
+    PROCESSED_PREFIX,
+    MultipleSequencesPerSegmentError,
+    add_assigned_reference,
+    add_nextclade_metadata,
+    build_missing_required_msg,
+    check_required_when_condition,
+    get_dataset_name,
+    get_output_metadata,
+    get_sequence_length,
+)
+from loculus_preprocessing.processing_functions import ProcessingFunctions, null_per_backend
+
+SINGLE_SEGMENT_CONFIG = "tests/single_segment_config.yaml"
+METADATA_DEPENDENCY_CONFIG = "tests/metadata_dependency.yaml"
+ENTRIES = 500
+REPEATS = 5
+
+
+def previous_add_input_metadata(
+    spec: ProcessingSpec, unprocessed: UnprocessedAfterNextclade, input_path: str, config: Config
+) -> InputData:
+    if input_path.startswith(ASSIGNED_REFERENCE_PREFIX):
+        return add_assigned_reference(spec, unprocessed, config=config)
+    if input_path.startswith(NEXTCLADE_PREFIX):
+        nextclade_path = input_path[len(NEXTCLADE_PREFIX) :]
+        return add_nextclade_metadata(spec, unprocessed, nextclade_path, config=config)
+    if input_path not in unprocessed.inputMetadata:
+        return InputData(datum=None)
+    return InputData(datum=unprocessed.inputMetadata[input_path])
+
+
+def previous_get_output_metadata(  # noqa: C901, PLR0912, PLR0914, PLR0915
+    accession_version: str,
+    unprocessed: UnprocessedData | UnprocessedAfterNextclade,
+    config: Config,
+) -> tuple[ProcessedMetadata, list[ProcessingAnnotation], list[ProcessingAnnotation]]:
+    """Per-entry spec interpretation this benchmark compares against"""
+    errors: list[ProcessingAnnotation] = []
+    warnings: list[ProcessingAnnotation] = []
+    output_metadata: ProcessedMetadata = {}
+
+    for output_field in config.processing_order:
+        spec = config.processing_spec[output_field]
+        input_data: InputMetadata = {}
+        input_fields: list[str] = []
+        if output_field == "length":
+            try:
+                segment = spec.args.get("segment", "main") if spec.args else "main"
+                sequence_name = get_dataset_name(
+                    str(segment), unprocessed.unalignedNucleotideSequences, config
+                )
+            except MultipleSequencesPerSegmentError:
+                output_metadata[output_field] = None
+                continue
+            output_metadata[output_field] = get_sequence_length(
+                unprocessed.unalignedNucleotideSequences, sequence_name
+            )
+            continue
+
+        if output_field.startswith("length_"):
+            sequence_name = get_dataset_name(
+                output_field[7:], unprocessed.unalignedNucleotideSequences, config
+            )
+            output_metadata[output_field] = get_sequence_length(
+                unprocessed.unalignedNucleotideSequences, sequence_name
+            )
+            continue
+
+        for arg_name, input_path in spec.inputs.items():
+            get_from_processed = input_path.startswith(PROCESSED_PREFIX)
+            resolved_path = input_path.removeprefix(PROCESSED_PREFIX)
+            if isinstance(unprocessed, UnprocessedAfterNextclade):
+                if get_from_processed:
+                    input_data[arg_name] = output_metadata.get(resolved_path)  # type: ignore
+                else:
+                    input_metadata = previous_add_input_metadata(
+                        spec, unprocessed, resolved_path, config=config
+                    )
+                    input_data[arg_name] = input_metadata.datum
+                    errors.extend(input_metadata.errors)
+                    warnings.extend(input_metadata.warnings)
+                input_fields.append(resolved_path)
+                group_id = (
+                    int(unprocessed.inputMetadata["group_id"])
+                    if unprocessed.inputMetadata["group_id"]
+                    else None
+                )
+                submitted_at = unprocessed.inputMetadata["submittedAt"]
+            else:
+                input_data[arg_name] = (  # type: ignore
+                    output_metadata.get(resolved_path)  # type: ignore
+                    if get_from_processed
+                    else unprocessed.metadata.get(resolved_path)
+                )
+                input_fields.append(resolved_path)
+                group_id = unprocessed.group_id
+                submitted_at = unprocessed.submittedAt
+
+        args: dict[str, Any] = dict(spec.args) if spec.args else {}
+        args["is_insdc_ingest_group"] = config.insdc_ingest_group_id == group_id
+        args["submittedAt"] = submitted_at
+        args["ACCESSION_VERSION"] = accession_version
+        args["taxonomy_service"] = config._taxonomy_service  # type: ignore
+        processing_result = ProcessingFunctions.call_function(
+            spec.function, args, input_data, output_field, input_fields
+        )
+
+        output_metadata[output_field] = processing_result.datum
+        errors.extend(processing_result.errors)
+        warnings.extend(processing_result.warnings)
+
+        if (
+            not null_per_backend(processing_result.datum)
+            or group_id == config.insdc_ingest_group_id
+        ):
+            continue
+
+        requirement_errors: list[str] = []
+        if spec.required:
+            requirement_errors.append(
+                build_missing_required_msg(output_field, input_fields, config)
+            )
+        for condition in spec.required_when:
+            if (
+                required_when_error := check_required_when_condition(
+                    condition, output_field, unprocessed, output_metadata
+                )
+            ) is not None:
+                requirement_errors.append(required_when_error)
+        errors.extend(
+            ProcessingAnnotation.from_fields(
+                spec.inputs.values(), [output_field], AnnotationSourceType.METADATA, message=msg
+            )
+            for msg in requirement_errors
+        )
+
+    return output_metadata, errors, warnings
+
+
+def make_config() -> Config:
+    config = get_config(SINGLE_SEGMENT_CONFIG, ignore_args=True)
+    config.processing_spec.update(
+        get_config(METADATA_DEPENDENCY_CONFIG, ignore_args=True).processing_spec
+    )
+    config.processing_order = get_processing_order(config)
+    return config
+
+
+def make_entries() -> list[tuple[str, UnprocessedAfterNextclade]]:
+    entries = []
+    for i in range(ENTRIES):
+        metadata: dict[str, str | None] = {
+            "group_id": "2",
+            "submittedAt": "1700000000",
+            "submissionId": f"sample_{i}",
+            "continent": "Asia",
+            "A": f"2022-11-{i % 28 + 1:02d}",
+            "ncbi_required_collection_date": "2022-11-01",
+            "name_required": f"name {i}",
+            "authors": "Smith, Anna; Perez, Tom J.",
+        }
+        sequence = "ACGT" * 2_500
+        entries.append(
+            (
+                f"LOC_{i}.1",
+                UnprocessedAfterNextclade(
+                    inputMetadata=metadata,
+                    files=None,
+                    nextcladeMetadata={
+                        "main": {
+                            "coverage": 0.99,
+                            "totalInsertions": i % 3,
+                            "totalSubstitutions": i % 50,
+                            "totalDeletions": 0,
+                        }
+                    },
+                    unalignedNucleotideSequences={"main": sequence},
+                    alignedNucleotideSequences={"main": sequence},
+                    nucleotideInsertions={},
+                    alignedAminoAcidSequences={},
+                    aminoAcidInsertions={},
+                    sequenceNameToFastaId={"main": f"sample_{i}"},
+                    errors=[],
+                    warnings=[],
+                ),
+            )
+        )
+    return entries
+
+
+def main() -> None:
+    config = make_config()
+    entries = make_entries()
+
+    def previous() -> list:
+        return [previous_get_output_metadata(av, entry, config) for av, entry in entries]
+
+    def current() -> list:
+        return [get_output_metadata(av, entry, config) for av, entry in entries]
+
+    assert previous() == current()  # noqa: S101
+    before = min(timeit.repeat(previous, number=1, repeat=REPEATS)) / ENTRIES
+    after = min(timeit.repeat(current, number=1, repeat=REPEATS)) / ENTRIES
+    print(
+        f"{'get_output_metadata per entry':<40} {before * 1e3:8.3f} ms -> "
+        f"{after * 1e3:8.3f} ms ({before / after:6.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
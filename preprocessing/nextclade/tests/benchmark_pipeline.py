@@ -0,0 +1,307 @@
+"""End-to-end benchmark of fetching, processing and submitting synthetic batches.
+
+Runs the serial or pipelined main loop against a stub backend serving generated entries for the
+test datasets, then reports the time per stage from `metrics` and the peak RSS of the process
+and of its children (nextclade, diamond and processing workers). Each scenario runs in a fresh
+process so that peak RSS and stage totals are its own.
+
+Not collected by pytest; run from preprocessing/nextclade with e.g.
+`python tests/benchmark_pipeline.py --scenarios single,multi --entries 500 --batch-sizes 50,200`.
+The `single` and `multi` scenarios need nextclade on the PATH, `unaligned` does not.
+"""
+
+import argparse
+import json
+import random
+import resource
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any
+
+import jwt
+import orjson
+import zstandard
+
+from loculus_preprocessing.config import SubmissionCompression, get_config
+from loculus_preprocessing.metrics import metrics
+from loculus_preprocessing.prepro import run_pipelined, run_serial
+
+GZIP_WBITS = 31
+
+
+@dataclass(frozen=True)
+class Scenario:
+    config_file: str
+    dataset_dir: str
+    # Reference sequence to mutate per segment (the key of unalignedNucleotideSequences)
+    references: dict[str, str]
+
+
+@dataclass(frozen=True)
+class Options:
+    entries: int
+    pipelined: bool
+    compression: SubmissionCompression | None
+    nextclade_jobs: int
+    seed: int
+
+
+SCENARIOS = {
+    "unaligned": Scenario("tests/no_alignment_config.yaml", "", {"main": ""}),
+    "single": Scenario(
+        "tests/single_segment_config.yaml",
+        "tests/ebola-dataset/ebola-sudan",
+        {"main": "tests/ebola-dataset/ebola-sudan/main/reference.fasta"},
+    ),
+    "multi": Scenario(
+        "tests/multi_segment_config.yaml",
+        "tests/ebola-multipath-dataset",
+        {
+            "ebola-sudan": "tests/ebola-dataset/ebola-sudan/main/reference.fasta",
+            "ebola-zaire": "tests/ebola-dataset/ebola-zaire/main/reference.fasta",
+        },
+    ),
+}
+
+
+def read_reference(path: str) -> str:
+    if not path:
+        return "ACGT" * 2_500
+    lines = Path(path).read_text(encoding="utf-8").splitlines()
+    return "".join(line.strip() for line in lines if not line.startswith(">"))
+
+
+def mutate(reference: str, rng: random.Random) -> str:
+    """The reference with ~0.5% substitutions, a few Ns and occasionally an indel"""
+    sequence = list(reference)
+    for position in rng.sample(range(len(sequence)), len(sequence) // 200):
+        sequence[position] = rng.choice("ACGTN" if rng.random() < 0.1 else "ACGT")  # noqa: PLR2004
+    if rng.random() < 0.2:  # noqa: PLR2004
+        position = rng.randrange(len(sequence) - 10)
+        if rng.random() < 0.5:  # noqa: PLR2004
+            del sequence[position : position + 3]
+        else:
+            sequence[position:position] = rng.choices("ACGT", k=3)
+    return "".join(sequence)
+
+
+def unprocessed_lines(scenario: Scenario, entries: int, seed: int) -> list[bytes]:
+    """/extract-unprocessed-data NDJSON lines of synthetic entries"""
+    rng = random.Random(seed)  # noqa: S311
+    references = {name: read_reference(path) for name, path in scenario.references.items()}
+    lines = []
+    for i in range(entries):
+        metadata = {
+            "submissionId": f"sample_{i}",
+            "continent": rng.choice(["Africa", "Asia", "Europe", "Mars"]),
+            "collection_date": f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "ncbi_required_collection_date": "2023-01-01",
+            "sequenced_timestamp": str(1_700_000_000 + i),
+            "age_int": str(rng.randint(0, 90)),
+            "percentage_float": f"{rng.random() * 100:.2f}",
+            "name_required": f"name {i}",
+            "authors": "Smith, Anna; Perez, Tom J.",
+            "regex_field": f"EPI_ISL_{i}",
+        }
+        line = {
+            "accession": f"LOC_{i:06d}",
+            "version": 1,
+            "submitter": "benchmark",
+            "groupId": 2,
+            "submittedAt": 1_700_000_000,
+            "submissionId": f"sample_{i}",
+            "data": {
+                "metadata": metadata,
+                "unalignedNucleotideSequences": {
+                    name: mutate(reference, rng) for name, reference in references.items()
+                },
+            },
+        }
+        lines.append(orjson.dumps(line))
+    return lines
+
+
+class StubBackend(ThreadingHTTPServer):
+    """Keycloak and the two backend endpoints the main loop uses. Serves `lines` in batches of
+    the requested size, then answers with an error so that the main loop stops."""
+
+    def __init__(self, lines: list[bytes]) -> None:
+        super().__init__(("127.0.0.1", 0), StubBackendHandler)
+        self.lines = lines
+        self.served = 0
+        self.submitted = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubBackendHandler(BaseHTTPRequestHandler):
+    server: StubBackend
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def reply(self, status: int, body: bytes = b"", **headers: str) -> None:
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        # Submissions are streamed in chunks
+        chunks = []
+        while size := int(self.rfile.readline().split(b";")[0], 16):
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        self.rfile.readline()
+        return b"".join(chunks)
+
+    def do_POST(self) -> None:
+        body = self.read_body()
+        path = self.path.split("?")[0]
+        if path.endswith("/token"):
+            token = jwt.encode({"exp": int(time.time()) + 3600}, "benchmark" * 4, algorithm="HS256")
+            self.reply(200, json.dumps({"access_token": token}).encode())
+        elif path.endswith("/extract-unprocessed-data"):
+            size = int(
+                dict(p.split("=") for p in body.decode().split("&"))["numberOfSequenceEntries"]
+            )
+            with self.server.lock:
+                batch = self.server.lines[self.server.served : self.server.served + size]
+                self.server.served += len(batch)
+            if not batch:
+                self.reply(503, b"benchmark finished")
+            else:
+                self.reply(200, b"\n".join(batch), ETag=str(self.server.served))
+        elif path.endswith("/submit-processed-data"):
+            match self.headers.get("Content-Encoding"):
+                case SubmissionCompression.GZIP:
+                    body = zlib.decompress(body, wbits=GZIP_WBITS)
+                case SubmissionCompression.ZSTD:
+                    body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+            with self.server.lock:
+                self.server.submitted += len(body.splitlines())
+            self.reply(204)
+        else:
+            self.reply(404)
+
+
+def run_scenario(name: str, batch_size: int, workers: int, options: Options) -> dict[str, Any]:
+    scenario = SCENARIOS[name]
+    entries = options.entries
+    config = get_config(scenario.config_file, ignore_args=True)
+    backend = StubBackend(unprocessed_lines(scenario, entries, options.seed))
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    config.backend_host = backend.url
+    config.keycloak_host = backend.url
+    config.keycloak_token_path = "token"  # noqa: S105
+    config.batch_size = batch_size
+    config.processing_workers = workers
+    config.pipelined = options.pipelined
+    config.submission_compression = options.compression
+    if options.nextclade_jobs:
+        config.nextclade_jobs = options.nextclade_jobs
+
+    start = time.perf_counter()
+    try:
+        (run_pipelined if options.pipelined else run_serial)(scenario.dataset_dir, config)
+    except Exception as e:
+        if backend.served < entries:
+            raise
+        if backend.submitted < entries:
+            msg = f"Only {backend.submitted}/{entries} entries were submitted: {e}"
+            raise RuntimeError(msg) from e
+    seconds = time.perf_counter() - start
+    backend.shutdown()
+
+    return {
+        "scenario": name,
+        "entries": entries,
+        "batch_size": batch_size,
+        "processing_workers": workers,
+        "pipelined": options.pipelined,
+        "seconds": seconds,
+        "entries_per_second": entries / seconds,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "stages": [
+            {"stage": stage, **dict(labels), **vars(stats)}
+            for (stage, labels), stats in sorted(metrics.totals().items())
+        ],
+    }
+
+
+def print_result(result: dict[str, Any]) -> None:
+    mode = "pipelined" if result["pipelined"] else "serial"
+    print(
+        f"{result['scenario']}: {result['entries']} entries, batch size {result['batch_size']}, "
+        f"{result['processing_workers']} workers, {mode}"
+    )
+    print(
+        f"  total {result['seconds']:8.2f} s ({result['entries_per_second']:.1f} entries/s), "
+        f"peak RSS {result['peak_rss_mib']:.0f} MiB, "
+        f"children {result['peak_child_rss_mib']:.0f} MiB"
+    )
+    for stage in result["stages"]:
+        label = stage.get("dataset") or stage.get("method")
+        name = f"{stage['stage']}[{label}]" if label else stage["stage"]
+        print(
+            f"  {name:<40} {stage['seconds']:8.2f} s {stage['calls']:6d} calls "
+            f"{stage['items']:8d} items"
+        )
+
+
+def comma_separated(value: str) -> list[str]:
+    return [item for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", type=comma_separated, default=["single", "multi"])
+    parser.add_argument("--entries", type=int, default=200)
+    parser.add_argument("--batch-sizes", type=comma_separated, default=["100"])
+    parser.add_argument("--processing-workers", type=comma_separated, default=["1"])
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--nextclade-jobs", type=int, default=0)
+    parser.add_argument("--compression", choices=list(SubmissionCompression), default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - SCENARIOS.keys()
+    if unknown:
+        parser.error(f"Unknown scenarios {sorted(unknown)}, choose from {sorted(SCENARIOS)}")
+    options = Options(
+        args.entries, args.pipelined, args.compression, args.nextclade_jobs, args.seed
+    )
+
+    results = []
+    for name, batch_size, workers in product(
+        args.scenarios, args.batch_sizes, args.processing_workers
+    ):
+        # A fresh process per scenario, so that stage totals and peak RSS are its own
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            result = executor.submit(
+                run_scenario, name, int(batch_size), int(workers), options
+            ).result()
+        print_result(result)
+        results.append(result)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Microbenchmark for per-sequence checks on genome-sized inputs.
+
+Not collected by pytest; run from preprocessing/nextclade with
+`python tests/benchmark_sequence_checks.py`.
+"""
+
+import random
+import timeit
+
+from loculus_preprocessing.nextclade import mask_terminal_gaps
+from loculus_preprocessing.sequence_checks import UNALIGNED_NUCLEOTIDE_SYMBOLS, non_iupac_symbols
+
+GENOME_LENGTH = 200_000
+REPEATS = 20
+
+
+def previous_mask_terminal_gaps(sequence: str, mask_char: str = "N") -> str:
+    """Character-by-character implementation this benchmark compares against"""
+    if not sequence:
+        return ""
+    start = 0
+    while start < len(sequence) and sequence[start] == "-":
+        start += 1
+    end = len(sequence)
+    while end > start and sequence[end - 1] == "-":
+        end -= 1
+    return mask_char * start + sequence[start:end] + mask_char * (len(sequence) - end)
+
+
+def previous_non_iupac_symbols(sequence: str) -> set[str]:
+    return set(sequence.upper()) - UNALIGNED_NUCLEOTIDE_SYMBOLS
+
+
+def report(name: str, previous, current, sequence: str) -> None:
+    assert previous(sequence) == current(sequence)  # noqa: S101
+    before = min(timeit.repeat(lambda: previous(sequence), number=1, repeat=REPEATS))
+    after = min(timeit.repeat(lambda: current(sequence), number=1, repeat=REPEATS))
+    print(f"{name:<40} {before * 1e3:8.3f} ms -> {after * 1e3:8.3f} ms ({before / after:6.1f}x)")
+
+
+def main() -> None:
+    rng = random.Random(0)  # noqa: S311
+    genome = "".join(rng.choices("ACGT", k=GENOME_LENGTH))
+    gapped = "-" * 5_000 + genome[10_000:-10_000] + "-" * 5_000
+
+    report(
+        "non_iupac_symbols (valid genome)", previous_non_iupac_symbols, non_iupac_symbols, genome
+    )
+    report(
+        "non_iupac_symbols (lowercase genome)",
+        previous_non_iupac_symbols,
+        non_iupac_symbols,
+        genome.lower(),
+    )
+    report("mask_terminal_gaps (no gaps)", previous_mask_terminal_gaps, mask_terminal_gaps, genome)
+    report(
+        "mask_terminal_gaps (terminal gaps)",
+        previous_mask_terminal_gaps,
+        mask_terminal_gaps,
+        gapped,
+    )
+    report(
+        "mask_terminal_gaps (all gaps)",
+        previous_mask_terminal_gaps,
+        mask_terminal_gaps,
+        "-" * GENOME_LENGTH,
+    )
+
+
+if __name__ == "__main__":
+    main()
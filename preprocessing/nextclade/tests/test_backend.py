@@ -0,0 +1,259 @@
+# ruff: noqa: S101
+import dataclasses
+import datetime as dt
+import gzip
+import json
+from unittest.mock import MagicMock, patch
+
+import jwt
+import orjson
+import pytest
+import zstandard
+
+from loculus_preprocessing.backend import (
+    JwtCache,
+    fetch_unprocessed_sequences,
+    get_jwt,
+    ndjson_body,
+    parse_ndjson,
+    parse_ndjson_lines,
+    serialize_processed_entry,
+    split_submission,
+    submit_processed_sequences,
+)
+from loculus_preprocessing.config import Config, SubmissionCompression
+from loculus_preprocessing.datatypes import (
+    AnnotationSourceType,
+    FileCategory,
+    FileIdAndNameAndReadUrl,
+    ProcessedData,
+    ProcessedEntry,
+    ProcessingAnnotation,
+)
+
+
+def unprocessed_line(accession: str, **data) -> bytes:
+    return orjson.dumps(
+        {
+            "accession": accession,
+            "version": 1,
+            "submitter": "submitter",
+            "groupId": 2,
+            "submittedAt": "1700000000",
+            "submissionId": f"sub-{accession}",
+            "data": {
+                "metadata": {"note": "a\N{NO-BREAK SPACE}b"},
+                "unalignedNucleotideSequences": {"main": "NNACGTNN", "other": None},
+            }
+            | data,
+        }
+    )
+
+
+def test_parse_ndjson_lines_streams_entries() -> None:
+    files = {"rawReads": [{"fileId": "f1", "name": "r.fastq", "url": "https://s3/f1"}]}
+    lines = iter([unprocessed_line("LOC_1"), b"", b"  ", unprocessed_line("LOC_2", files=files)])
+
+    entries = parse_ndjson_lines(lines)
+    first = next(entries)
+
+    assert first.accessionVersion == "LOC_1.1"
+    assert first.data.metadata == {"note": "a b"}
+    assert first.data.unalignedNucleotideSequences == {"main": "ACGT", "other": None}
+    assert first.data.files is None
+    second = next(entries)
+    assert second.data.files == {
+        FileCategory("rawReads"): [
+            FileIdAndNameAndReadUrl(fileId="f1", name="r.fastq", url="https://s3/f1")
+        ]
+    }
+    assert next(entries, None) is None
+
+
+def test_parse_ndjson_matches_streamed_parsing() -> None:
+    body = b"\n".join([unprocessed_line("LOC_1"), unprocessed_line("LOC_2")]) + b"\n"
+
+    assert parse_ndjson(body.decode()) == list(parse_ndjson_lines(body.split(b"\n")))
+
+
+def test_parse_ndjson_lines_rejects_invalid_json() -> None:
+    with pytest.raises(ValueError, match="Failed to parse JSON"):
+        list(parse_ndjson_lines([b"{not json"]))
+
+
+def test_fetch_unprocessed_sequences_parses_streamed_body() -> None:
+    response = MagicMock(status_code=200, headers={"ETag": "etag-1"})
+    response.__enter__.return_value = response
+    response.iter_lines.return_value = iter([unprocessed_line("LOC_1"), unprocessed_line("LOC_2")])
+    config = Config(backend_host="http://backend")
+
+    with (
+        patch("loculus_preprocessing.backend.get_jwt", return_value="token"),
+        patch("loculus_preprocessing.backend.backend_session") as session,
+    ):
+        session.return_value.post.return_value = response
+        etag, entries = fetch_unprocessed_sequences(None, config, batch_size=2)
+
+    assert session.return_value.post.call_args.kwargs["stream"] is True
+    assert etag == "etag-1"
+    assert [entry.accessionVersion for entry in entries or []] == ["LOC_1.1", "LOC_2.1"]
+
+
+def make_processed_entry(accession: str, sequence: str = "ACGT") -> ProcessedEntry:
+    return ProcessedEntry(
+        accession=accession,
+        version=1,
+        data=ProcessedData(
+            metadata={"date": "2024-01-01", "length": len(sequence), "score": 0.5, "host": None},
+            files={FileCategory.RAW_READS: [FileIdAndNameAndReadUrl("f1", "r.fastq", None)]},
+            unalignedNucleotideSequences={"main": sequence},
+            alignedNucleotideSequences={"main": sequence},
+            nucleotideInsertions={"main": ["10:ACG"]},
+            alignedAminoAcidSequences={"NP": "MK*", "VP35": None},
+            aminoAcidInsertions={"NP": []},
+            sequenceNameToFastaId={"main": "fasta-id"},
+        ),
+        errors=[
+            ProcessingAnnotation.from_fields(
+                ["date"], ["date"], AnnotationSourceType.METADATA, "Invalid date"
+            )
+        ],
+    )
+
+
+def test_serialized_entry_matches_json_of_asdict() -> None:
+    entry = make_processed_entry("LOC_1")
+
+    assert orjson.loads(serialize_processed_entry(entry)) == json.loads(
+        json.dumps(dataclasses.asdict(entry))
+    )
+
+
+def test_split_submission_respects_request_size() -> None:
+    lines = [b"a" * 10, b"b" * 10, b"c" * 30, b"d" * 5, b"e" * 5]
+
+    assert list(split_submission(lines, 25)) == [lines[0:2], lines[2:3], lines[3:5]]
+    assert list(split_submission(lines, 10**6)) == [lines]
+    assert list(split_submission([], 25)) == []
+
+
+@pytest.mark.parametrize(
+    ("compression", "decompress"),
+    [
+        (None, lambda data: data),
+        (SubmissionCompression.GZIP, gzip.decompress),
+        (
+            SubmissionCompression.ZSTD,
+            lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+        ),
+    ],
+)
+def test_ndjson_body_streams_lines(compression, decompress) -> None:
+    lines = [
+        serialize_processed_entry(make_processed_entry(f"LOC_{i}", "ACGT" * 10_000))
+        for i in range(10)
+    ]
+
+    body = b"".join(ndjson_body(lines, compression))
+
+    assert decompress(body) == b"\n".join(lines)
+
+
+def test_submit_processed_sequences_splits_and_compresses_requests() -> None:
+    processed = [make_processed_entry(f"LOC_{i}") for i in range(5)]
+    line_size = len(serialize_processed_entry(processed[0])) + 1
+    config = Config(
+        backend_host="http://backend",
+        submission_compression=SubmissionCompression.GZIP,
+        submission_max_request_bytes=2 * line_size,
+    )
+    requests_sent: list[tuple[dict, bytes]] = []
+
+    def post(url, data, headers, params, timeout):
+        requests_sent.append((headers, gzip.decompress(b"".join(data))))
+        return MagicMock(ok=True, headers={})
+
+    with (
+        patch("loculus_preprocessing.backend.get_jwt", return_value="token"),
+        patch("loculus_preprocessing.backend.backend_session") as session,
+    ):
+        session.return_value.post.side_effect = post
+        submit_processed_sequences(processed, "unused", config)
+
+    assert [len(body.split(b"\n")) for _, body in requests_sent] == [2, 2, 1]
+    assert all(headers["Content-Encoding"] == "gzip" for headers, _ in requests_sent)
+    submitted = [orjson.loads(line) for _, body in requests_sent for line in body.split(b"\n")]
+    assert [entry["accession"] for entry in submitted] == [f"LOC_{i}" for i in range(5)]
+
+
+def token_response(name: str, lifetime: dt.timedelta) -> MagicMock:
+    expiration = dt.datetime.now(tz=dt.UTC) + lifetime
+    access_token = jwt.encode(
+        {"sub": name, "exp": expiration}, "test-secret-of-at-least-32-bytes", algorithm="HS256"
+    )
+    response = MagicMock(ok=True)
+    response.__enter__.return_value = response
+    response.json.return_value = {
+        "access_token": access_token,
+        "refresh_token": f"refresh-{name}",
+        "refresh_expires_in": 3600,
+    }
+    return response
+
+
+def test_tokens_without_expiration_are_expired() -> None:
+    cache = JwtCache()
+    cache.token = "token"  # noqa: S105
+    cache.refresh_token = "refresh"  # noqa: S105
+
+    assert cache.get_token() is None
+    assert cache.get_refresh_token() is None
+
+
+def test_get_jwt_caches_token_and_refreshes_it() -> None:
+    config = Config()
+    responses = [
+        token_response("first", dt.timedelta(minutes=1)),
+        token_response("second", dt.timedelta(hours=1)),
+    ]
+
+    with (
+        patch("loculus_preprocessing.backend.jwt_cache", JwtCache()),
+        patch("loculus_preprocessing.backend.backend_session") as session,
+    ):
+        session.return_value.post.side_effect = responses
+        # The first token is about to expire, so it is refreshed on the next call
+        first = get_jwt(config)
+        second = get_jwt(config)
+        assert get_jwt(config) == second
+
+    grants = [call.kwargs["data"] for call in session.return_value.post.call_args_list]
+    assert jwt.decode(first, options={"verify_signature": False})["sub"] == "first"
+    assert jwt.decode(second, options={"verify_signature": False})["sub"] == "second"
+    assert [grant["grant_type"] for grant in grants] == ["password", "refresh_token"]
+    assert grants[1]["refresh_token"] == "refresh-first"  # noqa: S105
+
+
+def test_get_jwt_falls_back_to_password_grant_when_refresh_fails() -> None:
+    config = Config()
+    rejected = MagicMock(ok=False, status_code=400, text="invalid_grant")
+    rejected.__enter__.return_value = rejected
+    responses = [
+        token_response("first", dt.timedelta(minutes=1)),
+        rejected,
+        token_response("second", dt.timedelta(hours=1)),
+    ]
+
+    with (
+        patch("loculus_preprocessing.backend.jwt_cache", JwtCache()),
+        patch("loculus_preprocessing.backend.backend_session") as session,
+    ):
+        session.return_value.post.side_effect = responses
+        get_jwt(config)
+        token = get_jwt(config)
+
+    grants = [
+        call.kwargs["data"]["grant_type"] for call in session.return_value.post.call_args_list
+    ]
+    assert grants == ["password", "refresh_token", "password"]
+    assert jwt.decode(token, options={"verify_signature": False})["sub"] == "second"
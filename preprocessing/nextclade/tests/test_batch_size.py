@@ -0,0 +1,64 @@
+# ruff: noqa: S101
+
+from loculus_preprocessing.batch_size import BatchSizeController
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.metrics import metrics
+
+
+def make_controller(**overrides) -> BatchSizeController:
+    settings = {
+        "adaptive_batch_size": True,
+        "batch_size": 10,
+        "min_batch_size": 2,
+        "max_batch_size": 50,
+        "target_batch_seconds": 30,
+        "backend_processing_timeout_seconds": 120,
+    }
+    return BatchSizeController(Config(**(settings | overrides)))
+
+
+def test_fixed_batch_size_when_disabled() -> None:
+    controller = BatchSizeController(Config(batch_size=7))
+
+    assert controller.observe(requested=7, received=7, seconds=1, has_files=False) == 7  # noqa: PLR2004
+
+
+def test_grows_on_full_fast_batches_up_to_max() -> None:
+    controller = make_controller()
+
+    sizes = [controller.observe(controller.batch_size, controller.batch_size, 1, False)]
+    sizes.extend(
+        controller.observe(controller.batch_size, controller.batch_size, 1, False) for _ in range(3)
+    )
+
+    assert sizes == [20, 40, 50, 50]
+    assert metrics.gauges()["batch_size"] == 50  # noqa: PLR2004
+
+
+def test_does_not_grow_without_backlog() -> None:
+    controller = make_controller()
+
+    assert controller.observe(requested=10, received=3, seconds=1, has_files=False) == 10  # noqa: PLR2004
+
+
+def test_growth_limited_by_projected_latency() -> None:
+    controller = make_controller()
+
+    # 2s per entry fits 15 entries into the 30s budget
+    assert controller.observe(requested=10, received=10, seconds=20, has_files=False) == 15  # noqa: PLR2004
+
+
+def test_shrinks_slow_batches_down_to_min() -> None:
+    controller = make_controller()
+
+    assert controller.observe(requested=10, received=10, seconds=60, has_files=False) == 5  # noqa: PLR2004
+    assert controller.observe(requested=5, received=5, seconds=600, has_files=False) == 2  # noqa: PLR2004
+
+
+def test_budget_respects_backend_timeout_and_url_expiry() -> None:
+    controller = make_controller(file_read_url_expiry_seconds=20, target_batch_seconds=100)
+
+    assert controller.budget_seconds(has_files=False) == 60  # noqa: PLR2004
+    assert controller.budget_seconds(has_files=True) == 10  # noqa: PLR2004
+    # 15s is within the target but too close to the expiry of file URLs
+    assert controller.observe(requested=10, received=10, seconds=15, has_files=True) == 6  # noqa: PLR2004
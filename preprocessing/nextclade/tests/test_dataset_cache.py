@@ -0,0 +1,165 @@
+# ruff: noqa: S101
+import os
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+from loculus_preprocessing.backend import download_file
+from loculus_preprocessing.config import get_config
+from loculus_preprocessing.dataset_cache import DatasetCache
+from loculus_preprocessing.nextclade import download_nextclade_dataset
+
+SINGLE_SEGMENT_CONFIG = "tests/single_segment_config.yaml"
+URL = "https://example.com/minimizer_index.json"
+
+
+def write_files(files: dict[str, str]):
+    def download(directory: Path) -> dict[str, str]:
+        for name, content in files.items():
+            (directory / name).parent.mkdir(parents=True, exist_ok=True)
+            (directory / name).write_text(content)
+        return {"etag": "v1"}
+
+    return download
+
+
+def test_installed_download_is_found_and_verified(tmp_path: Path) -> None:
+    cache = DatasetCache(str(tmp_path / "cache"))
+    key = ("nextclade_dataset", "server", "ebola", "2024-01-01")
+    assert cache.lookup(key) is None
+
+    installed = cache.install(
+        key, write_files({"pathogen.json": "{}", "ref/reference.fasta": ">a"})
+    )
+    cached = cache.lookup(key)
+
+    assert cached == installed
+    assert cached.metadata == {"etag": "v1"}
+    assert (cached.path / "ref/reference.fasta").read_text() == ">a"
+    # Identical content under another key shares the entry
+    assert (
+        cache.install(
+            ("other",), write_files({"pathogen.json": "{}", "ref/reference.fasta": ">a"})
+        ).path
+        == cached.path
+    )
+
+
+def test_corrupted_entry_is_quarantined(tmp_path: Path) -> None:
+    cache = DatasetCache(str(tmp_path / "cache"))
+    key = ("url", URL)
+    path = cache.install(key, write_files({"minimizer.json": "{}"})).path
+
+    (path / "minimizer.json").write_text('{"truncated"')
+
+    assert cache.lookup(key) is None
+    assert not path.exists()
+    [quarantined] = cache.quarantine_dir.iterdir()
+    assert quarantined.name.startswith(path.name)
+    assert (quarantined / "minimizer.json").read_text() == '{"truncated"'
+
+
+def test_unchanged_files_are_not_rehashed(tmp_path: Path) -> None:
+    key = ("url", URL)
+    path = DatasetCache(str(tmp_path / "cache")).install(key, write_files({"a.json": "{}"})).path
+    mtime_ns = (path / "a.json").stat().st_mtime_ns
+    # Same size and modification time, only found by hashing
+    (path / "a.json").write_text("[]")
+    os.utime(path / "a.json", ns=(mtime_ns, mtime_ns))
+
+    assert DatasetCache(str(tmp_path / "cache")).lookup(key) is not None
+    assert DatasetCache(str(tmp_path / "cache"), verify_checksums=True).lookup(key) is None
+
+
+def test_unused_entries_are_evicted(tmp_path: Path) -> None:
+    cache = DatasetCache(str(tmp_path / "cache"), max_unused_seconds=3600)
+    old = cache.install(("url", "old"), write_files({"a.json": "old"})).path
+    replaced = cache.install(("url", URL), write_files({"a.json": "v1"})).path
+    used = cache.install(("url", "used"), write_files({"a.json": "used"})).path
+    long_ago = time.time() - 7200
+    for path in [*cache.refs_dir.iterdir(), old, replaced, used]:
+        os.utime(path, (long_ago, long_ago))
+    assert cache.lookup(("url", "used")) is not None
+
+    current = cache.install(("url", URL), write_files({"a.json": "v2"})).path
+
+    assert cache.lookup(("url", "old")) is None
+    assert sorted(cache.objects_dir.iterdir()) == sorted([used, current])
+
+
+def make_response(status_code: int, body: bytes = b"", **headers: str) -> MagicMock:
+    response = MagicMock(status_code=status_code, headers=headers)
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [body]
+    if status_code >= 400:  # noqa: PLR2004
+        response.raise_for_status.side_effect = requests.HTTPError(str(status_code))
+    return response
+
+
+def test_download_file_revalidates_cached_copy(tmp_path: Path) -> None:
+    config = get_config(SINGLE_SEGMENT_CONFIG, ignore_args=True)
+    config._dataset_cache = DatasetCache(str(tmp_path / "cache"))  # type: ignore
+    responses = [
+        make_response(200, b"v1", ETag='"1"'),
+        make_response(304),
+        requests.ConnectionError("unreachable"),
+        make_response(200, b"v2", ETag='"2"'),
+    ]
+    contents = []
+
+    with patch("loculus_preprocessing.backend.requests.get", side_effect=responses) as get:
+        for i in range(len(responses)):
+            save_path = tmp_path / f"dataset{i}/minimizer/minimizer.json"
+            download_file(URL, str(save_path), config)
+            contents.append(save_path.read_text())
+
+    assert contents == ["v1", "v1", "v1", "v2"]
+    assert [call.kwargs["headers"] for call in get.call_args_list] == [
+        {},
+        {"If-None-Match": '"1"'},
+        {"If-None-Match": '"1"'},
+        {"If-None-Match": '"1"'},
+    ]
+
+
+def test_download_file_without_cached_copy_raises(tmp_path: Path) -> None:
+    config = get_config(SINGLE_SEGMENT_CONFIG, ignore_args=True)
+    config._dataset_cache = DatasetCache(str(tmp_path / "cache"))  # type: ignore
+
+    with (
+        patch("loculus_preprocessing.backend.requests.get", return_value=make_response(404)),
+        pytest.raises(requests.HTTPError),
+    ):
+        download_file(URL, str(tmp_path / "minimizer.json"), config)
+
+
+def fake_dataset_get(args: list[str], check: bool) -> MagicMock:
+    output_dir = Path(next(arg for arg in args if arg.startswith("--output-dir=")).split("=")[1])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "pathogen.json").write_text(str(args))
+    return MagicMock(returncode=0)
+
+
+@pytest.mark.parametrize(("tag", "downloads"), [("2024-01-01--00-00-00Z", 1), (None, 2)])
+def test_tagged_nextclade_datasets_are_downloaded_once(
+    tmp_path: Path, tag: str | None, downloads: int
+) -> None:
+    config = get_config(SINGLE_SEGMENT_CONFIG, ignore_args=True)
+    config._dataset_cache = DatasetCache(str(tmp_path / "cache"))  # type: ignore
+    for segment in config.segments:
+        for reference in segment.references:
+            reference.nextclade_dataset_tag = tag
+
+    with patch(
+        "loculus_preprocessing.nextclade.subprocess.run", side_effect=fake_dataset_get
+    ) as run:
+        for restart in range(2):
+            download_nextclade_dataset(str(tmp_path / f"restart{restart}"), config)
+
+    assert run.call_count == downloads
+    for restart in range(2):
+        pathogen_json = tmp_path / f"restart{restart}/main/pathogen.json"
+        assert "--name=ebola-sudan" in pathogen_json.read_text()
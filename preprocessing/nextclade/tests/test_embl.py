@@ -0,0 +1,334 @@
+# ruff: noqa: S101
+import random
+from pathlib import Path
+from typing import Any
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqFeature import CompoundLocation, FeatureLocation, Reference, SeqFeature
+from Bio.SeqRecord import SeqRecord
+
+from loculus_preprocessing.config import Config, get_config
+from loculus_preprocessing.datatypes import (
+    MoleculeType,
+    ProcessedData,
+    ProcessedEntry,
+    SubmissionData,
+    Topology,
+)
+from loculus_preprocessing.embl import (
+    EMBL_ANNOTATIONS,
+    create_flatfile,
+    get_authors,
+    get_country,
+    get_description,
+)
+
+SINGLE_SEGMENT_CONFIG = "tests/single_segment_config.yaml"
+MULTI_SEGMENT_CONFIG = "tests/multi_segment_config.yaml"
+MULTI_SEGMENT_EMBL = "tests/flatfiles/multi_segment_annotated.embl"
+
+
+def biopython_flatfile(config: Config, submission_data: SubmissionData) -> str:
+    """The SeqRecord-based implementation the EMBL writer replaced, kept as the reference the
+    writer must reproduce byte for byte"""
+    metadata = submission_data.processed_entry.data.metadata
+    annotation_object = submission_data.annotations
+    accession = submission_data.processed_entry.accession
+    version = submission_data.processed_entry.version
+    collection_date = metadata.get(config.embl.collection_date_property, "Unknown")
+    authors = get_authors(str(metadata.get(config.embl.authors_property) or ""))
+    country = get_country(metadata, config)
+    seqio_molecule_type = {
+        MoleculeType.GENOMIC_DNA: "DNA",
+        MoleculeType.GENOMIC_RNA: "RNA",
+        MoleculeType.VIRAL_CRNA: "cRNA",
+    }
+    embl_content = []
+    for (
+        seq_name,
+        sequence_str,
+    ) in submission_data.processed_entry.data.unalignedNucleotideSequences.items():
+        if not sequence_str:
+            continue
+        reference = Reference()
+        reference.authors = authors
+        segment = seq_name if config.multi_segment else None
+        annotations: dict[str, Any] = {
+            "molecule_type": seqio_molecule_type.get(config.molecule_type, "DNA"),
+            "organism": config.scientific_name,
+            "topology": config.topology,
+            "references": [reference],
+        }
+        record = SeqRecord(
+            Seq(sequence_str),
+            id=f"{accession}_{seq_name}" if config.multi_segment else accession,
+            annotations=annotations,
+            description=get_description(accession, version, config.db_name, metadata, segment),
+        )
+        record.features.append(
+            SeqFeature(
+                FeatureLocation(start=0, end=len(sequence_str)),
+                type="source",
+                qualifiers={
+                    "molecule_type": str(config.molecule_type),
+                    "organism": config.scientific_name,
+                    "country": country,
+                    "collection_date": collection_date,
+                },
+            )
+        )
+        if annotation_object and annotation_object.get(seq_name):
+            record.features.extend(
+                biopython_seq_features(annotation_object[seq_name], sequence_str)
+            )
+        embl_content.append(record.format("embl"))
+    return "".join(embl_content)
+
+
+def biopython_seq_features(annotation_object: dict[str, Any], sequence: str) -> list[SeqFeature]:
+    attribute_map = {"Note": "note", "phase": "codon_start"}
+    gene_map = {q: q for q in EMBL_ANNOTATIONS["gene_qualifiers"]} | attribute_map
+    cds_map = {q: q for q in EMBL_ANNOTATIONS["cds_qualifiers"]} | attribute_map
+    features = []
+    for gene in annotation_object.get("genes", []):
+        attributes = gene.get("attributes", {})
+        features.append(
+            SeqFeature(
+                FeatureLocation(start=gene["range"]["begin"], end=gene["range"]["end"]),
+                type="gene",
+                qualifiers={
+                    new: attributes[old] for old, new in gene_map.items() if old in attributes
+                },
+            )
+        )
+        for cds in gene.get("cdses", []):
+            ranges = [segment["range"] for segment in cds["segments"]]
+            locations = [
+                FeatureLocation(
+                    start=r["begin"], end=r["end"], strand=-1 if s.get("strand") == "-" else 1
+                )
+                for r, s in zip(ranges, cds["segments"], strict=True)
+            ]
+            attributes = cds.get("attributes", {})
+            qualifiers = {new: attributes[old] for old, new in cds_map.items() if old in attributes}
+            qualifiers["codon_start"] = qualifiers.get("codon_start", 0) + 1
+            qualifiers["translation"] = "".join(
+                str(Seq(sequence[r["begin"] : r["end"]]).translate()) for r in ranges
+            )
+            features.append(
+                SeqFeature(
+                    locations[0] if len(locations) == 1 else CompoundLocation(locations),
+                    type="CDS",
+                    qualifiers=qualifiers,
+                )
+            )
+    return features
+
+
+def cds(segments: list[tuple[int, int, str]], **attributes: Any) -> dict[str, Any]:
+    return {
+        "segments": [
+            {"range": {"begin": begin, "end": end}, "strand": strand}
+            for begin, end, strand in segments
+        ],
+        "attributes": attributes,
+    }
+
+
+def gene(begin: int, end: int, cdses: list[dict[str, Any]], **attributes: Any) -> dict[str, Any]:
+    return {"range": {"begin": begin, "end": end}, "attributes": attributes, "cdses": cdses}
+
+
+def random_sequence(length: int, seed: int) -> str:
+    return "".join(random.Random(seed).choices("ACGTACGTACGTNRY", k=length))  # noqa: S311
+
+
+ANNOTATION = {
+    "genes": [
+        gene(
+            10,
+            1510,
+            [
+                cds(
+                    [(10, 1510, "+")],
+                    gene="NP",
+                    product="nucleoprotein",
+                    protein_id="YP_138520.1",
+                    Note="predominant component of nucleocapsid with a note long enough to "
+                    'wrap across several lines, "quoted" in places',
+                ),
+                cds(
+                    [(10, 400, "+"), (399, 1000, "+")],
+                    gene="NP",
+                    product="spliced protein",
+                    ribosomal_slippage="",
+                    phase=1,
+                ),
+            ],
+            gene="NP",
+            product="NP",
+            unknown_attribute="dropped",
+        ),
+        gene(
+            1600,
+            2600,
+            [
+                cds([(1600, 2600, "-")], gene="VP35", product="polymerase cofactor"),
+                cds(
+                    [(1600, 1700, "-"), (1800, 2000, "-"), (2100, 2600, "-")],
+                    gene="VP35",
+                    product="complement join",
+                ),
+                cds([(1600, 1900, "+"), (2000, 2600, "-")], gene="VP35", product="mixed"),
+                cds([(2000, 2001, "+"), (2200, 2500, "+")], product="single base part"),
+            ],
+            gene="VP35",
+            gene_synonym="x" * 70,
+        ),
+        gene(
+            2700,
+            2999,
+            [
+                cds(
+                    [(begin, begin + 9, "+") for begin in range(2700, 2990, 10)],
+                    gene="many-parts",
+                )
+            ],
+        ),
+    ]
+}
+
+
+def make_config(config_file: str, **overrides: Any) -> Config:
+    config = get_config(config_file, ignore_args=True)
+    return config.model_copy(update=overrides)
+
+
+def make_submission(
+    sequences: dict[str, str],
+    annotations: dict[str, Any] | None,
+    metadata: dict[str, Any] | None = None,
+) -> SubmissionData:
+    default_metadata = {
+        "sampleCollectionDate": "2024-01-01",
+        "geoLocCountry": "Netherlands",
+        "geoLocAdmin1": "North Holland",
+        "authors": "Smith, Doe A; Müller, Jörg; Ng, Wai Kit;",
+    }
+    return SubmissionData(
+        processed_entry=ProcessedEntry(
+            accession="LOC_0001",
+            version=3,
+            data=ProcessedData(
+                metadata=default_metadata | (metadata or {}),
+                files=None,
+                unalignedNucleotideSequences=sequences,
+                alignedNucleotideSequences={},
+                nucleotideInsertions={},
+                alignedAminoAcidSequences={},
+                aminoAcidInsertions={},
+                sequenceNameToFastaId={},
+            ),
+        ),
+        submitter="test_submitter",
+        group_id=1,
+        annotations=annotations,
+    )
+
+
+SEQUENCE = random_sequence(3001, seed=1)
+
+flatfile_cases = [
+    pytest.param(SINGLE_SEGMENT_CONFIG, {}, {"main": SEQUENCE}, {"main": ANNOTATION}, {}, id="rna"),
+    pytest.param(
+        SINGLE_SEGMENT_CONFIG,
+        {"molecule_type": MoleculeType.GENOMIC_DNA, "topology": Topology.CIRCULAR},
+        {"main": SEQUENCE},
+        {"main": ANNOTATION},
+        {},
+        id="dna-circular",
+    ),
+    pytest.param(
+        SINGLE_SEGMENT_CONFIG,
+        {"molecule_type": MoleculeType.VIRAL_CRNA},
+        {"main": SEQUENCE[:2940]},
+        {"main": ANNOTATION},
+        {"authors": None, "sampleCollectionDate": None},
+        id="crna-full-last-line-no-authors",
+    ),
+    pytest.param(
+        SINGLE_SEGMENT_CONFIG,
+        {},
+        {"main": "acgtn"},
+        None,
+        {
+            "insdcAccessionFull": "OZ000001.1",
+            "gisaidIsolateId": "EPI_ISL_" + "1" * 80,
+            "authors": "; ".join(f"Author{i}, First Middle" for i in range(40)) + ";",
+        },
+        id="short-sequence-long-header-lines",
+    ),
+    pytest.param(
+        MULTI_SEGMENT_CONFIG,
+        {},
+        {"ebola-sudan": SEQUENCE, "ebola-zaire": SEQUENCE[:1000], "empty": None},
+        {"ebola-sudan": ANNOTATION, "ebola-zaire": None},
+        {"insdcAccessionFull_ebola-zaire": "OZ000002.1"},
+        id="multi-segment",
+    ),
+]
+
+
+@pytest.mark.parametrize(
+    ("config_file", "overrides", "sequences", "annotations", "metadata"), flatfile_cases
+)
+def test_flatfile_matches_biopython(
+    config_file: str,
+    overrides: dict[str, Any],
+    sequences: dict[str, str],
+    annotations: dict[str, Any] | None,
+    metadata: dict[str, Any],
+) -> None:
+    config = make_config(config_file, **overrides)
+    submission = make_submission(sequences, annotations, metadata)
+
+    assert create_flatfile(config, submission) == biopython_flatfile(config, submission)
+
+
+def test_flatfile_matches_biopython_on_random_annotations() -> None:
+    config = make_config(SINGLE_SEGMENT_CONFIG)
+    rng = random.Random(42)  # noqa: S311
+    for seed in range(50):
+        sequence = random_sequence(rng.randint(10, 700), seed)
+        genes = []
+        for _ in range(rng.randint(0, 4)):
+            parts = sorted(rng.sample(range(len(sequence) + 1), 2 * rng.randint(1, 3)))
+            segments = [
+                (begin, end, rng.choice("+-"))
+                for begin, end in zip(parts[::2], parts[1::2], strict=True)
+            ]
+            words = ["".join(rng.choices('abc "xyz', k=rng.randint(1, 30))) for _ in range(8)]
+            genes.append(
+                gene(
+                    parts[0],
+                    parts[-1],
+                    [cds(segments, note=" ".join(words), phase=rng.randint(0, 2))],
+                    Note=" ".join(words[: rng.randint(0, 8)]),
+                )
+            )
+        submission = make_submission({"main": sequence}, {"main": {"genes": genes}})
+
+        assert create_flatfile(config, submission) == biopython_flatfile(config, submission)
+
+
+def test_flatfile_matches_golden_file() -> None:
+    config = make_config(MULTI_SEGMENT_CONFIG)
+    submission = make_submission(
+        {"ebola-sudan": SEQUENCE, "ebola-zaire": SEQUENCE[:1000]},
+        {"ebola-sudan": ANNOTATION, "ebola-zaire": None},
+    )
+
+    assert create_flatfile(config, submission) == Path(MULTI_SEGMENT_EMBL).read_text(
+        encoding="utf-8"
+    )
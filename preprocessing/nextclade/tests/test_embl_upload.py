@@ -0,0 +1,130 @@
+# ruff: noqa: S101
+
+from unittest.mock import patch
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.datatypes import (
+    FileCategory,
+    FileIdAndNameAndReadUrl,
+    FileUploadInfo,
+    ProcessedData,
+    ProcessedEntry,
+    SubmissionData,
+)
+from loculus_preprocessing.prepro import upload_flatfiles
+
+
+def make_submission(accession: str, group_id: int | None) -> SubmissionData:
+    return SubmissionData(
+        processed_entry=ProcessedEntry(
+            accession=accession,
+            version=1,
+            data=ProcessedData(
+                metadata={},
+                files=None,
+                unalignedNucleotideSequences={},
+                alignedNucleotideSequences={},
+                nucleotideInsertions={},
+                alignedAminoAcidSequences={},
+                aminoAcidInsertions={},
+                sequenceNameToFastaId={},
+            ),
+        ),
+        submitter="submitter",
+        group_id=group_id,
+    )
+
+
+def fake_request_upload(group_id, number_of_files, config):
+    return [
+        FileUploadInfo(fileId=f"file-{group_id}-{i}", url=f"https://s3/{group_id}/{i}")
+        for i in range(number_of_files)
+    ]
+
+
+def test_upload_flatfiles_requests_urls_once_per_group_and_isolates_failures() -> None:
+    processed = [
+        make_submission("LOC_1", 1),
+        make_submission("LOC_2", 2),
+        make_submission("LOC_3", 1),
+        make_submission("LOC_4", None),
+    ]
+    uploaded: dict[str, str] = {}
+
+    def upload(content, url, extra_headers=None, session=None):
+        if content == "LOC_3":
+            msg = "S3 unavailable"
+            raise RuntimeError(msg)
+        uploaded[url] = content
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.request_upload", side_effect=fake_request_upload
+        ) as request_upload,
+        patch(
+            "loculus_preprocessing.prepro.create_flatfile",
+            side_effect=lambda config, submission_data: submission_data.processed_entry.accession,
+        ),
+        patch("loculus_preprocessing.prepro.upload_embl_file_to_presigned_url", side_effect=upload),
+    ):
+        upload_flatfiles(processed, Config(embl_upload_workers=2))
+
+    assert sorted(call.args[:2] for call in request_upload.call_args_list) == [(1, 2), (2, 1)]
+    assert uploaded == {"https://s3/1/0": "LOC_1", "https://s3/2/0": "LOC_2"}
+    files = [entry.processed_entry.data.files for entry in processed]
+    assert files[0] == {
+        FileCategory.ANNOTATIONS: [FileIdAndNameAndReadUrl(fileId="file-1-0", name="LOC_1.1.embl")]
+    }
+    assert files[1] == {
+        FileCategory.ANNOTATIONS: [FileIdAndNameAndReadUrl(fileId="file-2-0", name="LOC_2.1.embl")]
+    }
+    assert files[2] is None
+    assert files[3] is None
+    assert [len(entry.processed_entry.errors) for entry in processed] == [0, 0, 1, 1]
+
+
+def test_upload_flatfiles_marks_whole_group_when_url_request_fails() -> None:
+    processed = [make_submission("LOC_1", 1), make_submission("LOC_2", 1)]
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.request_upload",
+            side_effect=RuntimeError("backend unavailable"),
+        ),
+        patch("loculus_preprocessing.prepro.create_flatfile", return_value="flatfile"),
+        patch("loculus_preprocessing.prepro.upload_embl_file_to_presigned_url") as upload,
+    ):
+        upload_flatfiles(processed, Config())
+
+    upload.assert_not_called()
+    assert all(
+        entry.processed_entry.errors[0].message.startswith("Failed to create or upload EMBL file")
+        for entry in processed
+    )
+
+
+def test_upload_flatfiles_requests_urls_only_for_created_files() -> None:
+    processed = [make_submission("LOC_1", 1), make_submission("LOC_2", 1)]
+
+    def create_flatfile(config, submission_data):
+        if submission_data.processed_entry.accession == "LOC_1":
+            msg = "invalid metadata"
+            raise ValueError(msg)
+        return "flatfile"
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.request_upload", side_effect=fake_request_upload
+        ) as request_upload,
+        patch("loculus_preprocessing.prepro.create_flatfile", side_effect=create_flatfile),
+        patch("loculus_preprocessing.prepro.upload_embl_file_to_presigned_url") as upload,
+    ):
+        upload_flatfiles(processed, Config())
+
+    request_upload.assert_called_once()
+    assert request_upload.call_args.args[:2] == (1, 1)
+    upload.assert_called_once()
+    assert [len(entry.processed_entry.errors) for entry in processed] == [1, 0]
+    assert processed[1].processed_entry.data.files == {
+        FileCategory.ANNOTATIONS: [FileIdAndNameAndReadUrl(fileId="file-1-0", name="LOC_2.1.embl")]
+    }
@@ -0,0 +1,48 @@
+# ruff: file-ignore[assert]
+
+from pathlib import Path
+
+import pytest
+from Bio import SeqIO
+
+from loculus_preprocessing.fasta import parse_fasta, read_fasta, write_fasta
+
+FASTA = (
+    ">LOC_1.1__main description with spaces\nACGT\nNN--\n>LOC_2.1\r\nMKV*\r\n>empty\n>last\nAC GT"
+)
+
+
+def test_read_fasta_matches_biopython(tmp_path: Path) -> None:
+    path = tmp_path / "input.fasta"
+    path.write_text(FASTA, encoding="utf-8")
+
+    expected = [(record.id, str(record.seq)) for record in SeqIO.parse(path, "fasta")]
+
+    assert list(read_fasta(str(path))) == expected
+    assert expected == [
+        ("LOC_1.1__main", "ACGTNN--"),
+        ("LOC_2.1", "MKV*"),
+        ("empty", ""),
+        ("last", "ACGT"),
+    ]
+
+
+def test_read_fasta_empty_file(tmp_path: Path) -> None:
+    path = tmp_path / "empty.fasta"
+    path.touch()
+
+    assert list(read_fasta(str(path))) == []
+
+
+def test_read_fasta_missing_file_raises(tmp_path: Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        list(read_fasta(str(tmp_path / "missing.fasta")))
+
+
+def test_write_fasta_round_trip(tmp_path: Path) -> None:
+    sequences = {"a": "ACGT", "b": "", "c": "N" * 1000}
+    path = str(tmp_path / "out" / "sequences.fasta")
+    write_fasta(sequences, path)
+
+    assert dict(read_fasta(path)) == sequences
+    assert dict(parse_fasta(Path(path).read_bytes())) == sequences
@@ -1,8 +1,11 @@
 # ruff: noqa: S101
 
+from http import HTTPStatus
+from typing import Any
 from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
 from loculus_preprocessing import external_services
 from loculus_preprocessing.config import get_config
@@ -24,6 +27,8 @@ def make_response(status_code, json_data):
     mock = MagicMock()
     mock.status_code = status_code
     mock.json.return_value = json_data
+    if status_code >= HTTPStatus.BAD_REQUEST:
+        mock.raise_for_status.side_effect = requests.HTTPError(f"{status_code} Error")
     return mock
 
 
@@ -56,9 +61,15 @@ def taxonomy_service_mock(url: str, **kwargs):
     return make_response(404, {"detail": "not found"})
 
 
+def batch_endpoint_missing(url: str, **kwargs):
+    """Taxonomy service without the batch endpoint, lookups fall back to single requests"""
+    return make_response(404, {"detail": "Not Found"})
+
+
 @patch.object(external_services.taxonomy_cache, "session")
 def test_host_processing_tax_id(mock_session: MagicMock) -> None:
     mock_session.get.side_effect = taxonomy_service_mock
+    mock_session.post.side_effect = batch_endpoint_missing
     config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
     assert config.processing_order[0] == "hostTaxonId"
 
@@ -85,6 +96,7 @@ def test_host_processing_tax_id(mock_session: MagicMock) -> None:
 @patch.object(external_services.taxonomy_cache, "session")
 def test_host_processing_sci_name(mock_session: MagicMock) -> None:
     mock_session.get.side_effect = taxonomy_service_mock
+    mock_session.post.side_effect = batch_endpoint_missing
     config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
     assert config.processing_order[0] == "hostTaxonId"
 
@@ -146,6 +158,7 @@ def test_host_processing_invalid_host_insdc(mock_session: MagicMock) -> None:
     None, and a warning should be added explaining that host validation failed.
     """
     mock_session.get.return_value = make_response(404, {"detail": "not found"})
+    mock_session.post.side_effect = batch_endpoint_missing
     config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
 
     entry = make_entry(
@@ -174,6 +187,7 @@ def test_host_processing_invalid_host_direct(mock_session: MagicMock) -> None:
     validation failed.
     """
     mock_session.get.return_value = make_response(404, {"detail": "not found"})
+    mock_session.post.side_effect = batch_endpoint_missing
     config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
 
     entry = make_entry(
@@ -192,3 +206,162 @@ def test_host_processing_invalid_host_direct(mock_session: MagicMock) -> None:
     assert result[0].processed_entry.warnings == []
     assert len(result[0].processed_entry.errors) == 1
     assert "Host validation for" in result[0].processed_entry.errors[0].message
+
+
+TAXA: dict[int, dict[str, Any]] = {
+    7159: {
+        "tax_id": 7159,
+        "common_name": None,
+        "scientific_name": "Aedes aegypti",
+        "parent_id": 7158,
+        "depth": 28,
+    },
+    7158: {
+        "tax_id": 7158,
+        "common_name": "mosquitoes",
+        "scientific_name": "Aedes",
+        "parent_id": 1,
+        "depth": 27,
+    },
+    9606: {
+        "tax_id": 9606,
+        "common_name": "human",
+        "scientific_name": "Homo sapiens",
+        "parent_id": 1,
+        "depth": 31,
+    },
+    # Same name as 7159 but more specific, never selected
+    7160: {
+        "tax_id": 7160,
+        "common_name": None,
+        "scientific_name": "Aedes aegypti",
+        "parent_id": 7159,
+        "depth": 29,
+    },
+    # No ancestor with a common name
+    9999: {
+        "tax_id": 9999,
+        "common_name": None,
+        "scientific_name": "Nameless",
+        "parent_id": 1,
+        "depth": 1,
+    },
+}
+
+
+def by_name(name: str) -> list[dict[str, Any]]:
+    return [t for t in TAXA.values() if t["scientific_name"].lower() == name.lower()]
+
+
+def with_common_name(tax_id: int) -> dict[str, Any] | None:
+    taxon = TAXA.get(tax_id)
+    while taxon is not None and taxon["common_name"] is None:
+        taxon = TAXA.get(taxon["parent_id"])
+    return taxon
+
+
+def taxa_service_get(url: str, **kwargs):
+    """GET endpoints of the taxonomy service over TAXA"""
+    path, _, query = url.removeprefix("http://localhost:5000").partition("?")
+    if path == "/taxa":
+        name = query.removeprefix("scientific_name=").replace("+", " ")
+        taxa = by_name(name)
+        return make_response(200, taxa) if taxa else make_response(404, {"detail": "missing"})
+    tax_id = int(path.removeprefix("/taxa/"))
+    if tax_id not in TAXA:
+        return make_response(404, {"detail": f"'{tax_id}' not found"})
+    if query == "find_common_name=true":
+        taxon = with_common_name(tax_id)
+        if taxon is None:
+            return make_response(404, {"detail": "no common name"})
+        return make_response(200, taxon)
+    return make_response(200, TAXA[tax_id])
+
+
+def taxa_service_batch(url: str, json: dict, **kwargs):
+    """POST /taxa/batch of the taxonomy service over TAXA"""
+    names = {name: by_name(name) for name in json["scientific_names"] if by_name(name)}
+    tax_ids = {tax_id: TAXA[tax_id] for tax_id in json["tax_ids"] if tax_id in TAXA}
+    found = [*tax_ids.values(), *(t for taxa in names.values() for t in taxa)]
+    common_names = {
+        t["tax_id"]: with_common_name(t["tax_id"])
+        for t in found
+        if with_common_name(t["tax_id"]) is not None
+    }
+    return make_response(
+        200,
+        {"scientific_names": names, "tax_ids": tax_ids, "common_names": common_names},
+    )
+
+
+HOSTS = [
+    "Aedes aegypti",
+    "aedes aegypti",
+    "7159",
+    "07159",
+    "9606",
+    "9999",
+    "Nameless",
+    "nope",
+    "123",
+]
+
+
+def process_hosts(config, group_id: int) -> list:
+    entries = [
+        UnprocessedEntry(
+            accessionVersion=f"LOC_{i}.1",
+            data=make_entry({"host": host}, group_id).data,
+        )
+        for i, host in enumerate(HOSTS * 2)
+    ]
+    return [
+        (
+            result.processed_entry.data.metadata,
+            result.processed_entry.errors,
+            result.processed_entry.warnings,
+        )
+        for result in process_all(entries, "temp", config)
+    ]
+
+
+@pytest.mark.parametrize("insdc", [True, False])
+@patch.object(external_services.taxonomy_cache, "session")
+def test_batch_prefetch_matches_single_lookups(mock_session: MagicMock, insdc: bool) -> None:
+    config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
+    group_id = config.insdc_ingest_group_id + (0 if insdc else 1)
+    mock_session.get.side_effect = taxa_service_get
+
+    mock_session.post.side_effect = batch_endpoint_missing
+    single = process_hosts(config, group_id)
+    assert mock_session.get.call_count > len(set(HOSTS))
+
+    external_services.taxonomy_cache.clear()
+    mock_session.reset_mock()
+    mock_session.post.side_effect = taxa_service_batch
+    batched = process_hosts(config, group_id)
+
+    assert batched == single
+    assert mock_session.post.call_count == 1
+    assert mock_session.get.call_count == 0
+    request = mock_session.post.call_args.kwargs["json"]
+    assert sorted(request["scientific_names"]) == [
+        "Aedes aegypti",
+        "Nameless",
+        "aedes aegypti",
+        "nope",
+    ]
+    assert sorted(request["tax_ids"]) == [123, 7159, 9606, 9999]
+
+
+@patch.object(external_services.taxonomy_cache, "session")
+def test_batch_prefetch_skips_cached_hosts(mock_session: MagicMock) -> None:
+    config = get_config(HOST_PROCESSING_CONFIG, ignore_args=True)
+    mock_session.get.side_effect = taxa_service_get
+    mock_session.post.side_effect = taxa_service_batch
+
+    process_hosts(config, config.insdc_ingest_group_id)
+    process_hosts(config, config.insdc_ingest_group_id)
+
+    assert mock_session.post.call_count == 1
+    assert mock_session.get.call_count == 0
@@ -1,7 +1,10 @@
 # ruff: noqa: S101
-from dataclasses import dataclass, field
+import re
+from dataclasses import dataclass, field, replace
+from datetime import datetime
 from unittest import mock
 
+import dateutil.parser
 import pytest
 from factory_methods import (
     Case,
@@ -14,6 +17,7 @@ from factory_methods import (
     verify_processed_entry,
 )
 
+from loculus_preprocessing import prepro, processing_functions
 from loculus_preprocessing.config import Config, ProcessingSpec, get_config, get_processing_order
 from loculus_preprocessing.datatypes import (
     AnnotationSource,
@@ -23,13 +27,18 @@ from loculus_preprocessing.datatypes import (
     FunctionArgs,
     InputMetadata,
     ProcessedEntry,
+    ProcessingResult,
     UnprocessedData,
     UnprocessedEntry,
 )
 from loculus_preprocessing.prepro import process_all
 from loculus_preprocessing.processing_functions import (
     ProcessingFunctions,
+    current_time,
     format_authors,
+    now_snapshot,
+    parse_date,
+    parse_datetime,
     valid_authors,
 )
 
@@ -1082,6 +1091,21 @@ def test_processing_order() -> None:
     assert wrong_order.data.metadata["depends_on_A"] == "Asia/LOC_40.1"
 
 
+def test_processing_plan_is_reused_until_spec_is_replaced() -> None:
+    config = generate_config_with_deps()
+    plan = prepro.get_processing_plan(config)
+    assert prepro.get_processing_plan(config) is plan
+    assert [planned.output_field for planned in plan.fields] == list(config.processing_order)
+
+    config.processing_order = tuple(reversed(config.processing_order))
+    reordered = prepro.get_processing_plan(config)
+    assert reordered is not plan
+    assert [planned.output_field for planned in reordered.fields] == list(config.processing_order)
+
+    config.processing_spec = dict(config.processing_spec)
+    assert prepro.get_processing_plan(config) is not reordered
+
+
 def test_required_field_message_lists_only_user_input_fields() -> None:
     config = get_config(NO_ALIGNMENT_CONFIG, ignore_args=True)
     config.processing_spec.update(
@@ -1155,6 +1179,69 @@ def test_preprocessing_without_consensus_sequences(config: Config) -> None:
     assert processed_entry.data.aminoAcidInsertions == {}
 
 
+def test_process_all_in_worker_pool_matches_serial(
+    config: Config, factory_custom: ProcessedEntryFactory
+) -> None:
+    entries = [
+        test_case_def.create_test_case(factory_custom).input
+        for test_case_def in test_case_definitions
+    ]
+    pooled_config = config.model_copy(update={"processing_workers": 3})
+
+    serial = process_all(entries, "temp_dataset_dir", config)
+    pooled = process_all(entries, "temp_dataset_dir", pooled_config)
+
+    assert [result.processed_entry.accession for result in pooled] == [
+        entry.accessionVersion.split(".")[0] for entry in entries
+    ]
+    assert pooled == serial
+
+
+def test_process_all_in_worker_pool_isolates_failing_entries(
+    config: Config, factory_custom: ProcessedEntryFactory
+) -> None:
+    entries = [
+        test_case_def.create_test_case(factory_custom).input
+        for test_case_def in test_case_definitions[:4]
+    ]
+    failing = entries[1].accessionVersion
+    pooled_config = config.model_copy(update={"processing_workers": 2})
+    # Workers do not see mocks of the main process, so make the entry itself fail to process
+    data = replace(entries[1].data, metadata=None)  # type: ignore[arg-type]
+    entries[1] = replace(entries[1], data=data)
+
+    results = process_all(entries, "temp_dataset_dir", pooled_config)
+
+    assert len(results) == len(entries)
+    for entry, result in zip(entries, results, strict=True):
+        failed = entry.accessionVersion == failing
+        assert (result.processed_entry.data.metadata == {}) == failed
+        assert (
+            any(
+                "Failed to process submission" in error.message
+                for error in result.processed_entry.errors
+            )
+            == failed
+        )
+
+
+def test_process_all_reuses_worker_pool_across_batches(
+    config: Config, factory_custom: ProcessedEntryFactory
+) -> None:
+    entries = [
+        test_case_def.create_test_case(factory_custom).input
+        for test_case_def in test_case_definitions[:4]
+    ]
+    pooled_config = config.model_copy(update={"processing_workers": 2})
+
+    process_all(entries, "temp_dataset_dir", pooled_config)
+    pool = prepro._processing_pool
+    process_all(entries, "temp_dataset_dir", pooled_config)
+
+    assert pool is not None
+    assert prepro._processing_pool is pool
+
+
 def test_valid_authors() -> None:
     for author in accepted_authors:
         if valid_authors(author) is not True:
@@ -1820,5 +1907,101 @@ def test_call_function_converts_raw_errors_to_annotations() -> None:
     )
 
 
+DATE_STRINGS = [
+    "2021-12-03",
+    "2021-12",
+    "2021",
+    "2021-02-30",
+    "2021-13",
+    "21-12-03",
+    " 2021-12-03",
+    "2099-01-01",
+    "[2020-01 TO 2021-03-05]",
+    "2021-03/2020",
+    "2022-11-01T00:00:00Z",
+    "Nov 2022",
+    "not a date",
+    "",
+]
+
+
+def date_function_results() -> list[ProcessingResult]:
+    args: FunctionArgs = {"submittedAt": ts_from_ymd(2022, 12, 15)}
+    calls: list[tuple[str, InputMetadata, FunctionArgs]] = []
+    for date in DATE_STRINGS:
+        for release_date in ("", "2021-06-01", "not a date"):
+            calls.extend(
+                (
+                    "parse_date_into_range",
+                    {"date": date, "releaseDate": release_date},
+                    args | {"fieldType": field_type},
+                )
+                for field_type in ("dateRangeString", "dateRangeLower", "dateRangeUpper")
+            )
+            calls.append(
+                ("parse_and_assert_past_date", {"date": date, "release_date": release_date}, args)
+            )
+        calls.extend(
+            (
+                ("check_date", {"date": date}, args),
+                ("parse_timestamp", {"timestamp": date}, args),
+            )
+        )
+    return [
+        ProcessingFunctions.call_function(function, args, input_data, "field", ["field"])
+        for function, input_data, args in calls
+    ]
+
+
+def test_cached_date_parsing_matches_uncached_parsing() -> None:
+    formats = ("%Y-%m-%d", "%Y-%m", "%Y")
+    for date in DATE_STRINGS:
+        expected: tuple[str, datetime] | str = ""
+        for fmt in formats:
+            try:
+                expected = (fmt, datetime.strptime(date, fmt))  # noqa: DTZ007
+                break
+            except ValueError as e:
+                expected = str(e)
+        if isinstance(expected, str):
+            with pytest.raises(ValueError, match=re.escape(expected)):
+                parse_date(date, formats)
+        else:
+            assert parse_date(date, formats) == expected
+
+        try:
+            expected_datetime: datetime | None = dateutil.parser.parse(date)
+        except ValueError:
+            expected_datetime = None
+        assert parse_datetime(date) == expected_datetime
+
+    with now_snapshot():
+        with (
+            mock.patch.object(
+                processing_functions,
+                "_cached_strptime_first",
+                processing_functions._strptime_first,
+            ),
+            mock.patch.object(
+                processing_functions,
+                "_cached_dateutil_parse",
+                processing_functions._cached_dateutil_parse.__wrapped__,
+            ),
+        ):
+            uncached = date_function_results()
+        cached = date_function_results()
+        cached_again = date_function_results()
+    assert cached == uncached
+    assert cached_again == uncached
+
+
+def test_now_snapshot_fixes_current_time() -> None:
+    with now_snapshot() as now:
+        assert current_time() is now
+        assert current_time() is now
+    assert current_time() is not now
+    assert current_time() >= now
+
+
 if __name__ == "__main__":
     pytest.main()
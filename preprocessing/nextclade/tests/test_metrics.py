@@ -0,0 +1,67 @@
+# ruff: noqa: S101
+
+import json
+import logging
+
+import pytest
+
+from loculus_preprocessing.metrics import Metrics, StageStats
+
+
+def test_stage_records_time_and_items_also_on_error() -> None:
+    metrics = Metrics()
+    with metrics.stage("nextclade_run", items=3, dataset="L"):
+        pass
+    with pytest.raises(ValueError, match="boom"), metrics.stage("submit") as stage:
+        stage.items = 5
+        msg = "boom"
+        raise ValueError(msg)
+
+    totals = metrics.totals()
+    assert totals["nextclade_run", (("dataset", "L"),)].items == 3  # noqa: PLR2004
+    assert totals["submit", ()].items == 5  # noqa: PLR2004
+    assert all(stats.calls == 1 and stats.seconds >= 0 for stats in totals.values())
+
+
+def test_render_prometheus() -> None:
+    metrics = Metrics()
+    metrics.record("fetch", 0.5, 10)
+    metrics.record("fetch", 0.25, 5)
+    metrics.record("nextclade_run", 2.0, 15, dataset="S")
+
+    rendered = metrics.render_prometheus().splitlines()
+
+    assert "# TYPE loculus_preprocessing_stage_seconds_total counter" in rendered
+    assert 'loculus_preprocessing_stage_seconds_total{stage="fetch"} 0.75' in rendered
+    assert 'loculus_preprocessing_stage_items_total{stage="fetch"} 15' in rendered
+    assert (
+        'loculus_preprocessing_stage_calls_total{stage="nextclade_run",dataset="S"} 1' in rendered
+    )
+
+
+def test_log_summary_reports_window_and_respects_interval(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    metrics = Metrics()
+    metrics.record("metadata_processing", 2.0, 100)
+
+    with caplog.at_level(logging.INFO, logger="loculus_preprocessing.metrics"):
+        metrics.log_summary(min_interval_seconds=3600)
+        assert not caplog.records
+        metrics.log_summary()
+        metrics.log_summary()
+
+    assert len(caplog.records) == 1
+    summary = json.loads(caplog.records[0].getMessage().removeprefix("Stage metrics: "))
+    assert summary["stages"] == [
+        {
+            "stage": "metadata_processing",
+            "calls": 1,
+            "items": 100,
+            "seconds": 2.0,
+            "items_per_second": 50.0,
+        }
+    ]
+    assert metrics.totals()["metadata_processing", ()] == StageStats(
+        calls=1, items=100, seconds=2.0
+    )
@@ -0,0 +1,128 @@
+# ruff: noqa: S101
+
+from pathlib import Path
+from unittest.mock import patch
+
+from loculus_preprocessing import nextclade_cache
+from loculus_preprocessing.nextclade_cache import CachedNextcladeResult, NextcladeResultCache
+
+FINGERPRINT = "dataset-fingerprint"
+
+
+def make_result(sequence: str) -> CachedNextcladeResult:
+    return CachedNextcladeResult(
+        nextclade_metadata={"seqName": "LOC_1.1", "alignmentScore": 42, "qc": {"score": 0}},
+        aligned_nucleotide_sequence=sequence,
+        nucleotide_insertions=["10:ACG"],
+        aligned_amino_acid_sequences={"NP": "MXXK", "VP35": None},
+        amino_acid_insertions={"NP": ["4:K"]},
+    )
+
+
+def test_cache_round_trip(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    key = cache.key("ACGT", FINGERPRINT)
+
+    assert cache.get(key) is None
+    cache.put(key, make_result("ACGT"))
+
+    assert cache.get(key) == make_result("ACGT")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_persists_across_instances(tmp_path: Path) -> None:
+    key = NextcladeResultCache.key("ACGT", FINGERPRINT)
+    NextcladeResultCache(str(tmp_path), max_size_bytes=10**6).put(key, make_result("ACGT"))
+
+    assert NextcladeResultCache(str(tmp_path), max_size_bytes=10**6).get(key) == make_result("ACGT")
+
+
+def test_cache_key_depends_on_sequence_and_dataset() -> None:
+    key = NextcladeResultCache.key("ACGT", FINGERPRINT)
+
+    assert key == NextcladeResultCache.key("ACGT", FINGERPRINT)
+    assert key != NextcladeResultCache.key("ACGA", FINGERPRINT)
+    assert key != NextcladeResultCache.key("ACGT", "other-dataset")
+
+
+def test_dataset_fingerprint_changes_with_dataset_version(tmp_path: Path) -> None:
+    (tmp_path / "pathogen.json").write_text('{"version": {"tag": "1"}}')
+    first = NextcladeResultCache.dataset_fingerprint('{"name": "main"}', str(tmp_path))
+    (tmp_path / "pathogen.json").write_text('{"version": {"tag": "2"}}')
+    second = NextcladeResultCache.dataset_fingerprint('{"name": "main"}', str(tmp_path))
+
+    assert first != second
+
+
+def test_cache_caches_failed_alignments(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    key = cache.key("NNNN", FINGERPRINT)
+    cache.put(key, CachedNextcladeResult(nextclade_metadata=None))
+
+    assert cache.get(key) == CachedNextcladeResult(nextclade_metadata=None)
+
+
+def test_cache_evicts_least_recently_used_entries(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    keys = [cache.key(str(i), FINGERPRINT) for i in range(3)]
+    for key in keys:
+        cache.put(key, make_result("ACGT" * 100))
+    entry_size = next(tmp_path.glob("*/*.json.gz")).stat().st_size
+
+    small_cache = NextcladeResultCache(str(tmp_path), max_size_bytes=int(entry_size * 2.5))
+    small_cache.get(keys[0])
+    small_cache.put(cache.key("3", FINGERPRINT), make_result("ACGT" * 100))
+
+    assert small_cache.get(keys[0]) is not None
+    assert len(list(tmp_path.glob("*/*.json.gz"))) == 2  # noqa: PLR2004
+
+
+def test_cache_evicts_writes_of_other_replicas(tmp_path: Path) -> None:
+    replicas = [NextcladeResultCache(str(tmp_path), max_size_bytes=10**6) for _ in range(2)]
+    replicas[0].put(replicas[0].key("0", FINGERPRINT), make_result("ACGT" * 100))
+    entry_size = next(tmp_path.glob("*/*.json.gz")).stat().st_size
+    for replica in replicas:
+        replica.max_size_bytes = int(entry_size * 2.5)
+
+    with patch.object(nextclade_cache, "INDEX_MAX_AGE_SECONDS", 0):
+        for i in range(1, 6):
+            replica = replicas[i % 2]
+            replica.put(replica.key(str(i), FINGERPRINT), make_result("ACGT" * 100))
+
+    assert len(list(tmp_path.glob("*/*.json.gz"))) == 2  # noqa: PLR2004
+
+
+def test_failing_utime_keeps_entry(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    key = cache.key("ACGT", FINGERPRINT)
+    cache.put(key, make_result("ACGT"))
+
+    with patch.object(nextclade_cache.os, "utime", side_effect=PermissionError("read-only")):
+        assert cache.get(key) == make_result("ACGT")
+    assert cache.get(key) == make_result("ACGT")
+
+
+def test_failed_put_leaves_no_temporary_file(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    key = cache.key("ACGT", FINGERPRINT)
+
+    with patch.object(nextclade_cache.os, "replace", side_effect=OSError("disk full")):
+        cache.put(key, make_result("ACGT"))
+
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == []
+    assert cache.get(key) is None
+
+
+def test_read_only_cache_does_not_raise(tmp_path: Path) -> None:
+    cache = NextcladeResultCache(str(tmp_path), max_size_bytes=10**6)
+    key = cache.key("ACGT", FINGERPRINT)
+    cache.put(key, make_result("ACGT"))
+    path = next(tmp_path.rglob(f"*{nextclade_cache.CACHE_FILE_SUFFIX}"))
+    path.write_text("not gzip")
+
+    with (
+        patch.object(Path, "mkdir", side_effect=PermissionError("read-only")),
+        patch.object(Path, "unlink", side_effect=PermissionError("read-only")),
+    ):
+        assert cache.get(key) is None
+        cache.put(cache.key("TTTT", FINGERPRINT), make_result("TTTT"))
@@ -1,6 +1,8 @@
 # ruff: noqa: S101
 
 
+import json
+from collections import defaultdict
 from pathlib import Path
 from typing import Literal
 
@@ -21,8 +23,13 @@ from factory_methods import (
 from loculus_preprocessing.config import (
     AlignmentRequirement,
     Config,
+    NestedPath,
+    NextcladeSequenceAndDataset,
+    ProcessingSpec,
+    build_projection,
     get_config,
     get_processing_order,
+    project,
 )
 from loculus_preprocessing.datatypes import (
     AnnotationSourceType,
@@ -32,7 +39,16 @@ from loculus_preprocessing.datatypes import (
     UnprocessedEntry,
 )
 from loculus_preprocessing.embl import create_flatfile, reformat_authors_from_loculus_to_embl_style
-from loculus_preprocessing.prepro import get_nested_metadata, process_all
+from loculus_preprocessing.nextclade import (
+    load_aligned_aa_sequences,
+    load_aligned_nuc_sequences,
+    nextclade_input_id,
+    nextclade_projection,
+    parse_nextclade_json,
+    parse_nextclade_tsv,
+    split_jobs,
+)
+from loculus_preprocessing.prepro import process_all
 from loculus_preprocessing.processing_functions import (
     format_frameshift,
     format_stop_codon,
@@ -59,7 +75,7 @@ MUTATIONS_FROM_FOUNDER_CLADE = "tests/mutationsFromFounderClade.json"
 LABELED_PRIVATE_MUTATIONS = "tests/labeledPrivateMutations.json"
 
 
-def test_get_nested_metadata_uses_simple_dot_paths():
+def test_nested_path_uses_simple_dot_paths():
     metadata = {
         "coverage": 0.98,
         "qc": {"stopCodons": {"totalStopCodons": 0, "stopCodons": []}},
@@ -68,17 +84,21 @@ def test_get_nested_metadata_uses_simple_dot_paths():
         },
     }
 
-    assert get_nested_metadata(metadata, "coverage") == 0.98
-    assert get_nested_metadata(metadata, "qc.stopCodons.totalStopCodons") == 0
-    assert get_nested_metadata(metadata, "qc.stopCodons.stopCodons") == []
-    assert get_nested_metadata(metadata, "cladeFounderInfo.aaMutations") == [
+    assert NestedPath("coverage")(metadata) == 0.98
+    assert NestedPath("qc.stopCodons.totalStopCodons")(metadata) == 0
+    assert NestedPath("qc.stopCodons.stopCodons")(metadata) == []
+    assert NestedPath("cladeFounderInfo.aaMutations")(metadata) == [
         {"privateSubstitutions": ["NS1:Y35H"]},
     ]
-    assert get_nested_metadata(metadata, "qc.missing.total") is None
-    assert get_nested_metadata(metadata, "coverage.value") is None
+    assert NestedPath("qc.missing.total")(metadata) is None
+    assert NestedPath("coverage.value")(metadata) is None
 
     metadata_with_zero = {"qc": {"score": 0}}
-    assert get_nested_metadata(metadata_with_zero, "qc.score") == 0
+    assert NestedPath("qc.score")(metadata_with_zero) == 0
+
+    assert NestedPath("cladeFounderInfo.aaMutations.*.privateSubstitutions")(metadata) == [
+        {"privateSubstitutions": ["NS1:Y35H"]},
+    ]
 
 
 def consensus_sequence(
@@ -1694,5 +1714,134 @@ def test_preprocessing_multi_segment_multi_reference(test_case_def: Case):
     )
 
 
+def test_split_jobs_proportional_to_sequence_counts():
+    assert split_jobs({"L": 60, "M": 30, "S": 10}, 8) == {"L": 4, "M": 3, "S": 1}
+    assert split_jobs({"L": 1, "M": 1}, 8) == {"L": 4, "M": 4}
+    total_jobs = 16
+    assert sum(split_jobs({"a": 7, "b": 5, "c": 3}, total_jobs).values()) == total_jobs
+
+
+def test_split_jobs_gives_every_dataset_at_least_one_job():
+    assert split_jobs({"L": 100, "M": 1, "S": 1}, 4) == {"L": 2, "M": 1, "S": 1}
+    assert split_jobs({"L": 5, "M": 5, "S": 5}, 2) == {"L": 1, "M": 1, "S": 1}
+    assert split_jobs({}, 8) == {}
+
+
+def test_nextclade_projection_keeps_only_referenced_subtrees():
+    config = get_config(SINGLE_SEGMENT_CONFIG, ignore_args=True)
+    config.processing_spec["stopCodons"] = ProcessingSpec(
+        inputs={"input": "nextclade.qc.stopCodons.stopCodons"}
+    )
+    config.processing_spec["cladeFounder"] = ProcessingSpec(
+        inputs={"input": "nextclade.cladeFounderInfo.aaMutations.*.privateSubstitutions"}
+    )
+    config = Config(**config.model_dump())
+    result = {
+        "seqName": "LOC_1.1",
+        "totalSubstitutions": 3,
+        "qc": {"stopCodons": {"stopCodons": [], "score": 0}, "overallScore": 1},
+        "cladeFounderInfo": {"aaMutations": [], "nucMutations": []},
+        "annotation": {"genes": []},
+    }
+
+    projection = nextclade_projection(config)
+
+    assert "annotation" not in projection
+    assert project(result, projection) == {
+        "totalSubstitutions": 3,
+        "qc": {"stopCodons": {"stopCodons": []}},
+        "cladeFounderInfo": {"aaMutations": []},
+    }
+    config.create_embl_file = True
+    assert project(result, nextclade_projection(config))["annotation"] == {"genes": []}
+
+
+def test_build_projection_prefix_path_keeps_whole_subtree():
+    assert build_projection([("qc", "score"), ("qc",), ("a", "b", "c"), ("a", "b", "d")]) == {
+        "qc": None,
+        "a": {"b": {"c": None, "d": None}},
+    }
+
+
+def test_parse_nextclade_json_streams_ndjson_and_keeps_referenced_fields(tmp_path: Path):
+    records = [
+        {"index": 0, "seqName": "LOC_1.1", "qc": {"overallScore": 1}, "annotation": {"genes": []}},
+        {"index": 1, "seqName": "LOC_2.1", "errors": ["Unable to align: too many mismatches"]},
+    ]
+    (tmp_path / "nextclade.ndjson").write_text(
+        "\n".join(json.dumps(record) for record in records) + "\n", encoding="utf-8"
+    )
+    unaligned: dict[str, dict[str, str | None]] = {
+        "LOC_1.1": {"main": "ACGT"},
+        "LOC_2.1": {"main": "NNNN"},
+        "LOC_3.1": {},
+    }
+
+    nextclade_metadata = parse_nextclade_json(
+        str(tmp_path),
+        defaultdict(lambda: defaultdict(dict)),
+        "main",
+        unaligned,
+        projection={"qc": None},
+    )
+
+    assert nextclade_metadata["LOC_1.1"]["main"] == {
+        "seqName": "LOC_1.1",
+        "qc": {"overallScore": 1},
+    }
+    assert nextclade_metadata["LOC_2.1"]["main"] is None
+    assert "main" not in nextclade_metadata["LOC_3.1"]
+
+
+def test_classification_results_are_mapped_to_assigned_accessions(tmp_path: Path):
+    """Results of the ALIGN classification run (named <accession>__<fasta id>) are reused for
+    the sequences assigned to the dataset and skipped for all other candidates."""
+    assigned = nextclade_input_id("LOC_1.1", "seg_l")
+    not_assigned = nextclade_input_id("LOC_2.1", "seg_s")
+    seq_ids = {assigned: "LOC_1.1"}
+    (tmp_path / "nextclade.ndjson").write_text(
+        f'{{"seqName": "{assigned}", "qc": {{"overallScore": 1}}}}\n'
+        f'{{"seqName": "{not_assigned}", "qc": {{"overallScore": 99}}}}\n',
+        encoding="utf-8",
+    )
+    (tmp_path / "nextclade.aligned.fasta").write_text(
+        f">{assigned}\n--ACGT-\n>{not_assigned}\nTTTT\n", encoding="utf-8"
+    )
+    (tmp_path / "nextclade.cds_translation.L.fasta").write_text(
+        f">{assigned}\nMK-\n>{not_assigned}\nMM\n", encoding="utf-8"
+    )
+    (tmp_path / "nextclade.tsv").write_text(
+        f"seqName\tinsertions\taaInsertions\n{assigned}\t5:A\tL:2:K\n{not_assigned}\t7:C\t\n",
+        encoding="utf-8",
+    )
+    dataset = NextcladeSequenceAndDataset(name="L", genes=["L"])
+
+    nextclade_metadata = parse_nextclade_json(
+        str(tmp_path),
+        defaultdict(lambda: defaultdict(dict)),
+        "L",
+        {"LOC_1.1": {"L": "ACGT"}},
+        projection={"qc": None},
+        seq_ids=seq_ids,
+    )
+    aligned = load_aligned_nuc_sequences(str(tmp_path), "L", defaultdict(dict), seq_ids)
+    translations = load_aligned_aa_sequences(str(tmp_path), dataset, defaultdict(dict), seq_ids)
+    aa_insertions, nuc_insertions = parse_nextclade_tsv(
+        defaultdict(lambda: defaultdict(list)),
+        defaultdict(lambda: defaultdict(list)),
+        str(tmp_path),
+        dataset,
+        seq_ids,
+    )
+
+    assert dict(nextclade_metadata) == {
+        "LOC_1.1": {"L": {"seqName": "LOC_1.1", "qc": {"overallScore": 1}}}
+    }
+    assert dict(aligned) == {"LOC_1.1": {"L": "NNACGTN"}}
+    assert dict(translations) == {"LOC_1.1": {"L": "MKX"}}
+    assert dict(nuc_insertions) == {"LOC_1.1": {"L": ["5:A"]}}
+    assert dict(aa_insertions) == {"LOC_1.1": {"L": ["2:K"]}}
+
+
 if __name__ == "__main__":
     pytest.main()
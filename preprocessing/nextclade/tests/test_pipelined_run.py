@@ -0,0 +1,106 @@
+# ruff: noqa: S101
+
+from unittest.mock import patch
+
+import pytest
+
+from loculus_preprocessing.config import Config
+from loculus_preprocessing.prepro import IdleBackoff, run_pipelined
+
+
+class FetchExhaustedError(Exception):
+    pass
+
+
+def make_fetch(batches: list[list[str]]):
+    remaining = list(batches)
+
+    def fetch(etag, config, batch_size=None):
+        if not remaining:
+            raise FetchExhaustedError
+        return None, remaining.pop(0)
+
+    return fetch
+
+
+def fake_process_all(unprocessed, dataset_dir, config):
+    return [f"processed-{entry}" for entry in unprocessed]
+
+
+def test_pipelined_run_submits_batches_in_order_before_raising_fetch_error() -> None:
+    submitted: list[list[str]] = []
+    config = Config(pipelined=True, prefetch_batches=2, submit_queue_size=1)
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.fetch_unprocessed_sequences",
+            side_effect=make_fetch([["a", "b"], ["c"], ["d"]]),
+        ),
+        patch("loculus_preprocessing.prepro.process_all", side_effect=fake_process_all),
+        patch(
+            "loculus_preprocessing.prepro.submit_batch",
+            side_effect=lambda processed, dataset_dir, config: submitted.append(processed),
+        ),
+        pytest.raises(FetchExhaustedError),
+    ):
+        run_pipelined("dataset_dir", config)
+
+    assert submitted == [["processed-a", "processed-b"], ["processed-c"], ["processed-d"]]
+
+
+def test_pipelined_run_skips_batch_when_processing_fails() -> None:
+    submitted: list[list[str]] = []
+    config = Config(pipelined=True)
+
+    def process_all(unprocessed, dataset_dir, config):
+        if unprocessed == ["bad"]:
+            msg = "boom"
+            raise RuntimeError(msg)
+        return fake_process_all(unprocessed, dataset_dir, config)
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.fetch_unprocessed_sequences",
+            side_effect=make_fetch([["a"], ["bad"], ["c"]]),
+        ),
+        patch("loculus_preprocessing.prepro.process_all", side_effect=process_all),
+        patch(
+            "loculus_preprocessing.prepro.submit_batch",
+            side_effect=lambda processed, dataset_dir, config: submitted.append(processed),
+        ),
+        pytest.raises(FetchExhaustedError),
+    ):
+        run_pipelined("dataset_dir", config)
+
+    assert submitted == [["processed-a"], ["processed-c"]]
+
+
+def test_pipelined_run_raises_submit_error() -> None:
+    config = Config(pipelined=True)
+
+    def submit_batch(processed, dataset_dir, config):
+        msg = "backend unavailable"
+        raise ConnectionError(msg)
+
+    with (
+        patch(
+            "loculus_preprocessing.prepro.fetch_unprocessed_sequences",
+            side_effect=lambda etag, config, batch_size=None: (None, ["a"]),
+        ),
+        patch("loculus_preprocessing.prepro.process_all", side_effect=fake_process_all),
+        patch("loculus_preprocessing.prepro.submit_batch", side_effect=submit_batch),
+        pytest.raises(ConnectionError, match="backend unavailable"),
+    ):
+        run_pipelined("dataset_dir", config)
+
+
+def test_idle_backoff_doubles_up_to_maximum_and_resets() -> None:
+    backoff = IdleBackoff(Config(idle_poll_interval_seconds=1, max_idle_poll_interval_seconds=5))
+
+    with patch("loculus_preprocessing.prepro.time.sleep") as sleep:
+        for _ in range(5):
+            backoff.wait()
+        backoff.reset()
+        backoff.wait()
+
+    assert [call.args[0] for call in sleep.call_args_list] == [1, 2, 4, 5, 5, 1]
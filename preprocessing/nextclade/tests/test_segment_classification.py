@@ -0,0 +1,192 @@
+# ruff: noqa: S101
+import csv
+import math
+import random
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from factory_methods import UnprocessedEntryFactory
+
+from loculus_preprocessing.config import get_config
+from loculus_preprocessing.datatypes import SegmentClassificationMethod
+from loculus_preprocessing.nextclade import (
+    BestHits,
+    NextcladeRun,
+    assign_segment_with_diamond,
+    assign_segment_with_nextclade_align,
+    assign_segment_with_nextclade_sort,
+    nextclade_input_id,
+)
+
+MULTI_SEGMENT_CONFIG = "tests/multi_segment_config.yaml"
+
+# (seqName, dataset, score) rows with ties, missing and non-finite scores
+HITS = [
+    ("a", "ebola-sudan", "0.5"),
+    ("a", "ebola-zaire", "0.9"),
+    ("a", "other", "0.9"),
+    ("b", "other", ""),
+    ("b", "ebola-zaire", "NaN"),
+    ("c", "ebola-zaire", "-1"),
+    ("c", "ebola-sudan", "-inf"),
+    ("d", "ebola-sudan", "3"),
+    ("d", "other", "3.0"),
+    ("d", "ebola-zaire", "1e10"),
+    ("d", "ebola-sudan", "1E10"),
+]
+
+
+def sorted_best_hits(hits: list[tuple[str, str, str]]) -> dict[str, str]:
+    """The dropna -> stable sort by descending score -> groupby().first() semantics the reducer
+    replaced"""
+    scored = [hit for hit in hits if hit[2] and not math.isnan(float(hit[2]))]
+    best: dict[str, str] = {}
+    for seq_id, dataset, _ in sorted(scored, key=lambda hit: (hit[0], -float(hit[2]))):
+        best.setdefault(seq_id, dataset)
+    return best
+
+
+def reduce(hits: list[tuple[str, str, str]]) -> BestHits:
+    best_hits = BestHits()
+    for hit in hits:
+        best_hits.add(*hit)
+    return best_hits
+
+
+def test_best_hits_keep_first_of_equal_scores() -> None:
+    best_hits = reduce(HITS)
+
+    assert best_hits.datasets == {"a": "ebola-zaire", "c": "ebola-zaire", "d": "ebola-zaire"}
+    assert best_hits.seen == {"a", "b", "c", "d"}
+    assert best_hits.datasets == sorted_best_hits(HITS)
+
+
+def test_best_hits_match_sorted_reference_on_random_hits() -> None:
+    rng = random.Random(7)  # noqa: S311
+    for _ in range(200):
+        hits = [
+            (
+                rng.choice("abcde"),
+                rng.choice(["ebola-sudan", "ebola-zaire", "other"]),
+                rng.choice(["", "nan", "0", "0.25", "0.5", "0.50", "1", "-2"]),
+            )
+            for _ in range(rng.randint(0, 30))
+        ]
+
+        assert reduce(hits).datasets == sorted_best_hits(hits)
+
+
+def write_tsv(path: Path, header: list[str] | None, rows: list[list[str]]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        if header:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+
+def make_batch():
+    entries = [
+        UnprocessedEntryFactory.create_unprocessed_entry(
+            {}, str(i), {"seg1": "ACGT", "seg2": "ACGT"}
+        )
+        for i in range(3)
+    ]
+    # (entry, fasta id) -> [(dataset, score)] per classifier row, in output order
+    hits = {
+        (0, "seg1"): [("ebola-sudan", "0.8"), ("ebola-zaire", "0.2")],
+        (0, "seg2"): [("ebola-zaire", "0.5"), ("ebola-sudan", "0.5")],
+        (1, "seg1"): [("ebola-sudan", ""), ("ebola-zaire", "")],
+        (1, "seg2"): [("ebola-sudan", "0.1"), ("ebola-zaire", "0.7")],
+        (2, "seg1"): [("ebola-sudan", "0.5"), ("ebola-zaire", "0.5")],
+        (2, "seg2"): [("ebola-zaire", "0.5"), ("ebola-sudan", "0.5")],
+    }
+    rows = [
+        (nextclade_input_id(entries[i].accessionVersion, fasta_id), dataset, score)
+        for (i, fasta_id), dataset_hits in hits.items()
+        for dataset, score in dataset_hits
+    ]
+    return entries, rows
+
+
+def check_assignment(batch, entries) -> None:
+    first, second, third = (entry.accessionVersion for entry in entries)
+    assert batch.sequenceNameToFastaId[first] == {"ebola-sudan": "seg1", "ebola-zaire": "seg2"}
+    assert not batch.alerts[first].errors
+    # seg1 has no scored hit
+    assert batch.sequenceNameToFastaId[second] == {"ebola-zaire": "seg2"}
+    assert len(batch.alerts[second].errors) == 1
+    assert "fasta id seg1 does not match any reference" in batch.alerts[second].errors[0].message
+    # Both sequences tie between the datasets and resolve to the first hit of each
+    assert batch.sequenceNameToFastaId[third] == {"ebola-sudan": "seg1", "ebola-zaire": "seg2"}
+
+
+@pytest.mark.parametrize(
+    "method", [SegmentClassificationMethod.MINIMIZER, SegmentClassificationMethod.DIAMOND]
+)
+def test_assign_segment_from_classifier_output(
+    method: SegmentClassificationMethod, tmp_path: Path
+) -> None:
+    config = get_config(MULTI_SEGMENT_CONFIG, ignore_args=True)
+    config.segment_classification_method = method
+    entries, rows = make_batch()
+
+    def run_classifier(args, check):
+        if method == SegmentClassificationMethod.MINIMIZER:
+            result_file = args[args.index("--output-results-tsv") + 1]
+            header = ["index", "score", "seqName", "dataset"]
+            tsv_rows = [
+                [str(i), score, seq, dataset] for i, (seq, dataset, score) in enumerate(rows)
+            ]
+        else:
+            result_file = args[args.index("--out") + 1]
+            header = None
+            tsv_rows = [
+                [seq, f"{dataset}|CDS{i}", score or "0", *["0"] * 9]
+                for i, (seq, dataset, score) in enumerate(rows)
+                if score
+            ]
+        write_tsv(Path(result_file), header, tsv_rows)
+        return type("CompletedProcess", (), {"returncode": 0})()
+
+    with patch("loculus_preprocessing.nextclade.subprocess.run", side_effect=run_classifier):
+        if method == SegmentClassificationMethod.MINIMIZER:
+            batch = assign_segment_with_nextclade_sort(entries, config, str(tmp_path))
+        else:
+            batch = assign_segment_with_diamond(entries, config, str(tmp_path))
+
+    check_assignment(batch, entries)
+
+
+def test_assign_segment_with_nextclade_align(tmp_path: Path) -> None:
+    config = get_config(MULTI_SEGMENT_CONFIG, ignore_args=True)
+    config.segment_classification_method = SegmentClassificationMethod.ALIGN
+    entries, rows = make_batch()
+    names = [dataset.name for dataset in config.nextclade_sequence_and_datasets]
+    assert names == ["ebola-sudan", "ebola-zaire"]
+
+    def run_nextclade(runs: list[NextcladeRun], dataset_dir, config) -> None:
+        for run in runs:
+            write_tsv(
+                Path(run.result_dir) / "nextclade.tsv",
+                ["index", "seqName", "alignmentScore"],
+                [
+                    [str(i), seq, score]
+                    for i, (seq, dataset, score) in enumerate(rows)
+                    if dataset == run.name
+                ],
+            )
+
+    with patch("loculus_preprocessing.nextclade.run_nextclade", side_effect=run_nextclade):
+        batch = assign_segment_with_nextclade_align(entries, config, str(tmp_path))
+
+    first, second, third = (entry.accessionVersion for entry in entries)
+    # Hits are read dataset by dataset, so on equal scores the dataset listed first wins and
+    # both sequences of the first and third entry are assigned to ebola-sudan
+    for accession_version in (first, third):
+        assert batch.sequenceNameToFastaId[accession_version] == {}
+        assert "Multiple sequences (with fasta ids: seg1, seg2) align to ebola-sudan" in str(
+            batch.alerts[accession_version].errors
+        )
+    assert batch.sequenceNameToFastaId[second] == {"ebola-zaire": "seg2"}
@@ -0,0 +1,73 @@
+# ruff: noqa: S101
+
+import random
+from typing import Literal
+
+import pytest
+
+from loculus_preprocessing.nextclade import mask_terminal_gaps
+from loculus_preprocessing.sequence_checks import (
+    UNALIGNED_NUCLEOTIDE_SYMBOLS,
+    errors_if_non_iupac,
+    non_iupac_symbols,
+)
+
+
+def reference_mask_terminal_gaps(sequence: str, mask_char: str = "N") -> str:
+    """Straightforward character-by-character implementation used as oracle"""
+    start = 0
+    while start < len(sequence) and sequence[start] == "-":
+        start += 1
+    end = len(sequence)
+    while end > start and sequence[end - 1] == "-":
+        end -= 1
+    return mask_char * start + sequence[start:end] + mask_char * (len(sequence) - end)
+
+
+@pytest.mark.parametrize(
+    "sequence",
+    ["", "-", "---", "A", "ACGT", "--ACGT", "ACGT--", "--AC--GT--", "-A-", "AC-GT"],
+)
+@pytest.mark.parametrize("mask_char", ["N", "X"])
+def test_mask_terminal_gaps_matches_reference(sequence: str, mask_char: Literal["N", "X"]) -> None:
+    assert mask_terminal_gaps(sequence, mask_char) == reference_mask_terminal_gaps(
+        sequence, mask_char
+    )
+
+
+def test_mask_terminal_gaps_matches_reference_on_random_sequences() -> None:
+    rng = random.Random(0)  # noqa: S311
+    for _ in range(500):
+        sequence = "".join(rng.choices("AC-", k=rng.randint(0, 30)))
+        assert mask_terminal_gaps(sequence) == reference_mask_terminal_gaps(sequence)
+
+
+def test_mask_terminal_gaps_rejects_invalid_mask_char() -> None:
+    with pytest.raises(ValueError, match="mask_char"):
+        mask_terminal_gaps("--A", "Z")  # type: ignore[arg-type]
+
+
+@pytest.mark.parametrize(
+    ("sequence", "expected"),
+    [
+        ("ACGTRYKMSWBDHVN", set()),
+        ("acgtrykmswbdhvn", set()),
+        ("ACGT-", {"-"}),
+        ("ACGuX", {"U", "X"}),
+        ("ACG T\n", {" ", "\n"}),
+        ("ACGTé", {"É"}),
+    ],
+)
+def test_non_iupac_symbols(sequence: str, expected: set[str]) -> None:
+    assert non_iupac_symbols(sequence) == expected
+    assert non_iupac_symbols(sequence) == set(sequence.upper()) - UNALIGNED_NUCLEOTIDE_SYMBOLS
+
+
+def test_errors_if_non_iupac_reports_gaps() -> None:
+    errors = errors_if_non_iupac({"main": "AC-GT", "other": "ACGT", "missing": None})
+
+    assert len(errors) == 1
+    assert errors[0].message == (
+        "Found non-IUPAC symbols in the main sequence: -. "
+        "Gap characters (-) are not allowed in raw sequences."
+    )
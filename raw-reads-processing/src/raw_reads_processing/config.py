@@ -2,6 +2,7 @@ from pathlib import Path
 
 import yaml
 from pydantic import BaseModel
+from raw_reads_processing.datatypes import Validator
 
 
 class Config(BaseModel):
@@ -12,6 +13,11 @@ class Config(BaseModel):
     file_service_host: str | None = None
     file_service_port: int | None = None
 
+    # validators that read the files through named pipes while they are downloaded
+    # instead of from a local copy, see README
+    streaming_validators: list[Validator] = []
+    streaming_buffer_bytes: int = 64 * 1024 * 1024  # per validator and file
+
     deacon_max_host_reads_proportion: float
     deacon_max_host_bp: int  # maximum number of host base pairs allowed in a sample before it is flagged as contaminated
 
@@ -1,4 +1,5 @@
 from dataclasses import dataclass, fields
+from enum import StrEnum
 import json
 from pathlib import Path
 
@@ -9,6 +10,11 @@ FileName = str
 FileUrl = str
 
 
+class Validator(StrEnum):
+    READTOOLS = "readtools"
+    DEACON = "deacon"
+
+
 class FileIdAndNameAndReadUrl(BaseModel):
     fileId: FileId  # noqa: N815
     name: FileName
@@ -1,4 +1,8 @@
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -9,34 +13,150 @@ from raw_reads_processing.datatypes import (
     FileIdAndNameAndReadUrl,
     FileName,
     RequestWithFiles,
+    Validator,
 )
 from raw_reads_processing.errors import ProcessingFailure
 from raw_reads_processing.file_format_validation import (
+    FileFormat,
     validate_file_extensions,
     validate_file_numbers,
     validate_with_readtools,
 )
 from raw_reads_processing.deacon import validate_with_deacon
+from raw_reads_processing.streaming import SpillingBuffer, feed_pipe
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def download_file(
-    config: Config, file: FileIdAndNameAndReadUrl, save_path: Path
-) -> Annotation | None:
-    logger.debug(f"Downloading file '{file.name}' from S3 to '{save_path}'")
+# Formats that validators read front to back. Readers of other formats may seek, e.g.
+# to an index or the EOF marker of a BAM file, so those are always downloaded first.
+STREAMABLE_FORMATS = {FileFormat.FASTQ}
+
+
+def tee_download(
+    config: Config,
+    file: FileIdAndNameAndReadUrl,
+    buffers: list[SpillingBuffer],
+    save_path: Path | None,
+) -> None:
+    """Download `file` into each of `buffers` and, if given, to `save_path`. The buffers
+    are closed when the download ends, also if it failed."""
+    destinations = [f"{len(buffers)} validators"] if buffers else []
+    destinations += [f"'{save_path}'"] if save_path else []
+    logger.debug(
+        f"Downloading file '{file.name}' from S3 to {' and '.join(destinations)}"
+    )
     try:
-        with requests.get(
-            file.url, stream=True, timeout=config.s3_request_timeout_seconds
-        ) as response:
+        with (
+            requests.get(
+                file.url, stream=True, timeout=config.s3_request_timeout_seconds
+            ) as response,
+            save_path.open("wb") if save_path else nullcontext() as f,
+        ):
             response.raise_for_status()
-            with save_path.open("wb") as f:
-                f.writelines(response.iter_content(chunk_size=1024 * 1024))
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                for buffer in buffers:
+                    buffer.put(chunk)
+                if f:
+                    f.write(chunk)
     except requests.RequestException as e:
         message = f"Error downloading file '{file.name}' from S3: {e}"
         logger.error(message)
         raise ProcessingFailure(message) from e
-    logger.debug(f"Successfully downloaded file '{file.name}' to '{save_path}'")
+    finally:
+        for buffer in buffers:
+            buffer.close()
+    logger.debug(f"Successfully downloaded file '{file.name}'")
+
+
+def download_file(
+    config: Config, file: FileIdAndNameAndReadUrl, save_path: Path
+) -> Annotation | None:
+    tee_download(config, file, [], save_path)
+
+
+def run_validator(
+    validator: Validator,
+    files: dict[FileName, Path],
+    file_format: FileFormat,
+    data_dir: str,
+    config: Config,
+) -> None:
+    match validator:
+        case Validator.READTOOLS:
+            validate_with_readtools(
+                files, file_format, config.read_validation_timeout_seconds
+            )
+        case Validator.DEACON:
+            validate_with_deacon(files, data_dir, config)
+
+
+def validate_while_downloading(
+    config: Config,
+    files: list[FileIdAndNameAndReadUrl],
+    file_format: FileFormat,
+    tmp_dir: str,
+) -> None:
+    """Validate `files` with the validators in `config.streaming_validators` while they
+    are downloaded: each file is downloaded once and tee'd into one named pipe per
+    streaming validator. Other validators read a local copy written during the download.
+
+    A failed download is reported over validation errors, as the validators then saw
+    truncated files. Validation errors are raised in the same order as when validating
+    downloaded files.
+    """
+    streaming = [v for v in Validator if v in config.streaming_validators]
+    local_files: dict[FileName, Path] = {}
+    pipes: dict[Validator, dict[FileName, Path]] = {v: {} for v in streaming}
+    buffers: dict[FileName, list[SpillingBuffer]] = {file.name: [] for file in files}
+    reader_done = {v: threading.Event() for v in streaming}
+
+    def validate_from_pipes(validator: Validator) -> None:
+        try:
+            run_validator(validator, pipes[validator], file_format, tmp_dir, config)
+        finally:
+            reader_done[validator].set()
+
+    # Downloads never wait for the validators, so all threads end once the downloads
+    # ended and the validators exited
+    with ThreadPoolExecutor(
+        max_workers=len(files) * (len(streaming) + 1) + len(streaming),
+        thread_name_prefix="validate-while-downloading",
+    ) as executor:
+        for validator in streaming:
+            (Path(tmp_dir) / validator).mkdir()
+            for file in files:
+                pipe_path = Path(tmp_dir) / validator / file.fileId
+                os.mkfifo(pipe_path, 0o600)
+                pipes[validator][file.name] = pipe_path
+                buffer = SpillingBuffer(
+                    config.streaming_buffer_bytes, Path(f"{pipe_path}.spill")
+                )
+                buffers[file.name].append(buffer)
+                executor.submit(feed_pipe, buffer, pipe_path, reader_done[validator])
+        validations = {v: executor.submit(validate_from_pipes, v) for v in streaming}
+
+        if len(streaming) < len(Validator):
+            local_files = {file.name: Path(tmp_dir) / file.fileId for file in files}
+        downloads = [
+            executor.submit(
+                tee_download,
+                config,
+                file,
+                buffers[file.name],
+                local_files.get(file.name),
+            )
+            for file in files
+        ]
+        for download in downloads:
+            download.result()
+
+        for validator in Validator:
+            if validator in validations:
+                validations[validator].result()
+            else:
+                run_validator(validator, local_files, file_format, tmp_dir, config)
 
 
 def validate_raw_reads_submission(
@@ -53,13 +173,15 @@ def validate_raw_reads_submission(
     validate_file_numbers(file_format, [file.name for file in files])
 
     with TemporaryDirectory() as tmp_dir:
+        if config.streaming_validators and file_format in STREAMABLE_FORMATS:
+            validate_while_downloading(config, files, file_format, tmp_dir)
+            return
+
         local_files: dict[FileName, Path] = {}
         for file in files:
             downloaded_file_path = Path(tmp_dir) / f"{file.fileId}"
             download_file(config, file, downloaded_file_path)
             local_files[file.name] = downloaded_file_path
 
-        validate_with_readtools(
-            local_files, file_format, config.read_validation_timeout_seconds
-        )
-        validate_with_deacon(local_files, tmp_dir, config)
+        for validator in Validator:
+            run_validator(validator, local_files, file_format, tmp_dir, config)
@@ -0,0 +1,145 @@
+"""Pass files to validators through named pipes while they are being downloaded."""
+
+import errno
+import logging
+import os
+import threading
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PIPE_OPEN_POLL_SECONDS = 0.05
+SPILL_READ_SIZE = 1024 * 1024
+
+
+class SpillingBuffer:
+    """Chunks of a download on their way to one validator.
+
+    Up to `memory_limit` bytes are held in memory. When the validator falls further
+    behind, e.g. because it reads paired files one after the other while another
+    validator reads them in lockstep, later chunks are spilled to `spill_path` instead
+    of stalling the download. The spill file is removed once the validator caught up.
+    """
+
+    def __init__(self, memory_limit: int, spill_path: Path) -> None:
+        self.memory_limit = memory_limit
+        self.spill_path = spill_path
+        self._chunks: deque[bytes] = deque()
+        self._memory_bytes = 0
+        self._spill_fd: int | None = None
+        self._spill_read = 0
+        self._spill_written = 0
+        self._closed = False
+        self._discarding = False
+        self._changed = threading.Condition()
+
+    def put(self, chunk: bytes) -> None:
+        with self._changed:
+            if self._discarding:
+                return
+            if (
+                self._spill_fd is None
+                and self._memory_bytes + len(chunk) <= self.memory_limit
+            ):
+                self._chunks.append(chunk)
+                self._memory_bytes += len(chunk)
+            else:
+                if self._spill_fd is None:
+                    logger.debug(
+                        f"Validator fell behind, spilling to '{self.spill_path}'"
+                    )
+                    self._spill_fd = os.open(
+                        self.spill_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600
+                    )
+                os.pwrite(self._spill_fd, chunk, self._spill_written)
+                self._spill_written += len(chunk)
+            self._changed.notify()
+
+    def close(self) -> None:
+        """Mark the download as complete (or failed)"""
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+
+    def discard(self) -> None:
+        """Drop buffered and future chunks, the validator stopped reading"""
+        with self._changed:
+            self._discarding = True
+            self._chunks.clear()
+            self._memory_bytes = 0
+            self._remove_spill_file()
+
+    def get(self) -> bytes | None:
+        """The next chunk, or None once the download is complete and all was read"""
+        with self._changed:
+            while True:
+                if self._chunks:
+                    chunk = self._chunks.popleft()
+                    self._memory_bytes -= len(chunk)
+                    return chunk
+                if self._spill_fd is not None:
+                    if self._spill_read < self._spill_written:
+                        chunk = os.pread(
+                            self._spill_fd,
+                            min(
+                                SPILL_READ_SIZE, self._spill_written - self._spill_read
+                            ),
+                            self._spill_read,
+                        )
+                        self._spill_read += len(chunk)
+                        return chunk
+                    # Caught up, buffer in memory again
+                    self._remove_spill_file()
+                if self._closed:
+                    return None
+                self._changed.wait()
+
+    def _remove_spill_file(self) -> None:
+        if self._spill_fd is not None:
+            os.close(self._spill_fd)
+            self.spill_path.unlink(missing_ok=True)
+        self._spill_fd = None
+        self._spill_read = 0
+        self._spill_written = 0
+
+
+def open_pipe_for_writing(pipe_path: Path, reader_done: threading.Event) -> int | None:
+    """Open the named pipe once the validator opened it for reading. Returns None if
+    the validator finished without opening it, e.g. because it failed on another file.
+    """
+    while True:
+        try:
+            fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:  # ENXIO: no reader yet
+                raise
+            if reader_done.wait(PIPE_OPEN_POLL_SECONDS):
+                return None
+            continue
+        # Block on a full pipe so that the validator paces the writes
+        os.set_blocking(fd, True)
+        return fd
+
+
+def feed_pipe(
+    buffer: SpillingBuffer, pipe_path: Path, reader_done: threading.Event
+) -> None:
+    """Write the chunks of `buffer` to the named pipe `pipe_path` until the download is
+    complete or the validator stops reading."""
+    fd = None
+    try:
+        fd = open_pipe_for_writing(pipe_path, reader_done)
+        if fd is None:
+            logger.debug(f"Validator finished without opening '{pipe_path}'")
+            return
+        while (chunk := buffer.get()) is not None:
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view) :]
+    except BrokenPipeError:
+        logger.debug(f"Validator closed '{pipe_path}' before reading all of it")
+    finally:
+        buffer.discard()
+        if fd is not None:
+            os.close(fd)
@@ -0,0 +1,190 @@
+# ruff: noqa: S101
+
+import stat
+from pathlib import Path
+
+import pytest
+import requests
+from raw_reads_processing import process_files
+from raw_reads_processing.config import Config
+from raw_reads_processing.datatypes import (
+    Annotation,
+    FileIdAndNameAndReadUrl,
+    RequestWithFiles,
+    Validator,
+)
+from raw_reads_processing.errors import InvalidSubmission, ProcessingFailure
+from raw_reads_processing.streaming import SpillingBuffer
+
+R1 = "".join(f"@read{i}/1\nACGTACGTAC\n+\nIIIIIIIIII\n" for i in range(500))
+R2 = "".join(f"@read{i}/2\nTTGCATGCAA\n+\nIIIIIIIIII\n" for i in range(500))
+CHUNK_SIZE = 1000
+
+
+def _config(streaming_validators: list[Validator]) -> Config:
+    return Config(
+        log_level="DEBUG",
+        s3_request_timeout_seconds=10,
+        read_validation_timeout_seconds=10,
+        deacon_filter_timeout_seconds=10,
+        deacon_max_host_reads_proportion=0.05,
+        deacon_max_host_bp=1000,
+        streaming_validators=streaming_validators,
+        # Small enough that validators reading the files in different orders spill
+        streaming_buffer_bytes=4 * CHUNK_SIZE,
+    )
+
+
+def _request() -> RequestWithFiles:
+    return RequestWithFiles(
+        accessionVersion="LOC_1.1",
+        files=[
+            FileIdAndNameAndReadUrl(fileId="f1", name="reads_1.fastq", url="R1"),
+            FileIdAndNameAndReadUrl(fileId="f2", name="reads_2.fastq", url="R2"),
+        ],
+    )
+
+
+class FakeResponse:
+    def __init__(self, content: str, fail_after: int | None = None):
+        self.content = content.encode()
+        self.fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for i, start in enumerate(range(0, len(self.content), CHUNK_SIZE)):
+            if i == self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield self.content[start : start + CHUNK_SIZE]
+
+
+class Validators:
+    """Fake validators recording what they read: readtools reads the files one after
+    the other, deacon reads them in lockstep"""
+
+    def __init__(self):
+        self.read: dict[str, dict[str, str]] = {}
+        self.regular_files: dict[str, bool] = {}
+        self.readtools_error: Annotation | None = None
+
+    def _record(self, validator: str, files: dict[str, Path]) -> None:
+        self.regular_files[validator] = all(
+            stat.S_ISREG(path.stat().st_mode) for path in files.values()
+        )
+
+    def readtools(self, files, file_format, timeout_seconds):
+        self._record("readtools", files)
+        if self.readtools_error:
+            raise InvalidSubmission(self.readtools_error)
+        self.read["readtools"] = {
+            name: path.read_text() for name, path in files.items()
+        }
+
+    def deacon(self, files, data_dir, config):
+        self._record("deacon", files)
+        handles = {name: path.open() for name, path in files.items()}
+        content = {name: "" for name in files}
+        while True:
+            lines = {name: f.readline() for name, f in handles.items()}
+            if not any(lines.values()):
+                break
+            for name, line in lines.items():
+                content[name] += line
+        for f in handles.values():
+            f.close()
+        self.read["deacon"] = content
+
+
+@pytest.fixture
+def validators(monkeypatch) -> Validators:
+    fake = Validators()
+    monkeypatch.setattr(process_files, "validate_with_readtools", fake.readtools)
+    monkeypatch.setattr(process_files, "validate_with_deacon", fake.deacon)
+    return fake
+
+
+def _fake_get(monkeypatch, fail_after: int | None = None) -> list[str]:
+    urls = []
+
+    def get(url, stream, timeout):
+        urls.append(url)
+        return FakeResponse({"R1": R1, "R2": R2}[url], fail_after)
+
+    monkeypatch.setattr(process_files.requests, "get", get)
+    return urls
+
+
+def test_spilling_buffer_keeps_order(tmp_path: Path) -> None:
+    buffer = SpillingBuffer(memory_limit=10, spill_path=tmp_path / "spill")
+    received = []
+    for i in range(20):
+        buffer.put(f"{i:04d}".encode())
+        if i % 3 == 0:
+            received.append(buffer.get())
+    assert (tmp_path / "spill").exists()
+    buffer.close()
+    while (chunk := buffer.get()) is not None:
+        received.append(chunk)
+
+    assert b"".join(received) == b"".join(f"{i:04d}".encode() for i in range(20))
+    assert not (tmp_path / "spill").exists()
+
+
+@pytest.mark.parametrize(
+    ("streaming_validators", "regular_files"),
+    [
+        (
+            [Validator.READTOOLS, Validator.DEACON],
+            {"readtools": False, "deacon": False},
+        ),
+        ([Validator.DEACON], {"readtools": True, "deacon": False}),
+    ],
+)
+def test_downloads_are_teed_into_validators(
+    monkeypatch, validators, streaming_validators, regular_files
+) -> None:
+    urls = _fake_get(monkeypatch)
+
+    process_files.validate_raw_reads_submission(
+        _config(streaming_validators), _request()
+    )
+
+    assert sorted(urls) == ["R1", "R2"]
+    expected = {"reads_1.fastq": R1, "reads_2.fastq": R2}
+    assert validators.read == {"readtools": expected, "deacon": expected}
+    assert validators.regular_files == regular_files
+
+
+def test_validator_failing_without_reading_does_not_block(
+    monkeypatch, validators
+) -> None:
+    _fake_get(monkeypatch)
+    validators.readtools_error = Annotation(fileNames=["reads_1.fastq"], message="bad")
+
+    with pytest.raises(InvalidSubmission) as error:
+        process_files.validate_raw_reads_submission(
+            _config([Validator.READTOOLS, Validator.DEACON]), _request()
+        )
+
+    assert error.value.error.message == "bad"
+    assert validators.read["deacon"]["reads_2.fastq"] == R2
+
+
+def test_failed_download_is_reported_over_validation(monkeypatch, validators) -> None:
+    _fake_get(monkeypatch, fail_after=3)
+
+    with pytest.raises(ProcessingFailure, match="connection reset"):
+        process_files.validate_raw_reads_submission(
+            _config([Validator.READTOOLS, Validator.DEACON]), _request()
+        )
+
+    # The validators saw truncated files
+    assert validators.read["deacon"]["reads_1.fastq"] == R1[: 3 * CHUNK_SIZE]
@@ -6,7 +6,12 @@ from typing import Annotated
 import uvicorn
 from fastapi import Depends, FastAPI, HTTPException, Response
 
-from taxonomy_service.datatypes import SubtreeRequestBody, Taxon
+from taxonomy_service.datatypes import (
+    SubtreeRequestBody,
+    TaxaBatchRequest,
+    TaxaBatchResponse,
+    Taxon,
+)
 from taxonomy_service.helpers import (
     ROOT_TAX_ID,
     convert_to_lineage_dict,
@@ -82,6 +87,39 @@ def get_taxon(
     return taxon
 
 
+@app.post("/taxa/batch")
+def query_taxa_batch(payload: TaxaBatchRequest, db: DbConnection) -> TaxaBatchResponse:
+    """Look up many scientific names and taxon IDs in one request, matching them like
+    `GET /taxa` and `GET /taxa/{tax_id}` do. Names and IDs that are not found are left out.
+
+    With find_common_name, `common_names` maps the ID of every returned taxon (also those
+    found by name) to the nearest ancestor (including self) that has a common name, if any.
+    """
+    by_name: dict[str, list[Taxon]] = {}
+    for name in dict.fromkeys(payload.scientific_names):
+        taxa = fetch_by_sci_name(db, name)
+        if taxa is not None:
+            by_name[name] = taxa
+
+    by_id: dict[int, Taxon] = {}
+    for tax_id in dict.fromkeys(payload.tax_ids):
+        taxon = fetch_by_id(db, tax_id)
+        if taxon is not None:
+            by_id[tax_id] = taxon
+
+    common_names: dict[int, Taxon] = {}
+    if payload.find_common_name:
+        found = [*by_id.values(), *(t for taxa in by_name.values() for t in taxa)]
+        for taxon in {t.tax_id: t for t in found}.values():
+            taxon_with_common_name = fetch_common_name(db, taxon)
+            if taxon_with_common_name is not None:
+                common_names[taxon.tax_id] = taxon_with_common_name
+
+    return TaxaBatchResponse(
+        scientific_names=by_name, tax_ids=by_id, common_names=common_names
+    )
+
+
 @app.post("/silo-lineage")
 def post_silo_lineage(
     payload: SubtreeRequestBody,
@@ -1,6 +1,9 @@
 import sqlite3
 from typing import Self
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+# Upper bound on the scientific names and on the taxon IDs of one batch request
+MAX_BATCH_SIZE = 1000
 
 
 class Taxon(BaseModel):
@@ -17,3 +20,15 @@ class Taxon(BaseModel):
 
 class SubtreeRequestBody(BaseModel):
     values: list[int]
+
+
+class TaxaBatchRequest(BaseModel):
+    scientific_names: list[str] = Field(default_factory=list, max_length=MAX_BATCH_SIZE)
+    tax_ids: list[int] = Field(default_factory=list, max_length=MAX_BATCH_SIZE)
+    find_common_name: bool = False
+
+
+class TaxaBatchResponse(BaseModel):
+    scientific_names: dict[str, list[Taxon]]
+    tax_ids: dict[int, Taxon]
+    common_names: dict[int, Taxon]
@@ -10,6 +10,7 @@ from requests import codes
 
 from taxonomy_service.api import app, get_db_connection, init_app
 from taxonomy_service.config import Config, get_config
+from taxonomy_service.datatypes import MAX_BATCH_SIZE
 
 client = TestClient(app)
 
@@ -140,6 +141,58 @@ class ApiTest(unittest.TestCase):
         )
 
 
+class PostTaxaBatchTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config: Config = get_config(config_file)
+        init_app(self.config)
+        app.dependency_overrides[get_db_connection] = get_test_db
+
+    def tearDown(self) -> None:
+        return app.dependency_overrides.clear()
+
+    def test_matches_single_lookups(self):
+        names = ["homo sapiens", "Pan", mock_missing_name]
+        tax_ids = [9606, 131567, mock_missing_taxon]
+        response = client.post(
+            "/taxa/batch",
+            json={
+                "scientific_names": names,
+                "tax_ids": tax_ids,
+                "find_common_name": True,
+            },
+        )
+        assert response.status_code == codes.ok
+        body = response.json()
+
+        assert set(body["scientific_names"]) == {"homo sapiens", "Pan"}
+        for name, taxa in body["scientific_names"].items():
+            query = urllib.parse.urlencode({"scientific_name": name})
+            assert taxa == client.get(f"/taxa?{query}").json()
+
+        assert set(body["tax_ids"]) == {"9606", "131567"}
+        for tax_id, taxon in body["tax_ids"].items():
+            assert taxon == client.get(f"/taxa/{tax_id}").json()
+
+        # Common names for the requested IDs and for the taxa found by name, except
+        # "cellular organisms" which has no ancestor with a common name
+        assert set(body["common_names"]) == {"9606", "9596"}
+        for tax_id, taxon in body["common_names"].items():
+            assert taxon == client.get(f"/taxa/{tax_id}?find_common_name=true").json()
+
+    def test_common_names_only_on_request(self):
+        response = client.post("/taxa/batch", json={"tax_ids": [9606]})
+
+        assert response.status_code == codes.ok
+        assert response.json()["common_names"] == {}
+
+    def test_rejects_oversized_batch(self):
+        response = client.post(
+            "/taxa/batch", json={"tax_ids": list(range(MAX_BATCH_SIZE + 1))}
+        )
+
+        assert response.status_code == codes.unprocessable_entity
+
+
 class PostSiloLineageTest(unittest.TestCase):
     def setUp(self) -> None:
         self.config: Config = get_config(config_file)